@@ -12,6 +12,66 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'db.sqlite'),
+        # apply new migrations when the app starts instead of with flask migrate-db
+        AUTO_MIGRATE=False,
+        # seconds a connection waits for another one's write lock
+        SQLITE_BUSY_TIMEOUT=5.0,
+        # applied to every connection: WAL lets reads continue while a sync writes
+        SQLITE_PRAGMAS={
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -16 * 1024,
+            'temp_store': 'MEMORY',
+        },
+        # rows written per executemany by insert_activities
+        INSERT_BATCH_SIZE=500,
+        # csv rows read, converted and committed at a time by the importers
+        IMPORT_CHUNK_SIZE=10000,
+        # rows handed to a worker process at a time by flask reparse
+        REPARSE_CHUNK_SIZE=10000,
+        # extra values pulled out of descriptions into activity_fields, {name: (pattern, type)}.
+        # The value is the pattern's first group, type is int, float or str. Run
+        # flask rebuild-fields after changing them.
+        DESCRIPTION_FIELDS={
+            'blisters': (r'[bB]listers?:\s?(\d+)', 'int'),
+            'hip_pain': (r'[hH]ip [pP]ain:\s?(\d+)', 'int'),
+            'temperature': (r'[tT]emp(?:erature)?:?\s?(-?\d+(?:\.\d+)?)\s?°?F', 'float'),
+        },
+        # weight of the latest hike in the exponentially weighted statistics hikes are compared with
+        ANOMALY_ALPHA=0.1,
+        # a hike is flagged abnormal when a metric is this many standard deviations above usual...
+        ANOMALY_THRESHOLD=2.0,
+        # ...and at least this fraction above it. Run flask rebuild-anomalies after changing these.
+        ANOMALY_MIN_INCREASE=0.1,
+        # hikes needed before any are flagged
+        ANOMALY_MIN_HIKES=5,
+        # activities per page on the index, and the most a ?page_size= can ask for
+        INDEX_PAGE_SIZE=50,
+        MAX_INDEX_PAGE_SIZE=500,
+        # rendered pages kept in memory per process by cache.cached_view, 0 turns it off
+        VIEW_CACHE_SIZE=64,
+        # rows fetched from the database and sent per chunk by the /api exports
+        EXPORT_BATCH_SIZE=1000,
+        # points /api/series downsamples to by default, and the most a ?points= can ask for
+        SERIES_POINTS=1000,
+        MAX_SERIES_POINTS=5000,
+        # SQLite file the gunicorn workers share rendered pages through, None turns it off
+        SHARED_CACHE=os.path.join(app.instance_path, 'cache.sqlite'),
+        # size the shared cache is trimmed back to, least recently used pages first
+        SHARED_CACHE_MAX_BYTES=64 * 1024 * 1024,
+        # seconds a worker may spend rendering a page before others stop waiting for it
+        SHARED_CACHE_LOCK_TIMEOUT=30,
+        # seconds between checks while waiting for another worker's page
+        SHARED_CACHE_POLL_INTERVAL=0.05,
+        # seconds between scheduled Strava syncs
+        SYNC_INTERVAL=60 * 60,
+        # seconds the background worker sleeps when there's nothing to do
+        WORKER_POLL_INTERVAL=5,
+        # token Strava echoes back when validating the webhook subscription
+        STRAVA_VERIFY_TOKEN=os.getenv('STRAVA_VERIFY_TOKEN'),
+        # if set, webhook events for other subscriptions are rejected
+        STRAVA_SUBSCRIPTION_ID=os.getenv('STRAVA_SUBSCRIPTION_ID'),
     )
 
     if test_config is None:
@@ -31,6 +91,30 @@ def create_app(test_config=None):
     from application import db
     db.init_app(app)
 
+    # register the background worker
+    from application import jobs
+    jobs.init_app(app)
+
+    # register the raw response archive
+    from application import archive
+    archive.init_app(app)
+
+    # register the weekly/monthly rollups
+    from application import rollups
+    rollups.init_app(app)
+
+    # register flask reparse
+    from application import reparse
+    reparse.init_app(app)
+
+    # register the user defined description fields
+    from application import fields
+    fields.init_app(app)
+
+    # register the abnormal hike flags
+    from application import anomalies
+    anomalies.init_app(app)
+
     # a simple page that says hello
     @app.route('/hello')
     def hello():
@@ -39,16 +123,39 @@ def create_app(test_config=None):
     from application import trainer
     app.register_blueprint(trainer.bp)
 
+    from application import webhook
+    app.register_blueprint(webhook.bp)
+
+    from application import api
+    app.register_blueprint(api.bp)
+
     # set trainer blueprint to index (no url_prefix)
     app.add_url_rule('/', endpoint='index')
 
     # add click command
-    from application.internal_api import upload_craw_csv
+    from application import importers
     @app.cli.command('upload-craw-csv')
     @click.argument('filename')
-    def upload_craw_csv_command(filename):
-        """Clear the existing data and create new tables."""
-        upload_craw_csv(filename)
+    @click.option('--chunk-size', type=int, help='Rows to read and commit at a time.')
+    def upload_craw_csv_command(filename, chunk_size):
+        """Import the Walks and Hikes from a CRAW csv, skipping ones already stored."""
+        for stats in importers.import_craw_csv(filename, chunk_size):
+            click.echo(
+                f'{stats["read"]} rows read, {stats["inserted"]} inserted, '
+                f'{stats["skipped"]} already stored ({stats["rows_per_second"]:.0f} rows/s)'
+            )
         click.echo(f'Uploaded {filename} data to database.')
 
+    @app.cli.command('import-strava-export')
+    @click.argument('path')
+    @click.option('--chunk-size', type=int, help='Rows to read and commit at a time.')
+    def import_strava_export_command(path, chunk_size):
+        """Import the Walks and Hikes from a Strava account export zip or directory."""
+        for stats in importers.import_strava_export(path, chunk_size):
+            click.echo(
+                f'{stats["read"]} rows read, {stats["inserted"]} inserted, '
+                f'{stats["updated"]} updated ({stats["rows_per_second"]:.0f} rows/s)'
+            )
+        click.echo(f'Imported {path} into the database.')
+
     return app
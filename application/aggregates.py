@@ -0,0 +1,131 @@
+"""Totals of the activities table by day, week, month or year, grouped in SQLite.
+
+Pages used to pull every activity into a pandas DataFrame to sum it by week.
+Here the grouping, sums and gap filling happen in one query, and the results
+come back as plain lists and dicts the templates can use straight away, so
+requests never import pandas.
+"""
+
+import datetime
+
+from application.db import get_db
+from application.rollups import summarize_rollup
+
+# strftime format each period's buckets are labelled with, the modifier that
+# moves a start_date onto its bucket and the one that steps to the next bucket.
+# Weeks end on Sunday like pandas' W grouping, the others are labelled by their
+# first day.
+PERIODS = {
+    "day": ("%Y-%m-%d", "+0 days", "+1 day"),
+    "week": ("%Y-%m-%d", "weekday 0", "+7 days"),
+    "month": ("%Y-%m-01", "+0 days", "+1 month"),
+    "year": ("%Y-01-01", "+0 days", "+1 year"),
+}
+
+# value of each graphable metric per activity, distance in miles like the summaries
+SERIES_METRICS = {
+    "distance": "ROUND(COALESCE(distance, 0) / 1609.34, 2)",
+    "total_elevation_gain": "COALESCE(total_elevation_gain, 0)",
+    "weight": "weight",
+    "knee_pain": "knee_pain",
+}
+
+AGGREGATE_SQL = '''
+WITH RECURSIVE totals AS (
+    SELECT strftime(:format, start_date, :modifier) AS bucket, COUNT(*) AS activities,
+        SUM(ROUND(COALESCE(distance, 0) / 1609.34, 2)) AS distance,
+        SUM(COALESCE(total_elevation_gain, 0)) AS total_elevation_gain,
+        SUM(COALESCE(weight, 0) * ROUND(COALESCE(distance, 0) / 1609.34, 2)) AS weight_distance,
+        SUM(COALESCE(knee_pain, 0)) AS knee_pain_sum,
+        COUNT(knee_pain) AS knee_pain_count
+    FROM activities
+    WHERE {where}
+    GROUP BY 1
+), buckets (bucket) AS (
+    SELECT MIN(bucket) FROM totals
+    UNION ALL
+    SELECT strftime(:format, bucket, :step) FROM buckets
+    WHERE bucket < (SELECT MAX(bucket) FROM totals)
+)
+SELECT buckets.bucket, activities, distance, total_elevation_gain, weight_distance, knee_pain_sum, knee_pain_count
+FROM buckets LEFT JOIN totals USING (bucket)
+WHERE buckets.bucket IS NOT NULL
+ORDER BY buckets.bucket
+'''
+
+
+def date_range_filter(start=None, end=None):
+    """Returns the WHERE clause and params that keep activities between two dates (inclusive).
+
+    Filters on the indexed start_ts column rather than the start_date string.
+    """
+    where = ["strftime('%s', start_date) IS NOT NULL"]
+    params = {}
+    if start is not None:
+        where.append("start_ts >= CAST(strftime('%s', :start) AS INTEGER)")
+        params["start"] = str(start)
+    if end is not None:
+        where.append("start_ts < CAST(strftime('%s', :end, '+1 day') AS INTEGER)")
+        params["end"] = str(end)
+    return " AND ".join(where), params
+
+
+def aggregate(period="week", start=None, end=None):
+    """Returns the totals for every {period} between the first and last activity in the range.
+
+    Buckets without activities in between are included with zeros, the same
+    way pandas' resampling fills them in.
+
+    :param period: day, week, month or year
+    :type period: str
+
+    :param start: First day to include. None for no lower limit.
+    :type start: datetime.date or str
+
+    :param end: Last day to include. None for no upper limit.
+    :type end: datetime.date or str
+
+    :return: Dicts with date (the bucket label), distance in miles,
+        total_elevation_gain, knee_pain (average per activity) and weight
+        (average per mile), oldest first
+    :rtype: list
+    """
+    if period not in PERIODS:
+        raise ValueError(f"Unknown period {period!r}, use one of {', '.join(PERIODS)}.")
+    bucket_format, modifier, step = PERIODS[period]
+    where, params = date_range_filter(start, end)
+    params.update(format=bucket_format, modifier=modifier, step=step)
+
+    db = get_db(readonly=True)
+    rows = db.execute(AGGREGATE_SQL.format(where=where), params)
+    return [
+        summarize_rollup(row["bucket"], row if row["activities"] is not None else None)
+        for row in rows
+    ]
+
+
+def activity_series(metric, start=None, end=None):
+    """Returns {metric} for every activity in the range, oldest first.
+
+    Activities without a value for the metric (i.e. no weight recorded) are
+    left out.
+
+    :param metric: One of SERIES_METRICS
+    :type metric: str
+
+    :return: (start timestamps, start dates, values) lists
+    :rtype: tuple
+    """
+    where, params = date_range_filter(start, end)
+    db = get_db(readonly=True)
+    rows = db.execute(
+        f"SELECT start_ts, start_date, {SERIES_METRICS[metric]} AS value FROM activities"
+        f" WHERE {where} AND start_ts IS NOT NULL AND value IS NOT NULL ORDER BY start_ts, id",
+        params
+    ).fetchall()
+    return [row["start_ts"] for row in rows], [row["start_date"] for row in rows], [row["value"] for row in rows]
+
+
+def parse_date_arg(value):
+    """Converts a YYYY-MM-DD query string argument to a date. Raises ValueError otherwise."""
+    return datetime.date.fromisoformat(value)
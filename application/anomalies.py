@@ -0,0 +1,282 @@
+"""Flags abnormal hikes, ones where I upped the weight, elevation, speed or distance.
+
+For each metric an exponentially weighted mean and variance of the earlier
+hikes is kept in the anomaly_state table. A new hike is compared with them,
+flagged if a metric is well above its usual value, and then folded in, the
+same small amount of work however long the history is. The flag and the
+reason are stored on the activity, so pages only read them.
+
+Editing or deleting the latest hike takes it back out of the statistics
+(unfold) and, for an edit, folds the new values in. Writes that don't change
+a hike's start or metrics are skipped. Any other hike stored out of order
+(imports, edits and deletes of older hikes) changes the history the
+statistics were built from, so then the whole table is recomputed in one
+vectorized pandas pass instead.
+"""
+
+import math
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from application.db import get_db
+
+# metrics hikes are compared on, the units they're given in the reason and the factor converting to them
+ANOMALY_METRICS = {
+    "weight": ("lbs", 1),
+    "total_elevation_gain": ("ft", 3.281),
+    "average_speed": ("mph", 2.23694),
+    "distance": ("mi", 1 / 1609.34),
+}
+
+
+def get_anomaly_settings():
+    """Returns the ANOMALY_ALPHA, ANOMALY_THRESHOLD, ANOMALY_MIN_INCREASE and ANOMALY_MIN_HIKES config."""
+    config = current_app.config
+    return config['ANOMALY_ALPHA'], config['ANOMALY_THRESHOLD'], config['ANOMALY_MIN_INCREASE'], config['ANOMALY_MIN_HIKES']
+
+
+def is_abnormal(value, count, mean, variance, threshold, min_increase, min_hikes):
+    """Whether {value} is well above the mean and variance of the {count} hikes before it.
+
+    It has to be more than {threshold} standard deviations and {min_increase}
+    (a fraction) above the mean, and there must be {min_hikes} hikes to go on.
+    """
+    if count < min_hikes:
+        return False
+    return value > mean + threshold * math.sqrt(max(variance, 0)) and value > mean * (1 + min_increase)
+
+
+def format_reason(metric, value, mean):
+    """i.e. "weight 35 lbs (usual 20)"."""
+    units, factor = ANOMALY_METRICS[metric]
+    # float() so numpy values round the same as Python ones
+    value, mean = round(float(value) * factor, 1), round(float(mean) * factor, 1)
+    return f"{metric.replace('_', ' ')} {value:g} {units} (usual {mean:g})"
+
+
+def fold(value, count, mean, variance, alpha):
+    """Adds a hike's value to a metric's exponentially weighted mean and variance.
+
+    :return: (count, mean, variance) including {value}
+    :rtype: tuple
+    """
+    if count == 0:
+        return 1, value, 0.0
+    diff = value - mean
+    increment = alpha * diff
+    return count + 1, mean + increment, (1 - alpha) * (variance + diff * increment)
+
+
+def unfold(value, count, mean, variance, alpha):
+    """Takes the last value folded in back out of a metric's statistics, the inverse of fold.
+
+    :return: (count, mean, variance) before {value} was folded in
+    :rtype: tuple
+    """
+    if count <= 1:
+        return 0, 0.0, 0.0
+    mean = (mean - alpha * value) / (1 - alpha)
+    diff = value - mean
+    return count - 1, mean, max(variance / (1 - alpha) - alpha * diff * diff, 0.0)
+
+
+def get_anomaly_values(db, ids):
+    """Returns {id: (start_ts, *metrics)} of the activities with {ids}, what update_anomalies compares edits with."""
+    values = {}
+    for start in range(0, len(ids), 500):
+        batch = ids[start:start + 500]
+        for row in db.execute(
+            f'SELECT id, start_ts, {", ".join(ANOMALY_METRICS)} FROM activities'
+            f' WHERE id IN ({",".join("?" * len(batch))})',
+            batch
+        ):
+            values[row[0]] = tuple(row)[1:]
+    return values
+
+
+def unfold_latest(db, state, activity_id, values):
+    """Takes the latest hike folded in back out of {state}, i.e. before it's edited or deleted.
+
+    :param values: The hike's (start_ts, *metrics) as they were folded in
+    :type values: tuple
+
+    :return: (start_ts, id) of the hike before it, the new last hike folded in, or None
+    :rtype: tuple
+    """
+    alpha = get_anomaly_settings()[0]
+    for metric, value in zip(ANOMALY_METRICS, values[1:]):
+        if value is not None:
+            state[metric] = list(unfold(value, *state[metric], alpha))
+    before = db.execute(
+        'SELECT start_ts, id FROM activities WHERE (start_ts, id) < (?, ?) AND id != ?'
+        ' ORDER BY start_ts DESC, id DESC LIMIT 1',
+        (values[0], activity_id, activity_id)
+    ).fetchone()
+    return tuple(before) if before else None
+
+
+def get_anomaly_state(db):
+    """Returns ({metric: [count, mean, variance]}, (start_ts, id) of the last hike folded in or None)."""
+    state = {metric: [0, 0.0, 0.0] for metric in ANOMALY_METRICS}
+    last = None
+    for row in db.execute('SELECT metric, count, mean, variance, last_start_ts, last_id FROM anomaly_state'):
+        if row["metric"] in state:
+            state[row["metric"]] = [row["count"], row["mean"], row["variance"]]
+        if row["last_id"] is not None:
+            last = (row["last_start_ts"], row["last_id"])
+    return state, last
+
+
+def save_anomaly_state(db, state, last):
+    db.execute('DELETE FROM anomaly_state')
+    db.executemany(
+        'INSERT INTO anomaly_state (metric, count, mean, variance, last_start_ts, last_id) VALUES (?, ?, ?, ?, ?, ?)',
+        [(metric, *values, *(last or (None, None))) for metric, values in state.items()]
+    )
+
+
+def update_anomalies(db, ids, previous=None):
+    """Flags the activities with {ids}, just written, against the hikes before them.
+
+    Activities newer than every hike already folded in are checked and folded
+    in one at a time. The latest hike can be edited the same way, it's
+    unfolded first. Activities whose start and metrics didn't change are
+    left alone. If any other activity is at or before the last hike folded
+    in, the flags are rebuilt from scratch. Doesn't commit, call it in the
+    transaction that wrote them.
+
+    :param db: Connection the activities were written with
+    :type db: sqlite3.Connection
+
+    :param ids: activities.id of the activities written
+    :type ids: list
+
+    :param previous: get_anomaly_values of the activities that were already
+        stored, from before they were written
+    :type previous: dict
+    """
+    previous = previous or {}
+    current = get_anomaly_values(db, list(ids))
+    changed = {activity_id: values for activity_id, values in current.items() if previous.get(activity_id) != values}
+    if not changed:
+        return
+    state, last = get_anomaly_state(db)
+
+    # edits of hikes already folded in
+    edited = [
+        activity_id for activity_id in changed
+        if activity_id in previous and previous[activity_id][0] is not None
+        and last is not None and (previous[activity_id][0], activity_id) <= last
+    ]
+    if edited:
+        if edited != [last[1]]:
+            rebuild_anomalies(db)
+            return
+        last = unfold_latest(db, state, last[1], previous[last[1]])
+
+    rows = sorted(
+        ((activity_id, values) for activity_id, values in changed.items() if values[0] is not None),
+        key=lambda row: (row[1][0], row[0])
+    )
+    if last is not None and rows and (rows[0][1][0], rows[0][0]) <= last:
+        rebuild_anomalies(db)
+        return
+
+    alpha, threshold, min_increase, min_hikes = get_anomaly_settings()
+    flags = [(0, None, activity_id) for activity_id, values in changed.items() if values[0] is None]
+    for activity_id, values in rows:
+        reasons = []
+        for metric, value in zip(ANOMALY_METRICS, values[1:]):
+            if value is None:
+                continue
+            count, mean, variance = state[metric]
+            if is_abnormal(value, count, mean, variance, threshold, min_increase, min_hikes):
+                reasons.append(format_reason(metric, value, mean))
+            state[metric] = list(fold(value, count, mean, variance, alpha))
+        flags.append((1 if reasons else 0, "; ".join(reasons) or None, activity_id))
+        last = (values[0], activity_id)
+    db.executemany('UPDATE activities SET abnormal = ?, abnormal_reason = ? WHERE id = ?', flags)
+    save_anomaly_state(db, state, last)
+
+
+def forget_anomaly(db, activity_id, values):
+    """Takes a deleted activity out of the statistics. Call after deleting it, doesn't commit.
+
+    Deleting the latest hike unfolds it, deleting an earlier one rebuilds
+    the flags of the hikes after it.
+
+    :param values: The activity's get_anomaly_values from before it was deleted
+    :type values: tuple
+    """
+    state, last = get_anomaly_state(db)
+    if values[0] is None or last is None or (values[0], activity_id) > last:
+        # never folded in
+        return
+    if (values[0], activity_id) == last:
+        save_anomaly_state(db, state, unfold_latest(db, state, activity_id, values))
+    else:
+        rebuild_anomalies(db)
+
+
+def rebuild_anomalies(db):
+    """Recomputes every flag and the statistics in one pass over the activities table.
+
+    The exponentially weighted statistics before each hike come from pandas'
+    ewm, which gives the same values fold does one at a time. Only flags that
+    changed are written. Doesn't commit.
+    """
+    import numpy as np
+    import pandas as pd
+    alpha, threshold, min_increase, min_hikes = get_anomaly_settings()
+    hikes = pd.read_sql_query(
+        f'SELECT id, start_ts, abnormal, abnormal_reason, {", ".join(ANOMALY_METRICS)} FROM activities'
+        ' WHERE start_ts IS NOT NULL ORDER BY start_ts, id',
+        db
+    )
+    state = {metric: [0, 0.0, 0.0] for metric in ANOMALY_METRICS}
+    reasons = pd.Series([[] for _ in range(len(hikes))], index=hikes.index, dtype=object)
+    for metric in ANOMALY_METRICS:
+        values = pd.to_numeric(hikes[metric], errors='coerce').dropna()
+        if values.empty:
+            continue
+        ewm = values.ewm(alpha=alpha, adjust=False)
+        means, variances = ewm.mean(), ewm.var(bias=True)
+        # the statistics of the hikes before each one
+        before_means, before_variances = means.shift(1), variances.shift(1).clip(lower=0)
+        counts = np.arange(len(values))
+        abnormal = (
+            (counts >= min_hikes)
+            & (values > before_means + threshold * np.sqrt(before_variances))
+            & (values > before_means * (1 + min_increase))
+        )
+        for index in values.index[abnormal]:
+            reasons[index].append(format_reason(metric, values[index], before_means[index]))
+        state[metric] = [len(values), float(means.iloc[-1]), float(variances.iloc[-1])]
+
+    flags = reasons.map(lambda found: "; ".join(found) or None)
+    changed = (hikes["abnormal"] != flags.notna().astype(int)) | (hikes["abnormal_reason"].fillna("") != flags.fillna(""))
+    db.executemany(
+        'UPDATE activities SET abnormal = ?, abnormal_reason = ? WHERE id = ?',
+        [(1 if reason else 0, reason, int(activity_id)) for activity_id, reason in zip(hikes["id"][changed], flags[changed])]
+    )
+    db.execute('UPDATE activities SET abnormal = 0, abnormal_reason = NULL WHERE start_ts IS NULL AND abnormal != 0')
+    last = None
+    if len(hikes):
+        last = (int(hikes["start_ts"].iloc[-1]), int(hikes["id"].iloc[-1]))
+    save_anomaly_state(db, state, last)
+
+
+@click.command('rebuild-anomalies')
+@with_appcontext
+def rebuild_anomalies_command():
+    """Re-flag every abnormal hike from scratch, i.e. after changing the ANOMALY_ settings."""
+    db = get_db()
+    with db:
+        rebuild_anomalies(db)
+    count = db.execute('SELECT COUNT(*) FROM activities WHERE abnormal = 1').fetchone()[0]
+    click.echo(f'Flagged {count} abnormal hikes.')
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_anomalies_command)
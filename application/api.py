@@ -0,0 +1,178 @@
+"""Machine readable exports of the activities table.
+
+The exports are streamed: rows come off a database cursor a batch at a time
+and are encoded and (optionally) gzipped as they go, so the first bytes go
+out straight away and exporting the whole history uses the same memory as
+exporting a week. The graph series are downsampled to a point budget, so
+the graphs load the same amount of data however long the history is.
+The user defined description fields are summed up per period in SQLite.
+"""
+import csv
+import io
+import json
+import zlib
+from itertools import islice
+
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context
+from werkzeug.exceptions import abort
+from application.aggregates import PERIODS, SERIES_METRICS, activity_series, aggregate, parse_date_arg
+from application.cache import cached_view
+from application.db import get_db
+from application.downsample import lttb
+from application.fields import aggregate_field, field_types
+from application.internal_api import activity_filters_from_args, iter_activities
+
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+EXPORT_MIMETYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+@bp.route('/activities')
+@bp.route('/activities.<any(ndjson, csv):format>')
+def activities(format='ndjson'):
+    """Stream activities oldest first as NDJSON (the default) or CSV.
+
+    ?fields= is a comma separated list of columns to include, the
+    ACTIVITY_FILTERS arguments (type, ground_type, start, end, min_weight,
+    max_weight, min_knee_pain) narrow the activities down. The response is
+    gzipped when the client accepts it.
+    """
+    fields = get_export_fields(request.args.get('fields'))
+    filters = activity_filters_from_args(request.args)
+    rows = iter_activities(fields, filters)
+    if format == "csv":
+        chunks = csv_chunks(fields, rows)
+    else:
+        chunks = ndjson_chunks(fields, rows)
+
+    headers = {"Vary": "Accept-Encoding"}
+    if format == "csv":
+        headers["Content-Disposition"] = "attachment; filename=activities.csv"
+    if 'gzip' in request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[format], headers=headers)
+
+
+def get_export_fields(fields):
+    """Returns the activities columns to export from a ?fields= value, all of them if None. Aborts on unknown ones."""
+    db = get_db(readonly=True)
+    columns = [row["name"] for row in db.execute('PRAGMA table_info(activities)')]
+    if not fields:
+        return columns
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in columns]
+    if unknown or not fields:
+        abort(400, f"Unknown fields {', '.join(unknown)}, use any of {', '.join(columns)}.")
+    return fields
+
+
+def batched_rows(rows):
+    """Splits rows into lists of EXPORT_BATCH_SIZE, so each response chunk holds a batch."""
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def ndjson_chunks(fields, rows):
+    """Yields a JSON object per activity, one per line, a batch per chunk."""
+    for batch in batched_rows(rows):
+        yield "".join(
+            json.dumps(dict(zip(fields, row)), default=str) + "\n" for row in batch
+        ).encode('utf8')
+
+
+def csv_chunks(fields, rows):
+    """Yields the header and then a batch of csv rows per chunk."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for batch in batched_rows(rows):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # no activities, still send the header
+        yield buffer.getvalue().encode('utf8')
+
+
+def gzip_chunks(chunks):
+    """Gzips a stream of chunks, flushing after each one so the client gets data as it's made."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+@bp.route('/series')
+@cached_view('activities')
+def series():
+    """A metric over time for the graphs, downsampled to at most ?points= points.
+
+    ?metric= is distance (the default, in miles), total_elevation_gain,
+    weight or knee_pain. ?start= and ?end= (YYYY-MM-DD) zoom in on a date
+    range and ?period= (day, week, month or year) graphs the totals per
+    period instead of every activity. Points are picked with LTTB, so peaks
+    and dips survive the downsampling.
+    """
+    metric = request.args.get('metric', 'distance')
+    period = request.args.get('period')
+    if metric not in SERIES_METRICS:
+        abort(400, f"Unknown metric, use one of {', '.join(SERIES_METRICS)}.")
+    if period is not None and period not in PERIODS:
+        abort(400, f"Unknown period, use one of {', '.join(PERIODS)}.")
+    points = request.args.get('points', current_app.config['SERIES_POINTS'], type=int)
+    points = min(max(points, 3), current_app.config['MAX_SERIES_POINTS'])
+    start = request.args.get('start', type=parse_date_arg)
+    end = request.args.get('end', type=parse_date_arg)
+
+    if period is None:
+        x, dates, y = activity_series(metric, start, end)
+    else:
+        buckets = aggregate(period, start, end)
+        dates = [bucket["date"] for bucket in buckets]
+        x = list(range(len(buckets)))
+        y = [bucket[metric] for bucket in buckets]
+
+    kept = lttb(x, y, points)
+    return jsonify({
+        "metric": metric,
+        "period": period,
+        "total": len(x),
+        "x": [dates[i] for i in kept],
+        "y": [y[i] for i in kept],
+    })
+
+
+@bp.route('/fields')
+def description_fields():
+    """The DESCRIPTION_FIELDS pulled out of descriptions and their types."""
+    return jsonify(field_types())
+
+
+@bp.route('/fields/<name>')
+@cached_view('activities')
+def description_field(name):
+    """Count, sum, average, min and max of a description field.
+
+    ?period= (day, week, month or year) gives them per period, otherwise over
+    every activity. ?start= and ?end= (YYYY-MM-DD) narrow the activities down.
+    Filter activities on a field with min_<name>, max_<name> or <name> on
+    the index or /api/activities.
+    """
+    if name not in field_types():
+        abort(404, f"Unknown field, use one of {', '.join(field_types())}.")
+    period = request.args.get('period')
+    if period is not None and period not in PERIODS:
+        abort(400, f"Unknown period, use one of {', '.join(PERIODS)}.")
+    start = request.args.get('start', type=parse_date_arg)
+    end = request.args.get('end', type=parse_date_arg)
+    return jsonify({
+        "field": name,
+        "period": period,
+        "buckets": aggregate_field(name, period, start, end),
+    })
@@ -0,0 +1,103 @@
+"""Keeps the raw DetailedActivity responses from Strava.
+
+parse_description only keeps what it understands, so every response is also
+stored gzipped. When the parser improves the parsed columns can be rebuilt
+from here instead of downloading everything from Strava again.
+"""
+
+import gzip
+import json
+
+import click
+from flask.cli import with_appcontext
+from application.anomalies import rebuild_anomalies
+from application.db import get_db
+from application.fields import store_fields
+from application.internal_api import ARCHIVE_ACTIVITY_SQL, parse_description
+
+
+def archive_row(activity):
+    """Returns the (strava_id, body) row storing a DetailedActivity as returned by Strava.
+
+    Call before parsing, which adds keys to it. The row is written by
+    insert_activities, in the same transaction as the activity.
+
+    :param activity: DetailedActivity JSON dict
+    :type activity: dict
+    """
+    return activity["id"], gzip.compress(json.dumps(activity).encode('utf8'))
+
+
+def archive_activity(activity):
+    """Stores a DetailedActivity on its own, outside of a sync. Call before parsing, which adds keys to it.
+
+    :param activity: DetailedActivity JSON dict
+    :type activity: dict
+    """
+    db = get_db()
+    with db:
+        db.execute(ARCHIVE_ACTIVITY_SQL, archive_row(activity))
+
+
+def get_archived_activity(strava_id):
+    """Returns the most recently fetched DetailedActivity for {strava_id}, or None."""
+    db = get_db()
+    row = db.execute(
+        'SELECT body FROM activity_archive WHERE strava_id = ? ORDER BY fetched_at DESC LIMIT 1',
+        (strava_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    return json.loads(gzip.decompress(row["body"]))
+
+
+def iter_archived_activities():
+    """Yields the most recently fetched DetailedActivity for every archived strava_id."""
+    db = get_db()
+    # SQLite takes the bare body column from the row that has the MAX(fetched_at)
+    rows = db.execute(
+        'SELECT body, MAX(fetched_at) FROM activity_archive GROUP BY strava_id'
+    )
+    for row in rows:
+        yield json.loads(gzip.decompress(row["body"]))
+
+
+def reparse_activities():
+    """Rebuilds the columns parse_description fills in from the archive. Makes no Strava calls.
+
+    :return: Number of activities updated
+    :rtype: int
+    """
+    updates = []
+    for activity in iter_archived_activities():
+        parse_description(activity)
+        updates.append((
+            activity["weight"], activity["knee_pain"], activity["ground_type"],
+            activity["comments"], activity["description"], activity["id"]
+        ))
+
+    db = get_db()
+    with db:
+        db.executemany(
+            'UPDATE activities SET weight = ?, knee_pain = ?, ground_type = ?, comments = ?, description = ?'
+            ' WHERE strava_id = ?',
+            updates
+        )
+        # the descriptions may have changed too
+        store_fields(db, [row[0] for row in db.execute(
+            'SELECT id FROM activities WHERE strava_id IN (SELECT strava_id FROM activity_archive)'
+        )])
+        rebuild_anomalies(db)
+    return len(updates)
+
+
+@click.command('reparse-activities')
+@with_appcontext
+def reparse_activities_command():
+    """Re-parse archived descriptions into the activities table."""
+    count = reparse_activities()
+    click.echo(f'Re-parsed {count} archived activities.')
+
+
+def init_app(app):
+    app.cli.add_command(reparse_activities_command)
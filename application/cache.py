@@ -0,0 +1,243 @@
+"""HTTP caching for the pages that only read activities.
+
+Triggers bump a counter in data_versions on every write to the tables a page
+reads (see migrations/0008_data_versions.sql). The page's ETag is built from
+those counters, so a conditional request is answered with a 304 after one
+tiny query. The rendered body is kept under the same ETag, first in this
+process' memory and then in a SQLite file shared by every gunicorn worker,
+where only one worker renders a missing page while the others wait for it.
+"""
+
+import datetime
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, make_response, request
+from application.db import get_db, get_connection
+
+# the shared cache connection each thread last made sure has the tables
+_schema_ready = threading.local()
+
+SHARED_CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    /* the page the body belongs to, older versions of it are dropped on store */
+    page TEXT NOT NULL,
+    body BLOB NOT NULL,
+    mimetype TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at);
+CREATE INDEX IF NOT EXISTS cache_page ON cache (page);
+/* a row per entry being computed, whoever inserted it computes it */
+CREATE TABLE IF NOT EXISTS cache_locks (
+    key TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+);
+'''
+
+
+class BodyCache:
+    """A small thread safe LRU of rendered responses, keyed by ETag."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.bodies = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.bodies.get(key)
+            if body is not None:
+                self.bodies.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.bodies[key] = body
+            self.bodies.move_to_end(key)
+            while len(self.bodies) > self.maxsize:
+                self.bodies.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.bodies.clear()
+
+
+def get_body_cache():
+    """Returns the app's BodyCache, sized by the VIEW_CACHE_SIZE config."""
+    cache = current_app.extensions.get('view_cache')
+    if cache is None:
+        cache = current_app.extensions['view_cache'] = BodyCache(current_app.config['VIEW_CACHE_SIZE'])
+    return cache
+
+
+def get_shared_cache_db():
+    """Returns this thread's connection to the SHARED_CACHE file, creating its tables the first time."""
+    db = get_connection(current_app.config['SHARED_CACHE'])
+    if getattr(_schema_ready, 'db', None) is not db:
+        db.executescript(SHARED_CACHE_SCHEMA)
+        _schema_ready.db = db
+    return db
+
+
+def get_shared(key):
+    """Returns the (body, mimetype) stored under {key} in the shared cache, or None."""
+    db = get_shared_cache_db()
+    row = db.execute('SELECT body, mimetype, accessed_at FROM cache WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    now = time.time()
+    # recording every hit would serialize the workers on the write lock, once a minute is plenty for LRU
+    if now - row["accessed_at"] > 60:
+        with db:
+            db.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+    return row["body"], row["mimetype"]
+
+
+def set_shared(key, page, body, mimetype):
+    """Stores a body in the shared cache, replacing older versions of {page}.
+
+    Least recently used entries are evicted until the cache fits in
+    SHARED_CACHE_MAX_BYTES again.
+    """
+    db = get_shared_cache_db()
+    with db:
+        db.execute('DELETE FROM cache WHERE page = ? AND key != ?', (page, key))
+        db.execute(
+            'INSERT OR REPLACE INTO cache (key, page, body, mimetype, size, accessed_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (key, page, body, mimetype, len(body), time.time())
+        )
+        db.execute(
+            'DELETE FROM cache WHERE key IN (SELECT key FROM ('
+            ' SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS total FROM cache'
+            ') WHERE total > ?)',
+            (current_app.config['SHARED_CACHE_MAX_BYTES'],)
+        )
+
+
+def claim_shared(key):
+    """Takes the lock to compute {key}. False if another worker holds it and it hasn't expired."""
+    db = get_shared_cache_db()
+    now = time.time()
+    with db:
+        claimed = db.execute(
+            'INSERT INTO cache_locks (key, expires_at) VALUES (?, ?)'
+            ' ON CONFLICT (key) DO UPDATE SET expires_at = excluded.expires_at WHERE expires_at < ?',
+            (key, now + current_app.config['SHARED_CACHE_LOCK_TIMEOUT'], now)
+        ).rowcount
+    return claimed == 1
+
+
+def release_shared(key):
+    db = get_shared_cache_db()
+    with db:
+        db.execute('DELETE FROM cache_locks WHERE key = ?', (key,))
+
+
+def get_or_compute_shared(key, page, compute):
+    """Returns the shared cache entry for {key}, making sure only one worker computes it.
+
+    The first worker to miss takes a lock and calls {compute}; the others
+    poll until its result shows up. If it gives up (compute returned None or
+    raised) one of them takes over, and nobody waits longer than
+    SHARED_CACHE_LOCK_TIMEOUT.
+
+    :param compute: Called without arguments, returns (body, mimetype) or None when the result shouldn't be cached
+    :type compute: function
+
+    :return: (body, mimetype), or None if compute returned None
+    :rtype: tuple
+    """
+    deadline = time.time() + current_app.config['SHARED_CACHE_LOCK_TIMEOUT']
+    while True:
+        entry = get_shared(key)
+        if entry is not None:
+            return entry
+        claimed = claim_shared(key)
+        if claimed or time.time() > deadline:
+            break
+        time.sleep(current_app.config['SHARED_CACHE_POLL_INTERVAL'])
+
+    try:
+        entry = compute()
+        if entry is not None:
+            set_shared(key, page, *entry)
+        return entry
+    finally:
+        if claimed:
+            release_shared(key)
+
+
+def get_data_versions(tables):
+    """Returns the data_versions rows of {tables}. Never touches the tables themselves."""
+    db = get_db(readonly=True)
+    return db.execute(
+        f'SELECT * FROM data_versions WHERE name IN ({",".join("?" * len(tables))}) ORDER BY name',
+        tables
+    ).fetchall()
+
+
+def make_etag(versions):
+    """Returns the ETag of the current request's page at {versions}."""
+    key = [request.endpoint, request.full_path]
+    key.extend(f'{row["name"]}:{row["generation"]}:{row["version"]}' for row in versions)
+    return hashlib.sha1('\n'.join(key).encode('utf8')).hexdigest()
+
+
+def cached_view(*tables):
+    """Decorates a view that only reads {tables} so it is served from its data versions.
+
+    Sends ETag and Last-Modified headers, answers If-None-Match and
+    If-Modified-Since with 304 and serves repeat views of an unchanged page
+    from the BodyCache, or the shared cache when another worker rendered it.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(*args, **kwargs):
+            # read before rendering: a write in between only leaves a newer body under an older ETag
+            versions = get_data_versions(tables)
+            etag = make_etag(versions)
+            last_modified = max(row["changed_at"] for row in versions).replace(tzinfo=datetime.timezone.utc)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                cache = get_body_cache()
+                body = cache.get(etag)
+                rendered = None
+                if body is None:
+                    def render():
+                        nonlocal rendered
+                        rendered = make_response(view(*args, **kwargs))
+                        if rendered.status_code == 200 and not rendered.is_streamed:
+                            return rendered.get_data(), rendered.mimetype
+                        return None
+
+                    if current_app.config['SHARED_CACHE']:
+                        page = f'{request.endpoint} {request.full_path}'
+                        body = get_or_compute_shared(etag, page, render)
+                    else:
+                        body = render()
+                    if body is not None:
+                        cache.set(etag, body)
+                response = rendered if rendered is not None else current_app.response_class(body[0], mimetype=body[1])
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # browsers may keep the page but have to check it's still current
+            response.cache_control.no_cache = True
+            return response
+        return wrapped_view
+    return decorator
@@ -1,33 +1,218 @@
+import importlib.util
+import os
 import sqlite3
+import threading
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
+# Connections kept open by this thread, keyed by (database, readonly). Each
+# gunicorn worker thread or process ends up with its own tuned connection.
+_connections = threading.local()
 
-def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
+
+def connect(database, readonly=False):
+    """Opens a connection tuned with the SQLITE_PRAGMAS config.
+
+    Read-only connections open the file with mode=ro and query_only on, so a
+    view can never take the write lock.
+    """
+    if readonly:
+        db = sqlite3.connect(
+            f'file:{database}?mode=ro', uri=True,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=current_app.config['SQLITE_BUSY_TIMEOUT']
+        )
+    else:
+        db = sqlite3.connect(
+            database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=current_app.config['SQLITE_BUSY_TIMEOUT']
         )
-        g.db.row_factory = sqlite3.Row
+    db.row_factory = sqlite3.Row
+
+    for pragma, value in current_app.config['SQLITE_PRAGMAS'].items():
+        # the journal mode is stored in the database file, only writers set it
+        if readonly and pragma == 'journal_mode':
+            continue
+        db.execute(f'PRAGMA {pragma} = {value}')
+    if readonly:
+        db.execute('PRAGMA query_only = ON')
+    return db
+
+
+def get_connection(database, readonly=False):
+    """Returns this thread's pooled connection to {database}, opening it the first time."""
+    key = (database, readonly)
+    pool = getattr(_connections, 'pool', None)
+    # a forked worker can't share its parent's connections
+    if pool is None or _connections.pid != os.getpid():
+        pool = _connections.pool = {}
+        _connections.pid = os.getpid()
+    if key not in pool:
+        pool[key] = connect(*key)
+    return pool[key]
+
+
+def get_db(readonly=False):
+    """Returns this thread's connection to the database, opening it the first time.
+
+    The connection outlives the request, so later requests on the same
+    thread skip connection setup. Pass readonly=True from code that only
+    reads, i.e. views, to get a connection that can't block writers.
+    """
+    name = 'db_readonly' if readonly else 'db'
+    if name not in g:
+        setattr(g, name, get_connection(current_app.config['DATABASE'], readonly))
 
-    return g.db
+    return g.get(name)
 
 
 def close_db(e=None):
-    db = g.pop('db', None)
+    """Hands the connections back at the end of a request, rolling back anything left uncommitted."""
+    for name in ('db', 'db_readonly'):
+        db = g.pop(name, None)
 
-    if db is not None:
+        if db is not None and db.in_transaction:
+            db.rollback()
+
+
+def close_connections():
+    """Closes every connection this thread has open, i.e. before deleting the database."""
+    pool = getattr(_connections, 'pool', None) or {}
+    for db in pool.values():
         db.close()
+    pool.clear()
+
+
+MIGRATIONS_PATH = os.path.join(os.path.dirname(__file__), 'migrations')
+
+
+def get_migrations():
+    """Returns (version, path) of every migration, oldest first.
+
+    Migrations live in application/migrations as NNNN_description.sql or
+    NNNN_description.py. A .py migration defines upgrade(db) and is for
+    changes, like backfills, that need to run in batches. It can also set
+    REBUILDS to the get_rebuilds names of derived tables to fill in once
+    every migration has been applied.
+    """
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_PATH):
+        version, _, rest = filename.partition('_')
+        if version.isdigit() and rest.endswith(('.sql', '.py')):
+            migrations.append((int(version), os.path.join(MIGRATIONS_PATH, filename)))
+    return sorted(migrations)
+
+
+def get_db_version():
+    """Returns the version of the last migration applied to the database."""
+    return get_db().execute('PRAGMA user_version').fetchone()[0]
+
+
+def get_rebuilds():
+    """Returns the function that rebuilds each kind of derived data a migration can ask for.
+
+    They use the application code and config as they are now, so they run
+    after the last migration rather than inside the one that asked for them.
+    Rebuilds are passed the connection and don't need to commit.
+    """
+    from application.fields import rebuild_fields
+    from application.anomalies import rebuild_anomalies
+    return {
+        "fields": lambda db: rebuild_fields(),
+        "anomalies": rebuild_anomalies,
+    }
+
+
+def migrate_db(target=None):
+    """Applies every migration newer than the database, keeping existing data.
+
+    The version reached is stored in PRAGMA user_version. A .sql migration
+    and its version bump commit together; a .py migration must be safe to
+    run again if it's interrupted. The REBUILDS the applied migrations ask
+    for run once the database reaches the latest version, if there are any
+    activities to rebuild from. A migration stopped short by {target}
+    leaves them to the flask rebuild-* commands.
+
+    :param target: Stop after this version. Defaults to the latest.
+    :type target: int
+
+    :return: Versions that were applied
+    :rtype: list
+    """
+    db = get_db()
+    current = get_db_version()
+    applied = []
+    rebuilds = []
+    migrations = get_migrations()
+    for version, path in migrations:
+        if version <= current or (target is not None and version > target):
+            continue
+        if path.endswith('.sql'):
+            with open(path, encoding='utf8') as f:
+                script = f.read()
+            try:
+                db.executescript(f'BEGIN;\n{script}\nPRAGMA user_version = {version};\nCOMMIT;')
+            except sqlite3.Error:
+                db.rollback()
+                raise
+        else:
+            spec = importlib.util.spec_from_file_location(f'application.migrations.m{version}', path)
+            migration = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(migration)
+            migration.upgrade(db)
+            db.execute(f'PRAGMA user_version = {version}')
+            rebuilds += [name for name in getattr(migration, 'REBUILDS', ()) if name not in rebuilds]
+        applied.append(version)
+
+    latest = migrations[-1][0] if migrations else 0
+    # a new database has nothing to rebuild, and rebuilding anomalies loads pandas
+    if rebuilds and get_db_version() == latest and db.execute('SELECT 1 FROM activities LIMIT 1').fetchone():
+        for name in rebuilds:
+            with db:
+                get_rebuilds()[name](db)
+    return applied
+
+
+def backfill(db, table, assignments, where, batch_size=10000):
+    """Runs UPDATE {table} SET {assignments} WHERE {where} one batch per transaction.
+
+    Keeps migrations on big tables from holding the write lock for long.
+    {where} must stop matching rows once they've been updated.
+    """
+    while True:
+        with db:
+            updated = db.execute(
+                f'UPDATE {table} SET {assignments}'
+                f' WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT ?)',
+                (batch_size,)
+            ).rowcount
+        if not updated:
+            break
 
 
 def init_db():
+    """Drops every table and view and builds the schema again from the migrations."""
     db = get_db()
+    objects = db.execute(
+        "SELECT type, name FROM sqlite_master WHERE type IN ('view', 'table') AND name NOT LIKE 'sqlite_%'"
+        " ORDER BY type = 'table'"
+    ).fetchall()
+    for obj in objects:
+        db.execute(f'DROP {obj["type"].upper()} "{obj["name"]}"')
+    db.execute('PRAGMA user_version = 0')
+    db.commit()
+    migrate_db()
+
 
-    with current_app.open_resource('schema.sql') as f:
-        db.executescript(f.read().decode('utf8'))
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    """Apply new migrations, keeping existing data."""
+    applied = migrate_db()
+    click.echo(f'Applied {len(applied)} migrations, database is at version {get_db_version()}.')
 
 
 @click.command('init-db')
@@ -41,4 +226,9 @@ def init_db_command():
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
+
+    if app.config['AUTO_MIGRATE']:
+        with app.app_context():
+            migrate_db()
     
\ No newline at end of file
@@ -0,0 +1,51 @@
+"""Shrinks long time series to a point budget while keeping their shape."""
+
+
+def lttb(x, y, points):
+    """Largest-Triangle-Three-Buckets downsampling.
+
+    Keeps the first and last point and, from each of {points} - 2 equal
+    buckets in between, the point forming the largest triangle with the
+    point kept before it and the average of the next bucket. Peaks and dips
+    survive, unlike plain averaging or taking every nth point.
+
+    :param x: Ascending x values, i.e. timestamps
+    :type x: list
+
+    :param y: y value for each x
+    :type y: list
+
+    :param points: Most points to keep, at least 3
+    :type points: int
+
+    :return: Indexes of the points to keep, ascending
+    :rtype: list
+    """
+    length = len(x)
+    if points >= length or points < 3:
+        return list(range(length))
+
+    every = (length - 2) / (points - 2)
+    kept = [0]
+    a = 0
+    for bucket in range(points - 2):
+        # average of the next bucket, the third corner of the triangle
+        next_start = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, length)
+        next_x = sum(x[next_start:next_end]) / (next_end - next_start)
+        next_y = sum(y[next_start:next_end]) / (next_end - next_start)
+
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        ax, ay = x[a], y[a]
+        largest = -1
+        for i in range(start, end):
+            # twice the triangle's area, the constant factor doesn't change which is largest
+            area = abs((ax - next_x) * (y[i] - ay) - (ax - x[i]) * (next_y - ay))
+            if area > largest:
+                largest = area
+                chosen = i
+        kept.append(chosen)
+        a = chosen
+    kept.append(length - 1)
+    return kept
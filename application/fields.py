@@ -0,0 +1,230 @@
+"""User defined description fields, like "blisters: 2" or "temp 40F".
+
+The DESCRIPTION_FIELDS config names each field and gives its pattern and
+type. The fields are compiled into one pattern (see parser.compile_fields)
+and every activity's values are kept in the activity_fields table, written
+in the same transaction as the activity. Activities can be filtered on them
+with min_<name>, max_<name> and <name> alongside the other ACTIVITY_FILTERS,
+and aggregate_field sums them up by period.
+"""
+
+import functools
+import keyword
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from application import parser
+from application.aggregates import PERIODS, date_range_filter
+from application.db import get_db
+
+# taken by the activities columns and the query string arguments fields are filtered with
+RESERVED_NAMES = {
+    "weight", "knee_pain", "ground_type", "comments", "description", "type",
+    "start", "end", "cursor", "page_size", "fields", "metric", "period", "points", "abnormal",
+}
+
+# comparison for each kind of field filter
+FIELD_OPERATORS = {"min": ">=", "max": "<=", "equals": "="}
+
+AGGREGATE_FIELD_SQL = '''
+SELECT {bucket} AS bucket, COUNT(*) AS activities, SUM(value) AS sum, AVG(value) AS average,
+    MIN(value) AS min, MAX(value) AS max
+FROM activity_fields JOIN activities ON activities.id = activity_fields.activity_id
+WHERE name = :name AND {where}
+GROUP BY 1
+ORDER BY 1
+'''
+
+
+def get_fields():
+    """Returns the DESCRIPTION_FIELDS config compiled for parser.parse_fields.
+
+    :raises ValueError: A field has a name that can't be used or an invalid pattern or type
+    """
+    fields = current_app.config['DESCRIPTION_FIELDS']
+    return compile_fields(tuple((name, tuple(field)) for name, field in fields.items()))
+
+
+@functools.lru_cache(maxsize=8)
+def compile_fields(fields):
+    """Checks the field names and compiles {fields}, ((name, (pattern, type)), ...), once per config."""
+    for name, field in fields:
+        if not name.isidentifier() or keyword.iskeyword(name) or name in RESERVED_NAMES:
+            raise ValueError(f"{name} can't be used as a field name.")
+    return parser.compile_fields(dict(fields))
+
+
+def field_types():
+    """Returns {name: type} of the DESCRIPTION_FIELDS."""
+    return {name: field[1] for name, field in current_app.config['DESCRIPTION_FIELDS'].items()}
+
+
+def extract_field_rows(rows, compiled):
+    """Yields (activity_id, name, value) for the fields found in (id, description) {rows}."""
+    for activity_id, description in rows:
+        for name, value in parser.parse_fields(description, compiled).items():
+            yield activity_id, name, value
+
+
+def store_fields(db, ids, batch_size=500):
+    """Replaces the stored fields of the activities with {ids} with ones parsed from their descriptions.
+
+    Doesn't commit, call it in the transaction that wrote the activities.
+
+    :param db: Connection the activities were written with
+    :type db: sqlite3.Connection
+
+    :param ids: activities.id of the activities to update
+    :type ids: iterable
+    """
+    compiled = get_fields()
+    ids = list(ids)
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        marks = ",".join("?" * len(batch))
+        db.execute(f'DELETE FROM activity_fields WHERE activity_id IN ({marks})', batch)
+        rows = db.execute(
+            f'SELECT id, description FROM activities WHERE id IN ({marks}) AND description IS NOT NULL',
+            batch
+        ).fetchall()
+        db.executemany(
+            'INSERT INTO activity_fields (activity_id, name, value) VALUES (?, ?, ?)',
+            extract_field_rows(rows, compiled)
+        )
+
+
+def rebuild_fields(chunk_size=10000):
+    """Parses every stored description again, i.e. after DESCRIPTION_FIELDS changed.
+
+    Activities are read {chunk_size} at a time in id order and each chunk's
+    fields are replaced in one transaction.
+
+    :return: (activities read, field values stored)
+    :rtype: tuple
+    """
+    compiled = get_fields()
+    db = get_db()
+    read = stored = 0
+    last_id = -1
+    while True:
+        rows = db.execute(
+            'SELECT id, description FROM activities WHERE id > ? ORDER BY id LIMIT ?',
+            (last_id, chunk_size)
+        ).fetchall()
+        if not rows:
+            break
+        values = list(extract_field_rows(rows, compiled))
+        with db:
+            db.execute(
+                'DELETE FROM activity_fields WHERE activity_id > ? AND activity_id <= ?',
+                (last_id, rows[-1]["id"])
+            )
+            db.executemany('INSERT INTO activity_fields (activity_id, name, value) VALUES (?, ?, ?)', values)
+        read += len(rows)
+        stored += len(values)
+        last_id = rows[-1]["id"]
+
+    with db:
+        # no trigger on activity_fields, pages filtered on fields would keep their old ETag otherwise
+        db.execute("UPDATE data_versions SET version = version + 1, changed_at = CURRENT_TIMESTAMP WHERE name = 'activities'")
+        # fields that came from activities past the last one
+        db.execute('DELETE FROM activity_fields WHERE activity_id > ?', (last_id,))
+    return read, stored
+
+
+def field_filters_from_args(args):
+    """Reads min_<name>, max_<name> and <name> for every DESCRIPTION_FIELDS field out of a query string.
+
+    Values that don't convert to the field's type are left out.
+
+    :param args: i.e. request.args
+    :type args: werkzeug.datastructures.MultiDict
+
+    :return: (name, "min", "max" or "equals", value) for each filter given
+    :rtype: list
+    """
+    filters = []
+    for name, type_name in field_types().items():
+        convert = parser.FIELD_TYPES[type_name]
+        for kind, arg in (("min", f'min_{name}'), ("max", f'max_{name}'), ("equals", name)):
+            value = args.get(arg, type=convert)
+            if value is not None and value != "":
+                filters.append((name, kind, value))
+    return filters
+
+
+def field_filter_sql(filters):
+    """Returns WHERE conditions on activities and their params for field_filters_from_args' {filters}."""
+    where = []
+    params = {}
+    for i, (name, kind, value) in enumerate(filters or []):
+        where.append(
+            f'id IN (SELECT activity_id FROM activity_fields'
+            f' WHERE name = :field_name_{i} AND value {FIELD_OPERATORS[kind]} :field_value_{i})'
+        )
+        params[f'field_name_{i}'] = name
+        params[f'field_value_{i}'] = value
+    return where, params
+
+
+def aggregate_field(name, period=None, start=None, end=None):
+    """Counts, sums, averages and finds the min and max of a field, per {period} or over everything.
+
+    Only activities that mention the field count, periods without any are left out.
+
+    :param name: A DESCRIPTION_FIELDS field
+    :type name: str
+
+    :param period: day, week, month or year, None for one bucket of everything
+    :type period: str
+
+    :param start: First day to include
+    :type start: datetime.date
+
+    :param end: Last day to include
+    :type end: datetime.date
+
+    :return: dicts of date (the bucket's label, None without a period),
+        activities, sum, average, min and max
+    :rtype: list
+    """
+    where, params = date_range_filter(start, end)
+    params["name"] = name
+    if period is None:
+        bucket = "NULL"
+    else:
+        bucket = "strftime(:format, start_date, :modifier)"
+        params["format"], params["modifier"] = PERIODS[period][:2]
+
+    db = get_db(readonly=True)
+    rows = db.execute(AGGREGATE_FIELD_SQL.format(bucket=bucket, where=where), params).fetchall()
+    return [
+        {
+            "date": row["bucket"], "activities": row["activities"], "sum": row["sum"],
+            "average": row["average"], "min": row["min"], "max": row["max"],
+        }
+        for row in rows
+    ]
+
+
+def get_activity_fields(activity_id):
+    """Returns {name: value} of the fields stored for an activity."""
+    db = get_db(readonly=True)
+    return {
+        row["name"]: row["value"]
+        for row in db.execute('SELECT name, value FROM activity_fields WHERE activity_id = ?', (activity_id,))
+    }
+
+
+@click.command('rebuild-fields')
+@click.option('--chunk-size', type=int, default=10000, help='Activities to parse and commit at a time.')
+@with_appcontext
+def rebuild_fields_command(chunk_size):
+    """Re-parse the DESCRIPTION_FIELDS out of every stored description."""
+    read, stored = rebuild_fields(chunk_size)
+    click.echo(f'Parsed {read} activities, stored {stored} field values.')
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_fields_command)
@@ -0,0 +1,250 @@
+"""Bulk importers that load activity history from files instead of the Strava API."""
+
+import csv
+import io
+import os
+import time
+import zipfile
+from datetime import datetime
+from itertools import islice
+
+from flask import current_app
+from application.anomalies import rebuild_anomalies
+from application.db import get_db
+from application.internal_api import insert_activities, parse_description
+
+CRAW_COLUMNS = ["Activity Date", "Activity Type", "Distance in Miles", "Comment"]
+
+# activities.csv column for each activities table value. The account export
+# repeats some headers (Distance, Elapsed Time); the later, unrounded metric
+# column wins. Lists are tried in order so API style dumps load too.
+STRAVA_EXPORT_COLUMNS = {
+    "id": ["Activity ID", "id"],
+    "start_date": ["Activity Date", "start_date", "start_date_local"],
+    "type": ["Activity Type", "type"],
+    "description": ["Activity Description", "description"],
+    "distance": ["Distance", "distance"],
+    "moving_time": ["Moving Time", "moving_time"],
+    "elapsed_time": ["Elapsed Time", "elapsed_time"],
+    "total_elevation_gain": ["Elevation Gain", "total_elevation_gain"],
+    "elev_high": ["Elevation High", "elev_high"],
+    "elev_low": ["Elevation Low", "elev_low"],
+    "average_speed": ["Average Speed", "average_speed"],
+}
+STRAVA_EXPORT_DATE_FORMATS = ["%Y-%m-%dT%H:%M:%SZ", "%b %d, %Y, %I:%M:%S %p"]
+
+
+def import_craw_csv(filename, chunk_size=None):
+    """Streams the Walks and Hikes from a CRAW csv export into the activities table.
+
+    The file is read {chunk_size} rows at a time so memory use stays flat no
+    matter how big it is. Each chunk's distances and dates are converted in
+    one vectorized step, rows already stored (same start_date, type and
+    distance) are skipped, and the chunk is committed on its own.
+
+    :param filename: Path to the CRAW csv
+    :type filename: str
+
+    :param chunk_size: Rows read per chunk. Defaults to the IMPORT_CHUNK_SIZE config.
+    :type chunk_size: int
+
+    :return: Generator yielding running totals after every chunk: rows read,
+        inserted, skipped and rows_per_second
+    :rtype: generator
+    """
+    import pandas as pd
+    chunk_size = chunk_size or current_app.config['IMPORT_CHUNK_SIZE']
+    stats = {"read": 0, "inserted": 0, "skipped": 0, "rows_per_second": 0}
+    started = time.perf_counter()
+
+    chunks = pd.read_csv(
+        filename, encoding='utf-8-sig', usecols=CRAW_COLUMNS, dtype=str,
+        keep_default_na=False, chunksize=chunk_size
+    )
+    for chunk in chunks:
+        stats["read"] += len(chunk)
+        chunk = chunk[chunk["Activity Type"].isin(["Walk", "Hike"])]
+
+        # convert miles to meters and the craw date format to Strava's, a column at a time
+        miles = pd.to_numeric(chunk["Distance in Miles"], errors='coerce').fillna(0)
+        distances = (miles * 1609.34).round(2)
+        start_dates = pd.to_datetime(chunk["Activity Date"], format='%m/%d/%y').dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        rows = list(zip(start_dates, chunk["Activity Type"], distances, chunk["Comment"]))
+        stored = get_stored_activity_keys([row[:3] for row in rows])
+        activities = []
+        for start_date, activity_type, distance, comment in rows:
+            key = (start_date, activity_type, distance)
+            if key in stored:
+                stats["skipped"] += 1
+                continue
+            stored.add(key)
+            activities.append(craw_activity(start_date, activity_type, distance, comment))
+
+        stats["inserted"] += len(insert_activities(activities, flag_abnormal=False))
+        stats["rows_per_second"] = stats["read"] / (time.perf_counter() - started)
+        yield dict(stats)
+    rebuild_abnormal_flags()
+
+
+def rebuild_abnormal_flags():
+    """Flags abnormal hikes once an import is done, rather than after every chunk."""
+    db = get_db()
+    with db:
+        rebuild_anomalies(db)
+
+
+def upload_craw_csv(filename, chunk_size=None):
+    """Imports a CRAW csv export and returns the final totals from import_craw_csv."""
+    stats = {"read": 0, "inserted": 0, "skipped": 0, "rows_per_second": 0}
+    for stats in import_craw_csv(filename, chunk_size):
+        pass
+    return stats
+
+
+def get_stored_activity_keys(keys):
+    """Returns the (start_date, type, distance) keys that already match a stored activity.
+
+    The keys are joined against the activities table through a temp table, so
+    the lookup only ever touches rows that match this chunk.
+    """
+    db = get_db()
+    db.execute('CREATE TEMP TABLE IF NOT EXISTS import_keys (start_date, type, distance)')
+    db.execute('DELETE FROM import_keys')
+    db.executemany('INSERT INTO import_keys VALUES (?, ?, ?)', keys)
+    return {
+        tuple(row) for row in db.execute(
+            'SELECT k.start_date, k.type, k.distance FROM import_keys k'
+            ' JOIN activities a ON a.start_date = k.start_date AND a.type = k.type AND a.distance = k.distance'
+        )
+    }
+
+
+def craw_activity(start_date, activity_type, distance, comment):
+    """Builds a prepared Activity dict from the converted values of a CRAW csv row."""
+    activity = {
+        "id": None,
+        "description": comment,
+        "start_date": start_date,
+        "type": activity_type,
+        "distance": float(distance),
+        "moving_time": 0,
+        "elapsed_time": 0,
+        "total_elevation_gain": 0,
+        "elev_high": 0,
+        "elev_low": 0,
+        "average_speed": 0,
+        "gear_id": 0,
+    }
+    parse_description(activity)
+    return activity
+
+
+def import_strava_export(path, chunk_size=None):
+    """Loads the Walks and Hikes from a Strava account export. Makes no API calls.
+
+    {path} can be the export zip, the unzipped export directory or an
+    activities csv. activities.csv is streamed straight out of the zip
+    without extracting it, and rows are upserted on strava_id {chunk_size}
+    at a time, so re-importing an export is safe.
+
+    :return: Generator yielding running totals after every chunk: rows read,
+        inserted, updated and rows_per_second
+    :rtype: generator
+    """
+    chunk_size = chunk_size or current_app.config['IMPORT_CHUNK_SIZE']
+    stats = {"read": 0, "inserted": 0, "updated": 0, "rows_per_second": 0}
+    started = time.perf_counter()
+
+    with open_strava_export(path) as data:
+        rows = csv.reader(data)
+        header = next(rows, None)
+        if header is None:
+            raise ValueError("Empty activities.csv, there's nothing to import.")
+        columns = strava_export_column_indexes(header)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            stats["read"] += len(chunk)
+            activities = (strava_export_activity(row, columns) for row in chunk)
+            outcomes = insert_activities(
+                (activity for activity in activities if activity["type"] in ["Walk", "Hike"]),
+                flag_abnormal=False
+            )
+            stats["inserted"] += outcomes.count("inserted")
+            stats["updated"] += outcomes.count("updated")
+            stats["rows_per_second"] = stats["read"] / (time.perf_counter() - started)
+            yield dict(stats)
+    rebuild_abnormal_flags()
+
+
+def open_strava_export(path):
+    """Opens activities.csv from an export zip, export directory or csv path as a text stream.
+
+    :raises ValueError: {path} is a zip without an activities.csv
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            name = next((n for n in archive.namelist() if os.path.basename(n) == "activities.csv"), None)
+            if name is None:
+                raise ValueError("No activities.csv in the export.")
+            # the member stays readable after the zip itself is closed
+            return io.TextIOWrapper(archive.open(name), encoding='utf-8-sig', newline='')
+    if os.path.isdir(path):
+        path = os.path.join(path, "activities.csv")
+    return open(path, encoding='utf-8-sig', newline='')
+
+
+def strava_export_column_indexes(header):
+    """Maps each activities table value to its column index in {header}."""
+    positions = {}
+    for index, name in enumerate(header):
+        # later duplicates overwrite earlier ones
+        positions[name] = index
+    columns = {}
+    for key, names in STRAVA_EXPORT_COLUMNS.items():
+        columns[key] = next((positions[name] for name in names if name in positions), None)
+    if columns["id"] is None or columns["start_date"] is None or columns["type"] is None:
+        raise ValueError("Not a Strava activities export, missing activity id, date or type columns.")
+    return columns
+
+
+def strava_export_activity(row, columns):
+    """Builds a prepared Activity dict from an activities.csv row."""
+    def value(key):
+        index = columns[key]
+        return row[index] if index is not None and index < len(row) else ""
+
+    def number(key, convert=float):
+        try:
+            return convert(float(value(key)))
+        except ValueError:
+            return 0
+
+    activity = {
+        "id": int(value("id")),
+        "start_date": convert_export_date(value("start_date")),
+        "type": value("type"),
+        "description": value("description") or None,
+        "distance": number("distance"),
+        "moving_time": number("moving_time", int),
+        "elapsed_time": number("elapsed_time", int),
+        "total_elevation_gain": number("total_elevation_gain"),
+        "elev_high": number("elev_high"),
+        "elev_low": number("elev_low"),
+        "average_speed": number("average_speed"),
+        "gear_id": None,
+    }
+    parse_description(activity)
+    return activity
+
+
+def convert_export_date(date):
+    """Converts an export date (i.e. "Dec 27, 2020, 7:45:05 PM", in UTC) to the Strava API format."""
+    for date_format in STRAVA_EXPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(date, date_format).strftime("%Y-%m-%dT%H:%M:%SZ")
+        except ValueError:
+            pass
+    raise ValueError(f"Unrecognised activity date {date!r}")
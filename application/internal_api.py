@@ -1,9 +1,12 @@
 """Internal API calls."""
 
+from flask import current_app
+from application import parser
+from application.anomalies import forget_anomaly, get_anomaly_values, update_anomalies
 from application.db import get_db
-import re
+from application.fields import field_filter_sql, field_filters_from_args, store_fields
+from itertools import islice
 import datetime
-import csv
 
 
 def get_all_activities():
@@ -12,16 +15,16 @@ def get_all_activities():
     :return: List of activities
     :rtype: list
     """
-    db = get_db()
+    db = get_db(readonly=True)
     activities = db.execute(
-        'SELECT * FROM activities ORDER BY start_date DESC'
+        'SELECT * FROM activities ORDER BY start_ts DESC, id DESC'
     ).fetchall()
     return activities
 
 
 def get_specific_activity(id):
     """Returns the activity with {id} from activities table in database"""
-    db = get_db()
+    db = get_db(readonly=True)
     activity = db.execute(
         'SELECT * FROM activities WHERE strava_id=?', (id,)
     ).fetchone()
@@ -30,11 +33,167 @@ def get_specific_activity(id):
 
 def activity_index():
     """Fetches all activities from the activities table and prepares them for easy reading."""
-    activities = get_all_activities()
-    formated_activities = []
-    for activity in activities:
-        formated_activities.append(format_activity_for_view(activity))
-    return formated_activities
+    return format_activities_for_view(get_all_activities())
+
+
+# SQL each index filter adds, keyed by the query string argument it comes from
+ACTIVITY_FILTERS = {
+    "type": "type = :type",
+    "ground_type": "ground_type = :ground_type",
+    "start": "start_ts >= CAST(strftime('%s', :start) AS INTEGER)",
+    "end": "start_ts < CAST(strftime('%s', :end, '+1 day') AS INTEGER)",
+    "min_weight": "weight >= :min_weight",
+    "max_weight": "weight <= :max_weight",
+    "min_knee_pain": "knee_pain >= :min_knee_pain",
+    # a literal 1 so the partial activities_abnormal index can be used
+    "abnormal": "abnormal = 1",
+}
+
+
+def activity_filters_from_args(args):
+    """Reads the ACTIVITY_FILTERS values out of a request's query string. Unusable values are left out.
+
+    :param args: i.e. request.args
+    :type args: werkzeug.datastructures.MultiDict
+
+    :return: filters for get_activities_page or iter_activities
+    :rtype: dict
+    """
+    return {
+        "type": args.get('type') or None,
+        "ground_type": args.get('ground_type') or None,
+        "start": args.get('start', type=datetime.date.fromisoformat),
+        "end": args.get('end', type=datetime.date.fromisoformat),
+        "min_weight": args.get('min_weight', type=float),
+        "max_weight": args.get('max_weight', type=float),
+        "min_knee_pain": args.get('min_knee_pain', type=int),
+        "abnormal": True if args.get('abnormal') else None,
+        "fields": field_filters_from_args(args),
+    }
+
+
+def activity_filter_sql(filters):
+    """Returns the WHERE conditions and params for the ACTIVITY_FILTERS in {filters}. None values are ignored.
+
+    {filters}["fields"] can hold description field filters, see fields.field_filters_from_args.
+    """
+    filters = dict(filters or {})
+    where, params = field_filter_sql(filters.pop("fields", None))
+    activity_params = {key: value for key, value in filters.items() if value is not None}
+    where[:0] = [ACTIVITY_FILTERS[key] for key in activity_params]
+    params.update(activity_params)
+    return where, params
+
+
+def iter_activities(fields=None, filters=None, batch_size=None):
+    """Yields activities oldest first without loading them all, i.e. to stream an export.
+
+    Rows are pulled off the cursor {batch_size} at a time, so memory use
+    doesn't grow with the history.
+
+    :param fields: Columns to select. None for all of them.
+    :type fields: list
+
+    :param filters: Values for any of the ACTIVITY_FILTERS keys
+    :type filters: dict
+
+    :param batch_size: Rows fetched at a time. Defaults to the EXPORT_BATCH_SIZE config.
+    :type batch_size: int
+
+    :return: Generator of sqlite3.Row
+    :rtype: generator
+    """
+    batch_size = batch_size or current_app.config['EXPORT_BATCH_SIZE']
+    where, params = activity_filter_sql(filters)
+    columns = ", ".join(f'"{field}"' for field in fields) if fields else "*"
+    db = get_db(readonly=True)
+    cursor = db.execute(
+        f"SELECT {columns} FROM activities {'WHERE ' + ' AND '.join(where) if where else ''}"
+        " ORDER BY start_ts, id",
+        params
+    )
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+
+def get_activities_page(filters=None, cursor=None, page_size=None):
+    """Returns one page of activities, newest first, and the cursor of the next page.
+
+    Pages are keyed on (start_ts, id) rather than an offset, so every page
+    is a range search of the activities_start_ts index reading page_size
+    rows no matter how far back it is, and activities synced in the meantime
+    don't shift the pages. Activities without a start_ts come last and are
+    paged on id alone, a page that reaches them continues into them.
+
+    :param filters: Values for any of the ACTIVITY_FILTERS keys. None values are ignored.
+    :type filters: dict
+
+    :param cursor: next_cursor returned with the previous page. None for the first page.
+    :type cursor: str
+
+    :param page_size: Activities per page. Defaults to the INDEX_PAGE_SIZE config.
+    :type page_size: int
+
+    :return: (activities, next_cursor), next_cursor is None on the last page
+    :rtype: tuple
+    """
+    page_size = page_size or current_app.config['INDEX_PAGE_SIZE']
+    where, params = activity_filter_sql(filters)
+    if cursor is None:
+        # NULL start_ts sort after every other one, so the first page reaches them too
+        activities = query_activities_page(where, params, page_size + 1)
+    else:
+        start_ts, id = parse_activity_cursor(cursor)
+        params.update(cursor_ts=start_ts, cursor_id=id)
+        if start_ts is None:
+            activities = query_activities_page(where + ["start_ts IS NULL AND id < :cursor_id"], params, page_size + 1)
+        else:
+            # the row value comparison alone, an OR would turn the range search into a scan
+            activities = query_activities_page(where + ["(start_ts, id) < (:cursor_ts, :cursor_id)"], params, page_size + 1)
+            if len(activities) <= page_size:
+                activities += query_activities_page(
+                    where + ["start_ts IS NULL"], params, page_size + 1 - len(activities)
+                )
+
+    if len(activities) <= page_size:
+        return activities, None
+    activities = activities[:page_size]
+    return activities, format_activity_cursor(activities[-1])
+
+
+def query_activities_page(where, params, limit):
+    """Returns up to {limit} activities matching the {where} conditions, newest first."""
+    db = get_db(readonly=True)
+    return db.execute(
+        f"SELECT * FROM activities {'WHERE ' + ' AND '.join(where) if where else ''}"
+        " ORDER BY start_ts DESC, id DESC LIMIT :limit",
+        dict(params, limit=limit)
+    ).fetchall()
+
+
+def format_activity_cursor(activity):
+    """Returns the cursor pointing after {activity}, i.e. "1609098305:12"."""
+    start_ts = activity["start_ts"]
+    return f"{'' if start_ts is None else start_ts}:{activity['id']}"
+
+
+def parse_activity_cursor(cursor):
+    """Splits a cursor from format_activity_cursor into (start_ts, id). Raises ValueError if it isn't one."""
+    start_ts, id = cursor.split(":")
+    return (int(start_ts) if start_ts else None), int(id)
+
+
+def activity_index_page(filters=None, cursor=None, page_size=None):
+    """Same as activity_index for one page from get_activities_page.
+
+    :return: (formatted activities, next_cursor)
+    :rtype: tuple
+    """
+    activities, next_cursor = get_activities_page(filters, cursor, page_size)
+    return format_activities_for_view(activities), next_cursor
 
 
 def format_activity_for_view(activity):
@@ -52,6 +211,91 @@ def format_activity_for_view(activity):
     return formated_activity
 
 
+# "MM:SS" for every second of an hour, so H:M:S strings are one lookup per value
+MINUTES_SECONDS = [f"{minutes:02d}:{seconds:02d}" for minutes in range(60) for seconds in range(60)]
+# "Dec 27" for every "12-27" of a leap year
+MONTH_DAYS = {
+    day.strftime("%m-%d"): day.strftime("%b %d")
+    for day in (datetime.date(2000, 1, 1) + datetime.timedelta(days=n) for n in range(366))
+}
+
+
+def format_activities_for_view(activities):
+    """Does what format_activity_for_view does for a whole block of activities at once.
+
+    Each column is converted in one pass with precomputed lookup tables
+    instead of calling the convert_* helpers row by row, and gives exactly
+    the same strings.
+
+    :param activities: Rows from the activities table
+    :type activities: list
+
+    :return: List of formatted activity dicts
+    :rtype: list
+    """
+    formated_activities = [dict(activity) for activity in activities]
+    if not formated_activities:
+        return formated_activities
+    columns = {
+        "moving_time": format_durations,
+        "elapsed_time": format_durations,
+        "start_date": format_dates,
+        "average_speed": format_average_speeds,
+        "distance": format_miles,
+        "total_elevation_gain": format_feet,
+        "elev_low": format_feet,
+        "elev_high": format_feet,
+    }
+    keys = list(columns)
+    values = [format_column([activity[key] for activity in formated_activities]) for key, format_column in columns.items()]
+    for activity, row in zip(formated_activities, zip(*values)):
+        activity.update(zip(keys, row))
+    return formated_activities
+
+
+def format_durations(column):
+    """convert_seconds_h_m_s for a column of seconds."""
+    lookup = MINUTES_SECONDS
+    return [
+        f"{time // 3600}:{lookup[time % 3600]}" if type(time) is int and 0 <= time < 86400
+        else convert_seconds_h_m_s(time)
+        for time in column
+    ]
+
+
+def format_dates(column):
+    """convert_date for a column of start dates.
+
+    Dates in the usual 2020-12-27T19:45:05Z shape are sliced and looked up in
+    MONTH_DAYS, anything else (and Feb 29th, to check the year) goes through
+    convert_date.
+    """
+    lookup = MONTH_DAYS
+    formated = []
+    for date in column:
+        month_day = lookup.get(date[5:10]) if len(date) == 20 and date[10] == "T" and date[:4].isdigit() else None
+        if month_day is None or date[5:10] == "02-29":
+            formated.append(convert_date(date))
+        else:
+            formated.append(f"{month_day} {date[:4]}")
+    return formated
+
+
+def format_average_speeds(column):
+    """convert_average_speed for a column of speeds in meters per second."""
+    return format_durations([round(1609.34/speed) if speed and speed > 0 else 0 for speed in column])
+
+
+def format_miles(column):
+    """convert_meters_miles for a column of distances."""
+    return [round(distance/1609.34, 2) if distance else 0 for distance in column]
+
+
+def format_feet(column):
+    """convert_meters_feet for a column of distances."""
+    return [round(distance*3.281, 2) if distance else 0 for distance in column]
+
+
 def convert_average_speed(speed):
     """Converts average speed from meters per second to hours:minutes:seconds per mile."""
     # def convert_speed(speed):
@@ -89,99 +333,116 @@ def convert_date(date):
     return date.strftime("%b %d %Y")
 
 
+# start_ts is worked out from start_date (parameter 9) by SQLite
+INSERT_ACTIVITY_SQL = (
+    'INSERT INTO activities (strava_id, distance, moving_time, elapsed_time, total_elevation_gain, elev_high, elev_low, type, start_date, average_speed, gear_id, weight, knee_pain, ground_type, comments, description, start_ts)'
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CAST(strftime('%s', ?9) AS INTEGER))"
+    ' ON CONFLICT (strava_id) DO UPDATE SET'
+    ' distance=excluded.distance, moving_time=excluded.moving_time, elapsed_time=excluded.elapsed_time,'
+    ' total_elevation_gain=excluded.total_elevation_gain, elev_high=excluded.elev_high, elev_low=excluded.elev_low,'
+    ' type=excluded.type, start_date=excluded.start_date, start_ts=excluded.start_ts, average_speed=excluded.average_speed, gear_id=excluded.gear_id,'
+    ' weight=excluded.weight, knee_pain=excluded.knee_pain, ground_type=excluded.ground_type, comments=excluded.comments, description=excluded.description'
+)
+
+# Raw DetailedActivity responses, see application.archive
+ARCHIVE_ACTIVITY_SQL = 'INSERT OR REPLACE INTO activity_archive (strava_id, fetched_at, body) VALUES (?, CURRENT_TIMESTAMP, ?)'
+
+
 def insert_activity(activity):
-    """Inserts a prepared Activity dict into the activities table."""
-    db = get_db()
-    db.execute(
-        'INSERT INTO activities (strava_id, distance, moving_time, elapsed_time, total_elevation_gain, elev_high, elev_low, type, start_date, average_speed, gear_id, weight, knee_pain, ground_type, comments)'
-        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-        (activity['id'], activity["distance"], activity["moving_time"], activity["elapsed_time"], activity["total_elevation_gain"], activity["elev_high"], activity["elev_low"], activity["type"], activity["start_date"], activity["average_speed"], activity["gear_id"], activity["weight"], activity["knee_pain"], activity["ground_type"], activity["comments"])
-    )
-    db.commit()
-
-
-def upload_craw_csv(filename):
-    with open(filename, 'r', encoding='utf-8-sig') as data:
-        for line in csv.DictReader(data): 
-            if line["Activity Type"] in ["Walk", "Hike"]:
-                # convert row to format to insert into df
-                line['description'] = line.pop('Comment')
-                parse_description(line)
-
-                # convert miles to meters
-                line["distance"] = convert_miles_to_meters(line.pop('Distance in Miles'))
-                # convert time format
-                line["start_date"] = reformat_activity_date(line.pop("Activity Date"))
-
-                line['id'] = None
-                line["moving_time"] = 0
-                line["elapsed_time"] = 0
-                line["total_elevation_gain"] = 0
-                line["elev_high"] = 0
-                line["elev_low"] = 0
-                line["type"] = line.pop("Activity Type")
-                line["average_speed"] = 0
-                line["gear_id"] = 0
-
-                insert_activity(line)
-
-
-def convert_miles_to_meters(miles):
-    """Convert float miles to meters."""
-    if miles:
-        return round(float(miles) * 1609.34, 2)
-    else:
-        return 0
+    """Inserts a prepared Activity dict into the activities table.
+
+    If an activity with the same strava_id is already stored it is updated
+    instead, so downloading an activity twice never duplicates it.
+    """
+    insert_activities([activity])
+
+
+def insert_activities(activities, batch_size=None, flag_abnormal=True, archived=()):
+    """Inserts prepared Activity dicts into the activities table in a single transaction.
+
+    Rows are written with executemany, {batch_size} at a time, and upserted on
+    strava_id the same way insert_activity does.
+
+    :param activities: Prepared Activity dicts, any iterable (i.e. a generator)
+    :type activities: iterable
+
+    :param batch_size: Rows per executemany. Defaults to the INSERT_BATCH_SIZE config.
+    :type batch_size: int
+
+    :param flag_abnormal: Flag abnormal hikes in the same transaction. Importers
+        turn it off and rebuild the flags once at the end instead.
+    :type flag_abnormal: bool
 
+    :param archived: (strava_id, gzipped body) rows from archive.archive_row,
+        stored in activity_archive in the same transaction
+    :type archived: iterable
 
-def reformat_activity_date(date):
-    """Reformat craw csv date format to match the date format used by Strava."""
-    date = datetime.datetime.strptime(date, '%m/%d/%y')
-    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+    :return: "inserted" or "updated" for each activity, in order
+    :rtype: list
+    """
+    batch_size = batch_size or current_app.config['INSERT_BATCH_SIZE']
+    activities = iter(activities)
+    outcomes = []
+    written = []
+    # start and metrics of the stored activities from before they're updated, so unchanged ones aren't re-flagged
+    previous = {}
+    db = get_db()
+    with db:
+        db.executemany(ARCHIVE_ACTIVITY_SQL, archived)
+        while True:
+            batch = list(islice(activities, batch_size))
+            if not batch:
+                break
+            ids = [activity['id'] for activity in batch if activity['id'] is not None]
+            stored_ids = {}
+            if ids:
+                stored_ids = dict(db.execute(
+                    f'SELECT strava_id, id FROM activities WHERE strava_id IN ({",".join("?" * len(ids))})', ids
+                ).fetchall())
+            stored = set(stored_ids)
+            if flag_abnormal:
+                for activity_id, values in get_anomaly_values(db, list(stored_ids.values())).items():
+                    previous.setdefault(activity_id, values)
+            last_id = db.execute('SELECT MAX(id) FROM activities').fetchone()[0] or 0
+            db.executemany(INSERT_ACTIVITY_SQL, (prepare_activity_row(activity) for activity in batch))
+            # updated rows keep their id, new ones are numbered after the last one
+            batch_ids = list(stored_ids.values()) + [
+                row[0] for row in db.execute('SELECT id FROM activities WHERE id > ?', (last_id,))
+            ]
+            store_fields(db, batch_ids)
+            written += batch_ids
+            for activity in batch:
+                if activity['id'] is not None and activity['id'] in stored:
+                    outcomes.append("updated")
+                else:
+                    outcomes.append("inserted")
+                    stored.add(activity['id'])
+        if flag_abnormal:
+            update_anomalies(db, written, previous)
+    return outcomes
+
+
+def prepare_activity_row(activity):
+    """Returns the values of an Activity dict in INSERT_ACTIVITY_SQL's column order."""
+    return (activity['id'], activity["distance"], activity["moving_time"], activity["elapsed_time"], activity["total_elevation_gain"], activity["elev_high"], activity["elev_low"], activity["type"], activity["start_date"], activity["average_speed"], activity["gear_id"], activity["weight"], activity["knee_pain"], activity["ground_type"], activity["comments"], activity.get("description"))
+
+
+def delete_activity(strava_id):
+    """Deletes the activity with {strava_id} from the activities table, if it's there."""
+    db = get_db()
+    with db:
+        row = db.execute('SELECT id FROM activities WHERE strava_id = ?', (strava_id,)).fetchone()
+        if row is None:
+            return
+        values = get_anomaly_values(db, [row["id"]])[row["id"]]
+        db.execute('DELETE FROM activities WHERE id = ?', (row["id"],))
+        forget_anomaly(db, row["id"], values)
 
 
 def parse_description(activity):
     """Takes an detailed activity object and parses the description key to pull out the various bits of information I need."""
     # parse ground type, lbs, knee pain, other comments
-    if not activity["description"]:
-        activity["weight"] = 0
-        activity["knee_pain"] = 0
-        activity['ground_type'] = "trail"
-        activity['comments'] = None
-    else:
-        comments = activity["description"]
-
-        weight_format = re.compile(r"\d+[\.]?\d*\s?(lbs|pounds|lb)\s?(pack|bag)?")
-        weight = weight_format.search(activity["description"])
-        if weight:
-            weight = weight.group()
-            activity["weight"] = float(re.sub(r"^0|[^0-9\.]", "", weight))
-            comments = re.sub(weight, "", comments)
-        else:
-            activity["weight"] = 0
-        
-        knee_pain_format = re.compile(r"(knee pain|Knee Pain|Knee pain):\s?\d+")
-        knee_pain = knee_pain_format.search(comments)
-        if knee_pain:
-            knee_pain = knee_pain.group()
-            activity["knee_pain"] = int(re.sub("[^0-9]", "", knee_pain))
-            comments = re.sub(knee_pain, "", comments)
-        else:
-            activity["knee_pain"] = 0
-
-        ground_format = re.compile(r"(snow|Snow|Rocky|rocky|pavement|Pavement|off-trail|Off-trail|Off trail|off trail)")
-        ground = ground_format.search(comments)
-        if ground:
-            activity['ground_type'] = ground.group().lower()
-        else:
-            activity['ground_type'] = "trail"
-
-        comment_format = re.compile(r"\w.*")
-        comments = comment_format.search(comments)
-        if comments:
-            activity['comments'] = comments.group()
-        else:
-            activity['comments'] = None
+    activity.update(parser.parse(activity["description"]))
 
 
 def handle_manual_activity_errors(activity):
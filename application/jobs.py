@@ -0,0 +1,152 @@
+"""Background jobs, so web requests never wait on Strava.
+
+Jobs live in the jobs table. The web app only ever queues them and reads
+their status; `flask run-worker` claims and runs them in a separate process
+and queues a sync on a schedule.
+"""
+
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from application.db import get_db
+
+
+def get_job_handlers():
+    """Returns the function that runs each kind of job. Handlers are passed the job's key."""
+    from application.strava_api import download_new_activities, ingest_activity
+    from application.internal_api import delete_activity
+    return {
+        "sync": lambda key: download_new_activities(),
+        "activity": lambda key: ingest_activity(int(key)),
+        "delete-activity": lambda key: delete_activity(int(key)),
+    }
+
+
+def enqueue_job(kind, key=''):
+    """Queues a {kind} job for {key} unless one is already queued or running.
+
+    :return: id of the new job, or of the queued/running job it joined
+    :rtype: int
+    """
+    key = str(key)
+    db = get_db()
+    with db:
+        cursor = db.execute(
+            "INSERT INTO jobs (kind, key) VALUES (?, ?) ON CONFLICT DO NOTHING", (kind, key)
+        )
+        if cursor.rowcount:
+            return cursor.lastrowid
+        return db.execute(
+            "SELECT id FROM jobs WHERE kind = ? AND key = ? AND status IN ('queued', 'running')", (kind, key)
+        ).fetchone()["id"]
+
+
+def get_job(id):
+    """Returns the job with {id} from the jobs table."""
+    db = get_db(readonly=True)
+    return db.execute("SELECT * FROM jobs WHERE id = ?", (id,)).fetchone()
+
+
+def get_latest_job(kind):
+    """Returns the most recently queued {kind} job, or None."""
+    db = get_db(readonly=True)
+    return db.execute(
+        "SELECT * FROM jobs WHERE kind = ? ORDER BY id DESC LIMIT 1", (kind,)
+    ).fetchone()
+
+
+def claim_next_job():
+    """Marks the oldest queued job as running and returns it, or None if there's nothing to do."""
+    db = get_db()
+    # IMMEDIATE takes the write lock up front so two workers can't claim the same job
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        job = db.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+        ).fetchone()
+        if job:
+            db.execute(
+                "UPDATE jobs SET status = 'running', started_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (job["id"],)
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return job
+
+
+def finish_job(id, error=None):
+    """Records that job {id} is done, or failed with {error}."""
+    db = get_db()
+    with db:
+        db.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+            ("failed" if error else "done", error, id)
+        )
+
+
+def run_next_job():
+    """Claims the next queued job and runs it.
+
+    :return: The job that was run, or None if the queue was empty.
+    """
+    job = claim_next_job()
+    if job is None:
+        return None
+    try:
+        get_job_handlers()[job["kind"]](job["key"])
+    except Exception as e:
+        finish_job(job["id"], error=repr(e))
+    else:
+        finish_job(job["id"])
+    return job
+
+
+def requeue_stale_jobs():
+    """Puts jobs left running by a worker that died back in the queue."""
+    db = get_db()
+    with db:
+        db.execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'")
+
+
+def enqueue_due_sync(interval):
+    """Queues a sync if none has been queued in the last {interval} seconds."""
+    db = get_db()
+    recent = db.execute(
+        "SELECT 1 FROM jobs WHERE kind = 'sync' AND created_at > datetime('now', ?)",
+        (f"-{int(interval)} seconds",)
+    ).fetchone()
+    if not recent:
+        enqueue_job("sync")
+
+
+def work(poll_interval, sync_interval, once=False):
+    """Runs queued jobs forever, queuing a sync every {sync_interval} seconds."""
+    requeue_stale_jobs()
+    while True:
+        enqueue_due_sync(sync_interval)
+        while run_next_job():
+            pass
+        if once:
+            break
+        time.sleep(poll_interval)
+
+
+@click.command('run-worker')
+@click.option('--once', is_flag=True, help='Run the queued jobs and exit.')
+@with_appcontext
+def run_worker_command(once):
+    """Run background jobs and scheduled syncs."""
+    click.echo('Worker started.')
+    work(
+        current_app.config['WORKER_POLL_INTERVAL'],
+        current_app.config['SYNC_INTERVAL'],
+        once=once
+    )
+
+
+def init_app(app):
+    app.cli.add_command(run_worker_command)
@@ -1,6 +1,6 @@
-DROP TABLE IF EXISTS activities;
+/* The original schema. IF NOT EXISTS so databases created by the old init-db adopt it as is. */
 
-CREATE TABLE activities (
+CREATE TABLE IF NOT EXISTS activities (
     id INTEGER PRIMARY KEY,
     strava_id INTEGER,
     /* Given in meters */
@@ -22,10 +22,7 @@ CREATE TABLE activities (
     comments STRING
 );
 
-
-DROP TABLE IF EXISTS gear;
-
-CREATE TABLE gear (
+CREATE TABLE IF NOT EXISTS gear (
     strava_id STRING PRIMARY KEY NOT NULL,
     name STRING NOT NULL
-)
\ No newline at end of file
+);
@@ -0,0 +1,10 @@
+/* Older syncs could store an activity twice, keep the newest copy */
+DELETE FROM activities
+WHERE strava_id IS NOT NULL
+  AND id NOT IN (SELECT MAX(id) FROM activities WHERE strava_id IS NOT NULL GROUP BY strava_id);
+
+/* Manual uploads have no strava_id, NULLs don't collide */
+CREATE UNIQUE INDEX IF NOT EXISTS activities_strava_id ON activities (strava_id);
+
+/* How csv imports recognise activities they've already stored */
+CREATE INDEX IF NOT EXISTS activities_natural_key ON activities (start_date, type, distance);
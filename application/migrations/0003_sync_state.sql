@@ -0,0 +1,15 @@
+/* Where an interrupted download_new_activities picks back up. Only ever one row. */
+CREATE TABLE sync_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    /* The after date the interrupted sync was paging with */
+    after_date DATETIME NOT NULL,
+    /* Next page of summaries to request */
+    page INTEGER NOT NULL,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+/* Activities that have been listed but not inserted yet */
+CREATE TABLE sync_in_flight (
+    strava_id INTEGER PRIMARY KEY,
+    start_date DATETIME NOT NULL
+);
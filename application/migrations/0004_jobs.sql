@@ -0,0 +1,16 @@
+/* Work for the background worker, i.e. syncing activities from Strava */
+CREATE TABLE jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    /* What the job works on, i.e. a strava_id. Empty for jobs like sync. */
+    key TEXT NOT NULL DEFAULT '',
+    /* queued, running, done or failed */
+    status TEXT NOT NULL DEFAULT 'queued',
+    error TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    started_at DATETIME,
+    finished_at DATETIME
+);
+
+/* At most one queued or running job per kind and key, extra requests join it */
+CREATE UNIQUE INDEX jobs_active_kind ON jobs (kind, key) WHERE status IN ('queued', 'running');
@@ -0,0 +1,7 @@
+/* Raw DetailedActivity responses, gzipped JSON, so descriptions can be re-parsed without Strava */
+CREATE TABLE activity_archive (
+    strava_id INTEGER NOT NULL,
+    fetched_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    body BLOB NOT NULL,
+    PRIMARY KEY (strava_id, fetched_at)
+);
@@ -0,0 +1,29 @@
+"""Adds start_ts, start_date as seconds since the epoch, and the indexes that sort on it.
+
+Each step checks whether it already ran, since the batched backfill can't
+share one transaction with the rest of the migration.
+"""
+
+from application.db import backfill
+
+
+def upgrade(db):
+    columns = [row["name"] for row in db.execute("PRAGMA table_info(activities)")]
+    if "start_ts" not in columns:
+        with db:
+            db.execute("ALTER TABLE activities ADD COLUMN start_ts INTEGER")
+
+    backfill(
+        db, "activities",
+        "start_ts = CAST(strftime('%s', start_date) AS INTEGER)",
+        "start_ts IS NULL AND start_date IS NOT NULL"
+    )
+
+    with db:
+        # newest first ordering of the index page
+        db.execute("CREATE INDEX IF NOT EXISTS activities_start_ts ON activities (start_ts DESC, id DESC)")
+        # most recent Strava activity, where syncs pick up from
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS activities_strava_start_ts ON activities (start_ts)"
+            " WHERE strava_id IS NOT NULL"
+        )
@@ -0,0 +1,106 @@
+/* Per day, week and month totals kept up to date by the triggers below, so
+   summaries read a handful of rows instead of every activity. */
+CREATE TABLE rollups (
+    /* day, week or month */
+    period TEXT NOT NULL,
+    /* The day, the Sunday a week ends on (like pandas' W grouping) or the first of the month */
+    bucket TEXT NOT NULL,
+    activities INTEGER NOT NULL DEFAULT 0,
+    /* Sum of each activity's distance in miles, rounded like convert_meters_miles */
+    distance FLOAT NOT NULL DEFAULT 0,
+    /* Given in meters */
+    total_elevation_gain FLOAT NOT NULL DEFAULT 0,
+    /* Sum of weight * miles, divide by distance for the average weight per mile */
+    weight_distance FLOAT NOT NULL DEFAULT 0,
+    knee_pain_sum INTEGER NOT NULL DEFAULT 0,
+    knee_pain_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, bucket)
+) WITHOUT ROWID;
+
+/* One row per period an activity starting at start_date falls into */
+CREATE VIEW rollup_periods AS
+    SELECT 'day' AS period, '%Y-%m-%d' AS bucket_format, '+0 days' AS modifier
+    UNION ALL SELECT 'week', '%Y-%m-%d', 'weekday 0'
+    UNION ALL SELECT 'month', '%Y-%m-01', '+0 days';
+
+/* Activities without a start date SQLite can read have no bucket and are left out */
+CREATE TRIGGER activities_rollup_insert AFTER INSERT ON activities
+WHEN strftime('%s', NEW.start_date) IS NOT NULL
+BEGIN
+    INSERT INTO rollups (period, bucket, activities, distance, total_elevation_gain, weight_distance, knee_pain_sum, knee_pain_count)
+    SELECT period, strftime(bucket_format, NEW.start_date, modifier), 1,
+        ROUND(COALESCE(NEW.distance, 0) / 1609.34, 2),
+        COALESCE(NEW.total_elevation_gain, 0),
+        COALESCE(NEW.weight, 0) * ROUND(COALESCE(NEW.distance, 0) / 1609.34, 2),
+        COALESCE(NEW.knee_pain, 0),
+        NEW.knee_pain IS NOT NULL
+    FROM rollup_periods WHERE true
+    ON CONFLICT (period, bucket) DO UPDATE SET
+        activities = activities + excluded.activities,
+        distance = distance + excluded.distance,
+        total_elevation_gain = total_elevation_gain + excluded.total_elevation_gain,
+        weight_distance = weight_distance + excluded.weight_distance,
+        knee_pain_sum = knee_pain_sum + excluded.knee_pain_sum,
+        knee_pain_count = knee_pain_count + excluded.knee_pain_count;
+END;
+
+CREATE TRIGGER activities_rollup_delete AFTER DELETE ON activities
+WHEN strftime('%s', OLD.start_date) IS NOT NULL
+BEGIN
+    UPDATE rollups SET
+        activities = activities - 1,
+        distance = distance - ROUND(COALESCE(OLD.distance, 0) / 1609.34, 2),
+        total_elevation_gain = total_elevation_gain - COALESCE(OLD.total_elevation_gain, 0),
+        weight_distance = weight_distance - COALESCE(OLD.weight, 0) * ROUND(COALESCE(OLD.distance, 0) / 1609.34, 2),
+        knee_pain_sum = knee_pain_sum - COALESCE(OLD.knee_pain, 0),
+        knee_pain_count = knee_pain_count - (OLD.knee_pain IS NOT NULL)
+    WHERE (period, bucket) IN (
+        SELECT period, strftime(bucket_format, OLD.start_date, modifier) FROM rollup_periods
+    );
+    /* empty buckets go away rather than keep float leftovers */
+    DELETE FROM rollups WHERE activities = 0;
+END;
+
+CREATE TRIGGER activities_rollup_update
+AFTER UPDATE OF start_date, distance, total_elevation_gain, weight, knee_pain ON activities
+BEGIN
+    UPDATE rollups SET
+        activities = activities - 1,
+        distance = distance - ROUND(COALESCE(OLD.distance, 0) / 1609.34, 2),
+        total_elevation_gain = total_elevation_gain - COALESCE(OLD.total_elevation_gain, 0),
+        weight_distance = weight_distance - COALESCE(OLD.weight, 0) * ROUND(COALESCE(OLD.distance, 0) / 1609.34, 2),
+        knee_pain_sum = knee_pain_sum - COALESCE(OLD.knee_pain, 0),
+        knee_pain_count = knee_pain_count - (OLD.knee_pain IS NOT NULL)
+    WHERE strftime('%s', OLD.start_date) IS NOT NULL AND (period, bucket) IN (
+        SELECT period, strftime(bucket_format, OLD.start_date, modifier) FROM rollup_periods
+    );
+    DELETE FROM rollups WHERE activities = 0;
+
+    INSERT INTO rollups (period, bucket, activities, distance, total_elevation_gain, weight_distance, knee_pain_sum, knee_pain_count)
+    SELECT period, strftime(bucket_format, NEW.start_date, modifier), 1,
+        ROUND(COALESCE(NEW.distance, 0) / 1609.34, 2),
+        COALESCE(NEW.total_elevation_gain, 0),
+        COALESCE(NEW.weight, 0) * ROUND(COALESCE(NEW.distance, 0) / 1609.34, 2),
+        COALESCE(NEW.knee_pain, 0),
+        NEW.knee_pain IS NOT NULL
+    FROM rollup_periods WHERE strftime('%s', NEW.start_date) IS NOT NULL
+    ON CONFLICT (period, bucket) DO UPDATE SET
+        activities = activities + excluded.activities,
+        distance = distance + excluded.distance,
+        total_elevation_gain = total_elevation_gain + excluded.total_elevation_gain,
+        weight_distance = weight_distance + excluded.weight_distance,
+        knee_pain_sum = knee_pain_sum + excluded.knee_pain_sum,
+        knee_pain_count = knee_pain_count + excluded.knee_pain_count;
+END;
+
+/* Totals for activities stored before the triggers existed */
+INSERT INTO rollups (period, bucket, activities, distance, total_elevation_gain, weight_distance, knee_pain_sum, knee_pain_count)
+SELECT period, strftime(bucket_format, start_date, modifier), COUNT(*),
+    SUM(ROUND(COALESCE(distance, 0) / 1609.34, 2)),
+    SUM(COALESCE(total_elevation_gain, 0)),
+    SUM(COALESCE(weight, 0) * ROUND(COALESCE(distance, 0) / 1609.34, 2)),
+    SUM(COALESCE(knee_pain, 0)),
+    COUNT(knee_pain)
+FROM activities, rollup_periods
+WHERE strftime('%s', start_date) IS NOT NULL
+GROUP BY 1, 2;
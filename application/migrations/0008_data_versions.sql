@@ -0,0 +1,41 @@
+/* A change counter per table the pages read, bumped by the triggers below on
+   every write. Pages compare versions instead of re-reading the tables. */
+CREATE TABLE data_versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0,
+    /* Random per database, so versions from before an init-db never match again */
+    generation TEXT NOT NULL DEFAULT (lower(hex(randomblob(4)))),
+    changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO data_versions (name) VALUES ('activities'), ('jobs');
+
+CREATE TRIGGER activities_version_insert AFTER INSERT ON activities
+BEGIN
+    UPDATE data_versions SET version = version + 1, changed_at = CURRENT_TIMESTAMP WHERE name = 'activities';
+END;
+
+CREATE TRIGGER activities_version_update AFTER UPDATE ON activities
+BEGIN
+    UPDATE data_versions SET version = version + 1, changed_at = CURRENT_TIMESTAMP WHERE name = 'activities';
+END;
+
+CREATE TRIGGER activities_version_delete AFTER DELETE ON activities
+BEGIN
+    UPDATE data_versions SET version = version + 1, changed_at = CURRENT_TIMESTAMP WHERE name = 'activities';
+END;
+
+CREATE TRIGGER jobs_version_insert AFTER INSERT ON jobs
+BEGIN
+    UPDATE data_versions SET version = version + 1, changed_at = CURRENT_TIMESTAMP WHERE name = 'jobs';
+END;
+
+CREATE TRIGGER jobs_version_update AFTER UPDATE ON jobs
+BEGIN
+    UPDATE data_versions SET version = version + 1, changed_at = CURRENT_TIMESTAMP WHERE name = 'jobs';
+END;
+
+CREATE TRIGGER jobs_version_delete AFTER DELETE ON jobs
+BEGIN
+    UPDATE data_versions SET version = version + 1, changed_at = CURRENT_TIMESTAMP WHERE name = 'jobs';
+END;
@@ -0,0 +1,35 @@
+"""Adds description, the activity description as written, so the parsed columns can be rebuilt.
+
+Activities that were archived get their description back from the latest
+archived response. The rest keep a NULL description and are left alone by
+flask reparse. Safe to run again, only NULL descriptions are filled in.
+"""
+
+import gzip
+import json
+
+
+def upgrade(db, batch_size=1000):
+    columns = [row["name"] for row in db.execute("PRAGMA table_info(activities)")]
+    if "description" not in columns:
+        with db:
+            db.execute("ALTER TABLE activities ADD COLUMN description TEXT")
+
+    # SQLite takes the bare body column from the row that has the MAX(fetched_at)
+    rows = db.execute(
+        'SELECT body, MAX(fetched_at) FROM activity_archive GROUP BY strava_id'
+    )
+    while True:
+        batch = rows.fetchmany(batch_size)
+        if not batch:
+            break
+        updates = []
+        for row in batch:
+            activity = json.loads(gzip.decompress(row["body"]))
+            if activity.get("description"):
+                updates.append((activity["description"], activity["id"]))
+        with db:
+            db.executemany(
+                'UPDATE activities SET description = ? WHERE strava_id = ? AND description IS NULL',
+                updates
+            )
@@ -0,0 +1,28 @@
+"""Adds activity_fields, the values of the DESCRIPTION_FIELDS config found in each activity's description.
+
+The fields depend on the config and the parser as they are when the
+migration runs, so migrate_db fills the table in with fields.rebuild_fields
+once every migration has been applied. The table, index and trigger are
+only created if they're missing, so it's safe to run again.
+"""
+
+# derived tables migrate_db rebuilds after the last migration
+REBUILDS = ("fields",)
+
+
+def upgrade(db):
+    with db:
+        # one row per field found
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS activity_fields ("
+            " activity_id INTEGER NOT NULL, name TEXT NOT NULL,"
+            # no declared type, so ints and floats stay numbers and compare as numbers
+            " value,"
+            " PRIMARY KEY (activity_id, name)) WITHOUT ROWID"
+        )
+        # filtering and aggregating on one field
+        db.execute("CREATE INDEX IF NOT EXISTS activity_fields_name_value ON activity_fields (name, value)")
+        db.execute(
+            "CREATE TRIGGER IF NOT EXISTS activities_fields_delete AFTER DELETE ON activities"
+            " BEGIN DELETE FROM activity_fields WHERE activity_id = OLD.id; END"
+        )
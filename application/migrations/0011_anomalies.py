@@ -0,0 +1,26 @@
+"""Adds the abnormal hike flags and the per metric statistics they're worked out from.
+
+Each step checks whether it already ran, like 0006. The stored hikes are
+flagged by anomalies.rebuild_anomalies, which migrate_db runs once every
+migration has been applied.
+"""
+
+# derived tables migrate_db rebuilds after the last migration
+REBUILDS = ("anomalies",)
+
+
+def upgrade(db):
+    columns = [row["name"] for row in db.execute("PRAGMA table_info(activities)")]
+    with db:
+        if "abnormal" not in columns:
+            db.execute("ALTER TABLE activities ADD COLUMN abnormal INTEGER NOT NULL DEFAULT 0")
+        if "abnormal_reason" not in columns:
+            db.execute("ALTER TABLE activities ADD COLUMN abnormal_reason TEXT")
+        # exponentially weighted mean and variance of each metric over the hikes up to last_start_ts, last_id
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS anomaly_state ("
+            " metric TEXT PRIMARY KEY, count INTEGER NOT NULL, mean REAL NOT NULL, variance REAL NOT NULL,"
+            " last_start_ts INTEGER, last_id INTEGER)"
+        )
+        # abnormal hikes only, on the index
+        db.execute("CREATE INDEX IF NOT EXISTS activities_abnormal ON activities (start_ts DESC, id DESC) WHERE abnormal = 1")
@@ -0,0 +1,167 @@
+"""Pulls weight, knee pain, ground type and comments out of activity descriptions.
+
+Descriptions are free text like "25 lbs pack; knee pain: 3; rocky, walked
+with Jack". The patterns are compiled once and searched in the order the old
+parser used: the weight in the whole description, then knee pain and ground
+type in what's left once the text matched before them is removed, so a
+number followed by "lbs" is always a weight. That's three searches rather
+than one pass over the description, a single scan can't give a weight
+precedence over knee pain text that starts before it. Unlike the old
+parser the matched text is removed as plain text rather than used as a
+pattern.
+
+User defined fields ("blisters: 2", "temp 40F") are compiled into one
+pattern by compile_fields and found by parse_fields.
+"""
+
+import re
+
+WEIGHT_PATTERN = re.compile(r"(\d+\.?\d*)\s?(?:lbs|pounds|lb)\s?(?:pack|bag)?")
+KNEE_PAIN_PATTERN = re.compile(r"(?:knee pain|Knee [Pp]ain):\s?(\d+)")
+GROUND_PATTERN = re.compile(r"[sS]now|[rR]ocky|[pP]avement|[oO]ff[- ]trail")
+# comments run from the first word character to the end of that line
+COMMENT_PATTERN = re.compile(r"\w.*")
+
+EMPTY_DESCRIPTION = {"weight": 0, "knee_pain": 0, "ground_type": "trail", "comments": None}
+
+# what the value of a user defined field is converted with
+FIELD_TYPES = {"int": int, "float": float, "str": str}
+
+
+def parse(description):
+    """Parses one description.
+
+    The first weight and knee pain found are used, and every other copy of
+    the same text is dropped from the comments too. The first ground type
+    left after that is used, "trail" if there isn't one.
+
+    :param description: Activity description, may be None
+    :type description: str
+
+    :return: weight, knee_pain, ground_type and comments
+    :rtype: dict
+    """
+    if not description:
+        return dict(EMPTY_DESCRIPTION)
+
+    # each pattern is searched for once the text before it matched is gone,
+    # removing it can join text on either side into a ground type
+    weight = WEIGHT_PATTERN.search(description)
+    if weight:
+        description = description.replace(weight.group(), "")
+    knee_pain = KNEE_PAIN_PATTERN.search(description)
+    if knee_pain:
+        description = description.replace(knee_pain.group(), "")
+    ground = GROUND_PATTERN.search(description)
+    comments = COMMENT_PATTERN.search(description)
+
+    return {
+        "weight": pounds_to_weight(weight.group(1)) if weight else 0,
+        "knee_pain": int(knee_pain.group(1)) if knee_pain else 0,
+        "ground_type": ground.group().lower() if ground else "trail",
+        "comments": comments.group() if comments else None,
+    }
+
+
+def pounds_to_weight(pounds):
+    """Converts the number in a weight match. Like the old parser one leading zero is dropped,
+    but "0 lbs" gives 0 instead of a ValueError."""
+    if pounds.startswith("0"):
+        pounds = pounds[1:]
+    try:
+        return float(pounds)
+    except ValueError:
+        return 0
+
+
+def compile_fields(fields):
+    """Compiles user defined fields, i.e. the DESCRIPTION_FIELDS config, into one pattern.
+
+    Each field's pattern is one alternative of the combined pattern, in the
+    order given. Nothing is wrapped around the alternatives, so the regex
+    engine can still skip one on its first character, and every field costs
+    the same small amount per description however many there are. Which
+    field matched is told apart by the index of the capturing groups it holds.
+
+    :param fields: {name: (pattern, type)}. The value is the pattern's first
+        group, or the whole match if it has none. type is "int", "float" or "str".
+        Patterns can't use named groups or backreferences.
+    :type fields: dict
+
+    :return: (pattern, fields by group index, fields in order), what parse_fields takes
+    :rtype: tuple
+
+    :raises ValueError: A pattern doesn't compile, has named groups or an unknown type
+    """
+    alternatives = []
+    by_group = [None]
+    ordered = []
+    for name, (pattern, type_name) in fields.items():
+        if type_name not in FIELD_TYPES:
+            raise ValueError(f"Field {name} has type {type_name}, use one of {', '.join(FIELD_TYPES)}.")
+        try:
+            compiled = re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f"Field {name} has an invalid pattern: {e}") from e
+        if compiled.groupindex:
+            raise ValueError(f"Field {name} can't use named groups.")
+        groups = compiled.groups
+        if not groups:
+            # the match is the value, it still needs a group to be told apart by
+            pattern = f"({pattern})"
+            groups = 1
+        field = (name, len(by_group), FIELD_TYPES[type_name], compiled)
+        by_group.extend([field] * groups)
+        ordered.append(field)
+        alternatives.append(pattern)
+    return re.compile("|".join(alternatives) or "(?!)"), by_group, ordered
+
+
+def parse_fields(description, compiled):
+    """Finds the user defined fields in a description with one scan.
+
+    The first value found for each field is used. Values that don't convert
+    to the field's type are left out.
+
+    :param description: Activity description, may be None
+    :type description: str
+
+    :param compiled: What compile_fields returned
+    :type compiled: tuple
+
+    :return: {name: value} of the fields found
+    :rtype: dict
+    """
+    values = {}
+    if not description:
+        return values
+    pattern, by_group, ordered = compiled
+    for match in pattern.finditer(description):
+        if match.lastindex is None:
+            # none of the field's groups took part, find it by trying each field here
+            name, group, convert, field_pattern = next(
+                field for field in ordered if field[3].match(description, match.start())
+            )
+        else:
+            name, group, convert, field_pattern = by_group[match.lastindex]
+        if name in values:
+            continue
+        text = match.group(group)
+        try:
+            values[name] = convert(match.group() if text is None else text)
+        except ValueError:
+            pass
+    return values
+
+
+def parse_descriptions(descriptions):
+    """Parses many descriptions, i.e. when importing or re-parsing the archive.
+
+    :param descriptions: Iterable of descriptions
+    :type descriptions: iterable
+
+    :return: Generator of the dicts parse returns, in the same order
+    :rtype: generator
+    """
+    for description in descriptions:
+        yield parse(description)
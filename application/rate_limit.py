@@ -0,0 +1,142 @@
+"""Keeps Strava requests inside the 15-minute and daily rate limits."""
+
+import threading
+import time
+
+# Strava's short limit resets at every natural quarter hour (UTC) and the
+# daily limit resets at midnight UTC.
+SHORT_WINDOW = 15 * 60
+DAILY_WINDOW = 24 * 60 * 60
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request would have to wait longer than allowed for quota."""
+
+    def __init__(self, wait):
+        super().__init__(f"Strava rate limit reached, quota resets in {int(wait)} seconds.")
+        self.wait = wait
+
+
+class RateLimiter:
+    """Token bucket that spaces requests to fit Strava's rate limits.
+
+    The bucket refills at whatever rate spreads the requests left in the
+    current 15-minute window evenly over the time left in it, so a long sync
+    uses the whole budget without going over while short syncs can still
+    burst. Limits and usage are corrected from the X-RateLimit-Limit and
+    X-RateLimit-Usage headers on every response.
+
+    When the 15-minute budget runs out acquire() sleeps until the next window.
+    If the daily budget runs out it raises RateLimitExceeded instead of
+    sleeping for hours, unless max_wait allows it.
+    """
+
+    def __init__(self, short_limit=100, daily_limit=1000, burst=10, max_wait=SHORT_WINDOW,
+                 clock=time.time, sleep=time.sleep):
+        self.short_limit = short_limit
+        self.daily_limit = daily_limit
+        self.burst = burst
+        self.max_wait = max_wait
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+
+        now = clock()
+        self.short_usage = 0
+        self.daily_usage = 0
+        self.short_window = now // SHORT_WINDOW
+        self.daily_window = now // DAILY_WINDOW
+        self.tokens = burst
+        self.last_refill = now
+
+    def _roll_windows(self, now):
+        """Resets usage counts once their window has passed. A new 15-minute window starts with a full bucket."""
+        if now // SHORT_WINDOW != self.short_window:
+            self.short_window = now // SHORT_WINDOW
+            self.short_usage = 0
+            self.tokens = self.burst
+            self.last_refill = now
+        if now // DAILY_WINDOW != self.daily_window:
+            self.daily_window = now // DAILY_WINDOW
+            self.daily_usage = 0
+
+    def _reserve(self, now):
+        """Counts a request against the budget if one can be sent at {now}. Call with the lock held.
+
+        :return: None if the request was counted, otherwise seconds to wait before trying again
+        :rtype: float or None
+        """
+        self._roll_windows(now)
+        if self.daily_usage >= self.daily_limit:
+            return (self.daily_window + 1) * DAILY_WINDOW - now
+        if self.short_usage >= self.short_limit:
+            return (self.short_window + 1) * SHORT_WINDOW - now
+
+        # spread what's left of this window's budget over what's left of the window
+        window_left = (self.short_window + 1) * SHORT_WINDOW - now
+        rate = (self.short_limit - self.short_usage) / window_left
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * rate)
+        self.last_refill = now
+        # a hair under 1 is rounding in the refill after waiting for exactly one token
+        if self.tokens < 1 - 1e-9:
+            return (1 - self.tokens) / rate
+
+        self.tokens = max(self.tokens - 1, 0)
+        self.short_usage += 1
+        self.daily_usage += 1
+        return None
+
+    def acquire(self):
+        """Blocks until another request can be sent and counts it against the budget.
+
+        The lock is only held to work out the wait, not while sleeping, so
+        update() can correct the budget from responses still coming in. The
+        budget is checked again after every sleep.
+
+        :raises RateLimitExceeded: The wait is longer than max_wait
+        """
+        while True:
+            with self.lock:
+                wait = self._reserve(self.clock())
+            if wait is None:
+                return
+            if wait > self.max_wait:
+                raise RateLimitExceeded(wait)
+            self.sleep(wait)
+
+    def update(self, headers):
+        """Takes limits and usage from a Strava response's rate limit headers.
+
+        :param headers: Response headers, i.e. X-RateLimit-Usage: "12,300"
+        :type headers: Mapping
+        """
+        limit = headers.get("X-RateLimit-Limit")
+        usage = headers.get("X-RateLimit-Usage")
+        if not limit or not usage:
+            return
+        try:
+            short_limit, daily_limit = (int(x) for x in limit.split(","))
+            short_usage, daily_usage = (int(x) for x in usage.split(","))
+        except ValueError:
+            return
+        with self.lock:
+            self._roll_windows(self.clock())
+            self.short_limit, self.daily_limit = short_limit, daily_limit
+            self.short_usage, self.daily_usage = short_usage, daily_usage
+
+    def exhaust(self):
+        """Marks the 15-minute budget as used up, i.e. after a 429 without headers."""
+        with self.lock:
+            self.short_usage = self.short_limit
+
+    def remaining(self):
+        """Returns the requests left in the current 15-minute and daily windows.
+
+        :rtype: dict
+        """
+        with self.lock:
+            self._roll_windows(self.clock())
+            return {
+                "short": max(self.short_limit - self.short_usage, 0),
+                "daily": max(self.daily_limit - self.daily_usage, 0),
+            }
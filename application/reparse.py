@@ -0,0 +1,172 @@
+"""Rebuilds the parsed columns of every activity from its stored description.
+
+Rows are read {chunk_size} at a time in id order, the chunks are parsed in
+a pool of worker processes, one per core, and only the rows whose weight,
+knee pain, ground type or comments came out different are written back, a
+chunk per transaction. Activities without a stored description (added
+before it was kept and never archived) are left as they are.
+"""
+
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from application.anomalies import rebuild_anomalies
+from application.db import get_db
+from application.parser import parse_descriptions
+
+PARSED_COLUMNS = ("weight", "knee_pain", "ground_type", "comments")
+
+
+def iter_description_chunks(chunk_size):
+    """Yields lists of (id, description, weight, knee_pain, ground_type, comments) tuples in id order.
+
+    Each chunk is its own query continuing after the last id, so no cursor
+    stays open while the previous chunk is written back.
+    """
+    db = get_db()
+    cursor = db.cursor()
+    # plain tuples, they're pickled over to the workers
+    cursor.row_factory = None
+    last_id = -1
+    while True:
+        rows = cursor.execute(
+            'SELECT id, description, weight, knee_pain, ground_type, comments FROM activities'
+            ' WHERE id > ? AND description IS NOT NULL ORDER BY id LIMIT ?',
+            (last_id, chunk_size)
+        ).fetchall()
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1][0]
+
+
+def parse_chunk(rows):
+    """Parses a chunk of rows, runs in the worker processes.
+
+    :param rows: (id, description, weight, knee_pain, ground_type, comments) tuples
+    :type rows: list
+
+    :return: (id, old, new) for every row whose parsed columns changed, old
+        and new being (weight, knee_pain, ground_type, comments) tuples
+    :rtype: list
+    """
+    changes = []
+    parsed = parse_descriptions(row[1] for row in rows)
+    for row, result in zip(rows, parsed):
+        new = (result["weight"], result["knee_pain"], result["ground_type"], result["comments"])
+        if new != row[2:]:
+            changes.append((row[0], row[2:], new))
+    return changes
+
+
+def map_chunks(executor, chunks, in_flight):
+    """executor.map(parse_chunk, chunks) with at most {in_flight} chunks read ahead.
+
+    executor.map reads every chunk up front, which would load the whole table.
+    """
+    pending = deque()
+    for chunk in chunks:
+        pending.append((len(chunk), executor.submit(parse_chunk, chunk)))
+        if len(pending) >= in_flight:
+            count, future = pending.popleft()
+            yield count, future.result()
+    while pending:
+        count, future = pending.popleft()
+        yield count, future.result()
+
+
+def reparse(workers=None, chunk_size=None, dry_run=False):
+    """Re-parses every stored description and writes back the columns that changed.
+
+    :param workers: Worker processes. Defaults to the number of cores, 1 parses in this process.
+    :type workers: int
+
+    :param chunk_size: Rows read, parsed and written at a time. Defaults to the REPARSE_CHUNK_SIZE config.
+    :type chunk_size: int
+
+    :param dry_run: Work out the changes without writing them
+    :type dry_run: bool
+
+    :return: Generator yielding running totals after every chunk: rows read,
+        changed and rows_per_second, plus the chunk's changes as parse_chunk
+        returns them
+    :rtype: generator
+    """
+    workers = workers or os.cpu_count() or 1
+    chunk_size = chunk_size or current_app.config['REPARSE_CHUNK_SIZE']
+    stats = {"read": 0, "changed": 0, "rows_per_second": 0}
+    started = time.perf_counter()
+    db = get_db()
+
+    chunks = iter_description_chunks(chunk_size)
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        if executor is None:
+            results = ((len(chunk), parse_chunk(chunk)) for chunk in chunks)
+        else:
+            # enough read ahead to keep every worker busy while a chunk is written
+            results = map_chunks(executor, chunks, workers * 2)
+
+        for count, changes in results:
+            if changes and not dry_run:
+                with db:
+                    db.executemany(
+                        'UPDATE activities SET weight = ?, knee_pain = ?, ground_type = ?, comments = ?'
+                        ' WHERE id = ?',
+                        [new + (activity_id,) for activity_id, old, new in changes]
+                    )
+            stats["read"] += count
+            stats["changed"] += len(changes)
+            stats["rows_per_second"] = stats["read"] / (time.perf_counter() - started)
+            yield dict(stats, changes=changes)
+
+        if stats["changed"] and not dry_run:
+            # changed weights change which hikes are abnormal
+            with db:
+                rebuild_anomalies(db)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def format_change(activity_id, old, new):
+    """One line of the dry run diff, i.e. "activity 12: weight 0 -> 10.0, comments 'garbled' -> None"."""
+    diffs = [
+        f'{column} {before!r} -> {after!r}'
+        for column, before, after in zip(PARSED_COLUMNS, old, new)
+        if before != after
+    ]
+    return f'activity {activity_id}: {", ".join(diffs)}'
+
+
+@click.command('reparse')
+@click.option('--workers', type=int, help='Worker processes, defaults to the number of cores.')
+@click.option('--chunk-size', type=int, help='Rows to read, parse and commit at a time.')
+@click.option('--dry-run', is_flag=True, help='Print what would change without writing it.')
+@with_appcontext
+def reparse_command(workers, chunk_size, dry_run):
+    """Re-parse every stored activity description into the parsed columns."""
+    stats = {"read": 0, "changed": 0, "rows_per_second": 0}
+    for stats in reparse(workers, chunk_size, dry_run):
+        if dry_run:
+            for change in stats["changes"]:
+                click.echo(format_change(*change))
+        else:
+            click.echo(
+                f'{stats["read"]} rows read, {stats["changed"]} changed '
+                f'({stats["rows_per_second"]:.0f} rows/s)'
+            )
+    verb = 'would change' if dry_run else 'changed'
+    click.echo(
+        f'Re-parsed {stats["read"]} activities, {stats["changed"]} {verb} '
+        f'({stats["rows_per_second"]:.0f} rows/s).'
+    )
+
+
+def init_app(app):
+    app.cli.add_command(reparse_command)
@@ -0,0 +1,104 @@
+"""Per day, week and month totals of the activities table.
+
+The rollups table is kept up to date by triggers on activities (see
+migrations/0007_rollups.sql), so every insert, update or delete adjusts the
+totals in the same transaction. Summaries read a few rollup rows instead of
+regrouping the whole history.
+"""
+
+import datetime
+
+import click
+from flask.cli import with_appcontext
+from application.db import get_db
+
+REBUILD_ROLLUPS_SQL = '''
+INSERT INTO rollups (period, bucket, activities, distance, total_elevation_gain, weight_distance, knee_pain_sum, knee_pain_count)
+SELECT period, strftime(bucket_format, start_date, modifier), COUNT(*),
+    SUM(ROUND(COALESCE(distance, 0) / 1609.34, 2)),
+    SUM(COALESCE(total_elevation_gain, 0)),
+    SUM(COALESCE(weight, 0) * ROUND(COALESCE(distance, 0) / 1609.34, 2)),
+    SUM(COALESCE(knee_pain, 0)),
+    COUNT(knee_pain)
+FROM activities, rollup_periods
+WHERE strftime('%s', start_date) IS NOT NULL
+GROUP BY 1, 2
+'''
+
+
+def rebuild_rollups():
+    """Recomputes every rollup from the activities table, i.e. to repair drift."""
+    db = get_db()
+    with db:
+        db.execute('DELETE FROM rollups')
+        db.execute(REBUILD_ROLLUPS_SQL)
+
+
+def get_rollups(period, first_bucket=None, last_bucket=None):
+    """Returns the {period} rollups between two buckets (inclusive), oldest first."""
+    db = get_db(readonly=True)
+    return db.execute(
+        'SELECT * FROM rollups WHERE period = ? AND bucket BETWEEN ? AND ? ORDER BY bucket',
+        (period, first_bucket or '0000-00-00', last_bucket or '9999-99-99')
+    ).fetchall()
+
+
+def summarize_rollup(bucket, rollup):
+    """Turns a rollup row (or None for an empty bucket) into the values the summaries show.
+
+    knee_pain is the average per activity, weight the average weight carried
+    per mile.
+    """
+    if rollup is None:
+        return {"date": bucket, "distance": 0, "total_elevation_gain": 0, "knee_pain": 0, "weight": 0}
+    return {
+        "date": bucket,
+        "distance": rollup["distance"],
+        "total_elevation_gain": rollup["total_elevation_gain"],
+        "knee_pain": round(rollup["knee_pain_sum"] / rollup["knee_pain_count"], 2) if rollup["knee_pain_count"] else 0,
+        "weight": rollup["weight_distance"] / rollup["distance"] if rollup["distance"] else 0,
+    }
+
+
+def weekly_summary(weeks=None):
+    """Returns the last {weeks} weeks of totals, oldest first, ending with the latest active week.
+
+    Weeks without activities in between are included with zeros, the same
+    way the pandas weekly grouping fills them in.
+
+    :param weeks: Number of weeks to return. None (or 0 or less) for the whole history.
+    :type weeks: int or None
+
+    :return: Dicts with date (the Sunday the week ends on), distance,
+        total_elevation_gain, knee_pain and weight
+    :rtype: list
+    """
+    db = get_db(readonly=True)
+    first, last = db.execute("SELECT MIN(bucket), MAX(bucket) FROM rollups WHERE period = 'week'").fetchone()
+    if last is None:
+        return []
+    first, last = datetime.date.fromisoformat(first), datetime.date.fromisoformat(last)
+    if weeks and weeks > 0:
+        first = max(first, last - datetime.timedelta(weeks=weeks - 1))
+
+    rollups = {
+        rollup["bucket"]: rollup for rollup in get_rollups('week', first.isoformat(), last.isoformat())
+    }
+    week = first
+    summary = []
+    while week <= last:
+        summary.append(summarize_rollup(week.isoformat(), rollups.get(week.isoformat())))
+        week += datetime.timedelta(weeks=1)
+    return summary
+
+
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+    """Recompute the day, week and month rollups from scratch."""
+    rebuild_rollups()
+    click.echo('Rebuilt rollups.')
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_rollups_command)
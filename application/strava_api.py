@@ -5,13 +5,123 @@ from dotenv import load_dotenv
 import requests
 import json
 import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from flask import current_app
 from datetime import datetime
 from application.db import get_db
-from application.internal_api import insert_activity, parse_description, handle_manual_activity_errors
+from application.archive import archive_row
+from application.rate_limit import RateLimiter, RateLimitExceeded
+from application.internal_api import insert_activities, delete_activity, parse_description, handle_manual_activity_errors
 
 # Get environment variables
 load_dotenv()
 
+# Number of detailed activities fetched from Strava at the same time
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", 8))
+
+# Used as the after date when the activities table is empty
+EPOCH_DATE = "1970-01-01T00:00:00Z"
+
+# Strava host, overridable so tests can point the client at a local server
+STRAVA_URL = os.getenv("STRAVA_URL", "https://www.strava.com")
+# Seconds to wait for Strava to connect/respond before retrying
+REQUEST_TIMEOUT = float(os.getenv("STRAVA_REQUEST_TIMEOUT", 10))
+# Times a failed request is retried, and the base delay between retries
+MAX_RETRIES = int(os.getenv("STRAVA_MAX_RETRIES", 4))
+RETRY_BACKOFF = float(os.getenv("STRAVA_RETRY_BACKOFF", 0.5))
+# Statuses worth trying again (rate limited or Strava having a bad time)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Strava's default 15-minute and daily request budgets, corrected from response headers
+RATE_LIMIT_SHORT = int(os.getenv("STRAVA_RATE_LIMIT_SHORT", 100))
+RATE_LIMIT_DAILY = int(os.getenv("STRAVA_RATE_LIMIT_DAILY", 1000))
+
+
+class StravaClient:
+    """Keep-alive connection to Strava with timeouts and retries.
+
+    One requests.Session is shared by every call so TCP/TLS connections are
+    reused, and its pool is sized to match the number of sync workers.
+    Requests that time out or come back with a status in RETRY_STATUSES are
+    retried with exponential backoff plus jitter. Every attempt first waits
+    on the rate limiter so syncs stay inside Strava's request budgets.
+    """
+
+    def __init__(self, base_url=STRAVA_URL, pool_size=SYNC_CONCURRENCY, timeout=REQUEST_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF, rate_limiter=None):
+        self.base_url = base_url
+        self.rate_limiter = rate_limiter or RateLimiter(RATE_LIMIT_SHORT, RATE_LIMIT_DAILY)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, path, access_token=None, retry=True, **kwargs):
+        """Sends a request to Strava, retrying timeouts and retryable statuses.
+
+        :param method: HTTP method i.e. "GET"
+        :type method: str
+
+        :param path: Path on the Strava host i.e. "/api/v3/activities"
+        :type path: str
+
+        :param access_token: Token sent as a Bearer Authorization header. None for oauth calls.
+        :type access_token: str or None
+
+        :param retry: Retry timeouts and RETRY_STATUSES. Off for requests that
+            can't be sent twice, i.e. exchanging a single use authorization code.
+        :type retry: bool
+
+        :return: The last response received
+        :rtype: Response object
+        """
+        headers = kwargs.pop("headers", {})
+        if access_token:
+            headers["Authorization"] = "Bearer " + access_token
+        kwargs.setdefault("timeout", self.timeout)
+        max_retries = self.max_retries if retry else 0
+
+        for attempt in range(max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.request(method, self.base_url + path, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == max_retries:
+                    raise
+                response = None
+            else:
+                self.rate_limiter.update(response.headers)
+                if response.status_code == 429 and "X-RateLimit-Usage" not in response.headers:
+                    self.rate_limiter.exhaust()
+                if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+                    return response
+            time.sleep(self.retry_delay(attempt, response))
+
+    def retry_delay(self, attempt, response=None):
+        """Seconds to wait before retry number {attempt} + 1.
+
+        Honors a Retry-After header if Strava sent one, otherwise doubles the
+        backoff every attempt and adds up to one backoff of random jitter.
+        """
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return int(response.headers["Retry-After"])
+        return self.backoff * 2 ** attempt + random.uniform(0, self.backoff)
+
+
+_client = None
+
+
+def get_client():
+    """Returns the shared StravaClient, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = StravaClient()
+    return _client
+
 
 def get_initial_token(code):
     """Creates strava_tokens.json with initial authorization token.
@@ -26,9 +136,12 @@ def get_initial_token(code):
     :type body: str
     """
     # Make Strava auth API call with your
-    # client_code, client_secret and code
-    response = requests.post(
-        url="https://www.strava.com/oauth/token",
+    # client_code, client_secret and code. The code only works once, so a
+    # retry after the first attempt reached Strava would only get a 400
+    response = get_client().request(
+        "POST",
+        "/oauth/token",
+        retry=False,
         data={
             "client_id": os.getenv("CLIENT_ID"),
             "client_secret": os.getenv("CLIENT_SECRET"),
@@ -78,8 +191,9 @@ def get_tokens():
 
 def refresh_tokens(strava_tokens):
     """Uses strava refresh token to get a new set of tokens."""
-    r = requests.post(
-        url="https://www.strava.com/oauth/token",
+    return get_client().request(
+        "POST",
+        "/oauth/token",
         data={
             "client_id": os.getenv("CLIENT_ID"),
             "client_secret": os.getenv("CLIENT_SECRET"),
@@ -87,9 +201,6 @@ def refresh_tokens(strava_tokens):
             "refresh_token": strava_tokens["refresh_token"],
             },
         )
-    print(dir(r))
-    print(r.ok)
-    return r
 
 
 def get_detailed_activity(activity_id, strava_tokens):
@@ -104,11 +215,10 @@ def get_detailed_activity(activity_id, strava_tokens):
     :return: Reponse object with Strava DetailedActivity object
     :rtype: Response object
     """
-    url = "https://www.strava.com/api/v3/activities"
-    access_token = strava_tokens["access_token"]
-
     # get response object with activity from Strava
-    return requests.get(url + "/" + str(activity_id) + "?access_token=" + access_token)
+    return get_client().request(
+        "GET", "/api/v3/activities/" + str(activity_id), strava_tokens["access_token"]
+    )
 
 
 def get_page_of_activities(last_activity_date, page, strava_tokens):
@@ -127,78 +237,198 @@ def get_page_of_activities(last_activity_date, page, strava_tokens):
     :rtype: Response Object
     """
 
-    url = "https://www.strava.com/api/v3/activities"
-    access_token = strava_tokens["access_token"]
+    params = {"per_page": 200, "page": page}
 
     if last_activity_date:
-        tstamp = int(
+        params["after"] = int(
             (
                 datetime.strptime(last_activity_date, "%Y-%m-%dT%H:%M:%SZ")
                 - datetime(1970, 1, 1)
             ).total_seconds()
         )
 
-        return requests.get(
-            url
-            + "?access_token="
-            + access_token
-            + "&after="
-            + str(tstamp)
-            + "&per_page=200"
-            + "&page="
-            + str(page)
+    return get_client().request(
+        "GET", "/api/v3/activities", strava_tokens["access_token"], params=params
+    )
+
+
+def download_new_activities(max_workers=SYNC_CONCURRENCY):
+    """Downloads all new activities from strava (activities added after most recent activity in DB).
+
+    Detailed activities are fetched by a bounded pool of worker threads while
+    the main loop keeps paging. Each page's results are inserted, in
+    start_date order, once the following page has been requested.
+
+    Progress is checkpointed in sync_state/sync_in_flight as it goes, so an
+    interrupted sync resumes from the page (and after date) it reached and
+    re-fetches only the activities that were listed but never inserted.
+
+    :param max_workers: Number of detailed activities fetched at once.
+    :type max_workers: int
+    """
+    strava_tokens = get_tokens()
+
+    state = get_sync_state()
+    if state:
+        last_activity_date, page = state["after_date"], state["page"]
+        current_app.logger.info("Resuming sync at page %s.", page)
+    else:
+        # get id of last downloaded activity in db. Always passing an after date
+        # makes Strava return pages oldest first, so inserts stay in date order.
+        last_activity_date, page = get_last_activity_date() or EPOCH_DATE, 1
+        save_sync_state(last_activity_date, page, [])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # activities an interrupted sync listed but didn't get to insert
+        pending = [
+            (start_date, activity_id, pool.submit(get_detailed_activity, activity_id, strava_tokens))
+            for activity_id, start_date in get_in_flight_activities()
+        ]
+        finished = False
+        try:
+            while True:
+                r = get_page_of_activities(last_activity_date, page, strava_tokens)
+                if r.status_code != 200:
+                    print("Was not able to fetch summary activity array.")
+                    break
+                r = r.json()
+                print("page: ", page, "length: ", len(r))
+
+                # queue up this page's detail requests before handling the last page
+                queued = [
+                    (summary["start_date"], summary["id"], pool.submit(get_detailed_activity, summary["id"], strava_tokens))
+                    for summary in r
+                    if summary["type"] == "Hike" or summary["type"] == "Walk"
+                ]
+                save_sync_state(last_activity_date, page + 1, [(q[1], q[0]) for q in queued])
+                insert_detailed_activities(pending)
+                pending = queued
+
+                if not r:
+                    finished = True
+                    break
+                page += 1
+
+            insert_detailed_activities(pending)
+        except RateLimitExceeded as e:
+            for _, _, future in pending:
+                future.cancel()
+            print(e)
+            print("Sync stopped, it will resume from page", page, "next time.")
+        else:
+            if finished:
+                clear_sync_state()
+
+    print("Remaining Strava requests: ", get_client().rate_limiter.remaining())
+
+
+def insert_detailed_activities(pending):
+    """Waits on queued detailed activity requests and inserts them in start_date order.
+
+    The activities and their archived responses are written in one batched
+    transaction and then taken out of the in flight set.
+
+    :param pending: (start_date, activity id, Future) tuples
+    :type pending: list
+    """
+    activities = []
+    archived = []
+    for start_date, activity_id, future in sorted(pending, key=lambda p: p[0]):
+        detailed_activity = future.result()
+        if detailed_activity.status_code == 200:
+            activity = detailed_activity.json()
+            archived.append(archive_row(activity))
+            parse_description(activity)
+            handle_manual_activity_errors(activity)
+            activities.append(activity)
+        else:
+            print(f"Not able to fetch detailed summary for activity {activity_id}")
+    insert_activities(activities, archived=archived)
+    finish_in_flight_activities([p[1] for p in pending])
+
+
+def ingest_activity(activity_id):
+    """Downloads a single activity and upserts it, i.e. when Strava says it was created or updated.
+
+    Activities that are gone from Strava, or are no longer a Hike or Walk,
+    are deleted instead.
+
+    :param activity_id: Strava Activity id
+    :type activity_id: int
+    """
+    detailed_activity = get_detailed_activity(activity_id, get_tokens())
+    if detailed_activity.status_code == 404:
+        delete_activity(activity_id)
+        return
+    if detailed_activity.status_code != 200:
+        raise RuntimeError(
+            f"Not able to fetch detailed summary for activity {activity_id}: {detailed_activity.status_code}"
         )
+    activity = detailed_activity.json()
+    if activity["type"] == "Hike" or activity["type"] == "Walk":
+        archived = [archive_row(activity)]
+        parse_description(activity)
+        handle_manual_activity_errors(activity)
+        insert_activities([activity], archived=archived)
     else:
-        return requests.get(
-            url
-            + "?access_token="
-            + access_token
-            + "&per_page=200"
-            + "&page="
-            + str(page)
+        delete_activity(activity_id)
+
+
+def get_sync_state():
+    """Returns the checkpoint left by an interrupted sync, or None if the last sync finished."""
+    db = get_db()
+    return db.execute("SELECT after_date, page FROM sync_state WHERE id = 1").fetchone()
+
+
+def save_sync_state(after_date, page, in_flight):
+    """Checkpoints the next page to request and the activities listed on the current one.
+
+    :param after_date: After date the sync is paging with.
+    :type after_date: DateTime str
+
+    :param page: Next page of summaries to request.
+    :type page: int
+
+    :param in_flight: (strava_id, start_date) of activities queued for download
+    :type in_flight: list
+    """
+    db = get_db()
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO sync_state (id, after_date, page, updated_at)"
+            " VALUES (1, ?, ?, CURRENT_TIMESTAMP)",
+            (after_date, page)
+        )
+        db.executemany(
+            "INSERT OR REPLACE INTO sync_in_flight (strava_id, start_date) VALUES (?, ?)", in_flight
         )
 
 
-def download_new_activities():
-    """Downloads all new activities from strava (activities added after most recent activity in DB)."""
-    strava_tokens = get_tokens()
+def get_in_flight_activities():
+    """Returns (strava_id, start_date) of activities listed but not yet inserted."""
+    db = get_db()
+    return db.execute("SELECT strava_id, start_date FROM sync_in_flight").fetchall()
+
 
-    # get id of last downloaded activity in db
-    last_activity_date = get_last_activity_date()
-
-    page = 1
-
-    while True:
-        r = get_page_of_activities(last_activity_date, page, strava_tokens)
-        if r.status_code != 200:
-            print("Was not able to fetch summary activity array.")
-            break
-        print("r: ", r)
-        r = r.json()
-        print("r.json:", r)
-        print("page: ", page)
-        if not r:
-            break
-        print("length: ", len(r), "\n")
-        for x in range(len(r)):
-            print("im here")
-            if r[x]["type"] == "Hike" or r[x]["type"] == "Walk":
-                detailed_activity = get_detailed_activity(r[x]["id"], strava_tokens)
-                if detailed_activity.status_code == 200:
-                    activity = detailed_activity.json()
-                    parse_description(activity)
-                    handle_manual_activity_errors(activity)
-                    insert_activity(activity)
-                    print("activity inserted")
-                else:
-                    print(f"Not able to fetch detailed summary for activity {r[x]['id']}")
-
-        page += 1
+def finish_in_flight_activities(activity_ids):
+    """Removes activities from the in flight set once they've been handled."""
+    db = get_db()
+    with db:
+        db.executemany("DELETE FROM sync_in_flight WHERE strava_id = ?", ((i,) for i in activity_ids))
+
+
+def clear_sync_state():
+    """Forgets the checkpoint once a sync has run to the end."""
+    db = get_db()
+    with db:
+        db.execute("DELETE FROM sync_state")
+        db.execute("DELETE FROM sync_in_flight")
 
 
 def get_last_activity_date():
     """Returns last start_date of last activity downloaded from Strava (not manual upload)"""
     db = get_db()
-    return db.execute(
-        "SELECT MAX(start_date) FROM activities WHERE strava_id IS NOT NULL"
-    ).fetchone()[0]
+    row = db.execute(
+        "SELECT start_date FROM activities WHERE strava_id IS NOT NULL ORDER BY start_ts DESC LIMIT 1"
+    ).fetchone()
+    return row[0] if row else None
@@ -1,66 +1,98 @@
 """Defines app URLS that relate to the training portion of the app."""
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, current_app, flash, g, jsonify, redirect, render_template, request, url_for
 )
 from werkzeug.exceptions import abort
-from application.internal_api import get_all_activities, activity_index
-from application.strava_api import download_new_activities
+from application.internal_api import activity_index_page, activity_filters_from_args, parse_activity_cursor
+from application.jobs import enqueue_job, get_job, get_latest_job
+from application.cache import cached_view
 
 bp = Blueprint('trainer', __name__)
 
-# TODO create test for download activities
 # TODO create tests for the previous things - tokens working, responses good,
 # getting all activities added after __ time, db insertions working properly
-# TODO let's put a nice refresh activities button in upper right hand corner
-# so we're not making calls every time we go to index
 @bp.route('/')
+@cached_view('activities', 'jobs')
 def index():
-    """Show all the activities."""
-    #download_new_activities()
-    activities = activity_index()
-    return render_template('trainer/index.html', activities=activities)
+    """Show a page of activities, newest first. Syncing with Strava is left to the background worker.
+
+    ?cursor= moves to the next page, ?page_size= sets its length and the
+    ACTIVITY_FILTERS arguments (type, ground_type, start, end, min_weight,
+    max_weight, min_knee_pain) narrow the activities down.
+    """
+    filters = activity_filters_from_args(request.args)
+    page_size = request.args.get('page_size', type=int)
+    if page_size is not None:
+        page_size = min(max(page_size, 1), current_app.config['MAX_INDEX_PAGE_SIZE'])
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        try:
+            parse_activity_cursor(cursor)
+        except ValueError:
+            abort(400, "Invalid cursor.")
+
+    activities, next_cursor = activity_index_page(filters, cursor, page_size)
+    sync = get_latest_job('sync')
+    # the filters as they were given, to carry over to the next page link
+    args = {key: value for key, value in request.args.items() if key != 'cursor' and value}
+    return render_template(
+        'trainer/index.html', activities=activities, sync=sync,
+        next_cursor=next_cursor, args=args, first_page=cursor is None
+    )
+
+
+@bp.route('/sync', methods=('POST',))
+def sync():
+    """Queue a Strava sync and return straight away."""
+    job_id = enqueue_job('sync')
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(dict(get_job(job_id))), 202
+    return redirect(url_for('index'))
+
+
+@bp.route('/jobs/<int:id>')
+def job_status(id):
+    """Show the status of a background job."""
+    job = get_job(id)
+    if job is None:
+        abort(404)
+    return jsonify(dict(job))
 
 
 @bp.route('/weekly-summary')
+@cached_view('activities')
 def weekly_summary():
-    """Shows summary of weekly stats."""
-    import pandas as pd
-    from application.db import get_db
-    from application.internal_api import convert_meters_miles
-    db = get_db()
-    df = pd.read_sql_query("SELECT * from activities", db)
-    df.start_date = pd.to_datetime(df.start_date, format="%Y-%m-%dT%H:%M:%SZ")
-    df.distance = df.distance.apply(convert_meters_miles)
-    totals = df[["distance", "total_elevation_gain", "start_date"]]
-    totals = totals.groupby(pd.Grouper(key='start_date', freq='W')).sum()
-
-    ave = df[["start_date", "knee_pain"]]
-    ave = ave.groupby(pd.Grouper(key='start_date', freq='W')).mean().round(2)
-
-    weekly = totals.join(ave).fillna(0)
-
-    # figure out average weight per mile
-    df['ave_weight'] = (df['weight']*df['distance'])
-    # group by week
-    weight = df[['ave_weight', 'start_date']].groupby(pd.Grouper(key='start_date', freq='W')).sum()
-    # divide by total distance that week to get ave weight carried per mile
-    weekly['weight'] = (weight['ave_weight']/weekly['distance']).fillna(0)
-
+    """Shows summary of weekly stats, read from the weekly rollups.
+
+    ?weeks= sets how many weeks back to show, 52 by default and 0 (or less) for all of them.
+    ?start= and ?end= (YYYY-MM-DD) show the weeks between two dates instead.
+    """
+    from application.rollups import weekly_summary as get_weekly_summary
+    from application.aggregates import aggregate, parse_date_arg
+    weeks = max(request.args.get('weeks', 52, type=int), 0)
+    start = request.args.get('start', type=parse_date_arg)
+    end = request.args.get('end', type=parse_date_arg)
+    if start or end:
+        # the rollups only hold whole weeks, group the activities in the range instead
+        weekly = aggregate('week', start, end)
+    else:
+        weekly = get_weekly_summary(weeks or None)
 
     # get values for graph before stringifying
-    date = list(weekly.index.strftime('%Y-%m-%d'))
-    distance = list(weekly.distance)
-    elevation = list(weekly.total_elevation_gain)
-    weight = list(weekly.weight)
-    knee_pain = list(weekly.knee_pain)
+    date = [week["date"] for week in weekly]
+    distance = [week["distance"] for week in weekly]
+    elevation = [week["total_elevation_gain"] for week in weekly]
+    weight = [week["weight"] for week in weekly]
+    knee_pain = [week["knee_pain"] for week in weekly]
     #stringify values to make decimals nicer
     def decimal_display(value):
         return f'{value:.2f}'
 
-    weekly.distance = weekly.distance.apply(decimal_display)
-    weekly.total_elevation_gain = weekly.total_elevation_gain.apply(decimal_display)
-    weekly.weight = weekly.weight.apply(decimal_display)
-    return render_template('trainer/weekly_summary.html', weekly=weekly.sort_index(ascending=False), date=date, distance=distance, elevation=elevation, weight=weight, knee_pain=knee_pain)
+    for week in weekly:
+        week["distance"] = decimal_display(week["distance"])
+        week["total_elevation_gain"] = decimal_display(week["total_elevation_gain"])
+        week["weight"] = decimal_display(week["weight"])
+    return render_template('trainer/weekly_summary.html', weekly=weekly[::-1], weeks=weeks, date=date, distance=distance, elevation=elevation, weight=weight, knee_pain=knee_pain)
 
     # totals:
     # miles hiked that week
@@ -85,11 +117,16 @@ def weekly_summary():
 
 @bp.route('/graphs')
 def graphs():
-    import pandas as pd
-    from application.db import get_db
-    from application.internal_api import convert_meters_miles
-    db = get_db()
-    df = pd.read_sql_query("SELECT start_date, distance from activities", db)
-    date = list(df.start_date)
-    distance = list(convert_meters_miles(i) for i in df.distance)
-    return render_template('trainer/graphs.html', date=date, distance=distance)
+    """Graphs a metric over time.
+
+    The page itself holds no data, it fetches a downsampled series from
+    /api/series and again for every zoom. ?period= (day, week, month or year)
+    graphs the totals per period instead of every activity, ?start= and ?end=
+    (YYYY-MM-DD) set the first range shown.
+    """
+    from application.aggregates import PERIODS, SERIES_METRICS
+    period = request.args.get('period')
+    if period is not None and period not in PERIODS:
+        abort(400, f"Unknown period, use one of {', '.join(PERIODS)}.")
+    args = {key: value for key, value in request.args.items() if key in ('period', 'start', 'end') and value}
+    return render_template('trainer/graphs.html', metrics=SERIES_METRICS, args=args)
@@ -0,0 +1,47 @@
+"""Receives Strava's push subscription events.
+
+Strava calls GET once to validate the subscription and then POSTs an event
+every time an activity is created, updated or deleted. Events are only
+queued here; the background worker fetches (or deletes) that one activity.
+"""
+from flask import Blueprint, current_app, jsonify, request
+from werkzeug.exceptions import abort
+from application.jobs import enqueue_job
+
+bp = Blueprint('webhook', __name__, url_prefix='/webhook')
+
+
+@bp.route('', methods=('GET',))
+def validate():
+    """Answer Strava's subscription validation handshake."""
+    if request.args.get('hub.mode') != 'subscribe':
+        abort(400)
+    verify_token = current_app.config['STRAVA_VERIFY_TOKEN']
+    if not verify_token or request.args.get('hub.verify_token') != verify_token:
+        abort(403)
+    return jsonify({'hub.challenge': request.args.get('hub.challenge')})
+
+
+@bp.route('', methods=('POST',))
+def event():
+    """Queue the work for a single activity event.
+
+    Strava expects a 200 within two seconds, so nothing is fetched here.
+    """
+    event = request.get_json(silent=True)
+    if not event or 'object_id' not in event or 'aspect_type' not in event:
+        abort(400)
+
+    subscription_id = current_app.config['STRAVA_SUBSCRIPTION_ID']
+    if subscription_id and str(event.get('subscription_id')) != str(subscription_id):
+        abort(403)
+
+    # athlete events (i.e. deauthorization) aren't something we store
+    if event.get('object_type') != 'activity':
+        return jsonify(queued=None)
+
+    if event['aspect_type'] == 'delete':
+        job_id = enqueue_job('delete-activity', event['object_id'])
+    else:
+        job_id = enqueue_job('activity', event['object_id'])
+    return jsonify(queued=job_id)
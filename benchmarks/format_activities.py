@@ -0,0 +1,67 @@
+"""Compares format_activities_for_view with the per-row format_activity_for_view.
+
+Run from the repo root:
+
+    python -m benchmarks.format_activities [rows ...]
+
+Prints the rows per second of both paths for 1k to 1M activities by default.
+"""
+
+import random
+import sys
+import time
+
+from application.internal_api import format_activities_for_view, format_activity_for_view
+
+SIZES = [1000, 10000, 100000, 1000000]
+
+
+def make_activities(count, seed=17):
+    """Builds {count} activity rows that look like the ones Strava sends."""
+    rand = random.Random(seed)
+    start = 1546300800
+    activities = []
+    for id in range(count):
+        start += rand.randint(3600, 3 * 86400)
+        moving_time = rand.randint(600, 6 * 3600)
+        activities.append({
+            "id": id,
+            "strava_id": id,
+            "distance": rand.uniform(0, 30000),
+            "moving_time": moving_time,
+            "elapsed_time": moving_time + rand.randint(0, 3600),
+            "total_elevation_gain": rand.uniform(0, 1500),
+            "elev_high": rand.uniform(0, 3000),
+            "elev_low": rand.uniform(0, 300),
+            "type": "Hike",
+            "start_date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start)),
+            "average_speed": rand.uniform(0.5, 2),
+            "gear_id": None,
+            "weight": rand.randint(0, 40),
+            "knee_pain": rand.randint(0, 10),
+            "ground_type": "trail",
+            "comments": None,
+        })
+    return activities
+
+
+def rows_per_second(format_block, activities):
+    started = time.perf_counter()
+    format_block(activities)
+    return len(activities) / (time.perf_counter() - started)
+
+
+def main(sizes):
+    print(f"{'rows':>9} {'per row/s':>12} {'batch/s':>12} {'speedup':>8}")
+    for size in sizes:
+        activities = make_activities(size)
+        assert format_activities_for_view(activities[:1000]) == [
+            format_activity_for_view(activity) for activity in activities[:1000]
+        ]
+        per_row = rows_per_second(lambda rows: [format_activity_for_view(row) for row in rows], activities)
+        batch = rows_per_second(format_activities_for_view, activities)
+        print(f"{size:>9} {per_row:>12,.0f} {batch:>12,.0f} {batch / per_row:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or SIZES)
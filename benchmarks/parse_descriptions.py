@@ -0,0 +1,98 @@
+"""Compares the compiled description parser with the one it replaced.
+
+Run from the repo root:
+
+    python -m benchmarks.parse_descriptions [repeats]
+
+Parses the test corpus {repeats} times (1000 by default) with both and
+prints descriptions per second.
+"""
+
+import json
+import os
+import re
+import sys
+import time
+
+from application.parser import parse_descriptions
+
+CORPUS = os.path.join(os.path.dirname(__file__), '..', 'tests', 'description_corpus.json')
+
+
+def load_corpus():
+    with open(CORPUS, encoding='utf8') as f:
+        return json.load(f)
+
+
+def legacy_parse_description(activity):
+    """internal_api.parse_description before application.parser, kept to compare against."""
+    # parse ground type, lbs, knee pain, other comments
+    if not activity["description"]:
+        activity["weight"] = 0
+        activity["knee_pain"] = 0
+        activity['ground_type'] = "trail"
+        activity['comments'] = None
+    else:
+        comments = activity["description"]
+
+        weight_format = re.compile(r"\d+[\.]?\d*\s?(lbs|pounds|lb)\s?(pack|bag)?")
+        weight = weight_format.search(activity["description"])
+        if weight:
+            weight = weight.group()
+            activity["weight"] = float(re.sub(r"^0|[^0-9\.]", "", weight))
+            comments = re.sub(weight, "", comments)
+        else:
+            activity["weight"] = 0
+
+        knee_pain_format = re.compile(r"(knee pain|Knee Pain|Knee pain):\s?\d+")
+        knee_pain = knee_pain_format.search(comments)
+        if knee_pain:
+            knee_pain = knee_pain.group()
+            activity["knee_pain"] = int(re.sub("[^0-9]", "", knee_pain))
+            comments = re.sub(knee_pain, "", comments)
+        else:
+            activity["knee_pain"] = 0
+
+        ground_format = re.compile(r"(snow|Snow|Rocky|rocky|pavement|Pavement|off-trail|Off-trail|Off trail|off trail)")
+        ground = ground_format.search(comments)
+        if ground:
+            activity['ground_type'] = ground.group().lower()
+        else:
+            activity['ground_type'] = "trail"
+
+        comment_format = re.compile(r"\w.*")
+        comments = comment_format.search(comments)
+        if comments:
+            activity['comments'] = comments.group()
+        else:
+            activity['comments'] = None
+
+
+def legacy_parse(description):
+    """Runs legacy_parse_description on a bare description, None if it raises."""
+    activity = {"description": description}
+    try:
+        legacy_parse_description(activity)
+    except ValueError:
+        return None
+    del activity["description"]
+    return activity
+
+
+def descriptions_per_second(parse_all, descriptions):
+    started = time.perf_counter()
+    parse_all(descriptions)
+    return len(descriptions) / (time.perf_counter() - started)
+
+
+def main(repeats):
+    descriptions = load_corpus() * repeats
+    legacy = descriptions_per_second(lambda ds: [legacy_parse(d) for d in ds], descriptions)
+    compiled = descriptions_per_second(lambda ds: list(parse_descriptions(ds)), descriptions)
+    print(f"{len(descriptions)} descriptions")
+    print(f"legacy   {legacy:>12,.0f}/s")
+    print(f"compiled {compiled:>12,.0f}/s  {compiled / legacy:.1f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
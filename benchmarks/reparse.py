@@ -0,0 +1,56 @@
+"""Times flask reparse over a throwaway database.
+
+Run from the repo root:
+
+    python -m benchmarks.reparse [rows] [workers ...]
+
+Fills a temporary database with {rows} activities (1M by default) whose
+descriptions come from the test corpus, then re-parses them with each
+worker count (1 and every core by default) and prints rows per second.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from application import create_app
+from application.db import get_db, init_db, close_connections
+from application.reparse import reparse
+from benchmarks.parse_descriptions import load_corpus
+
+
+def fill(rows):
+    corpus = load_corpus()
+    db = get_db()
+    with db:
+        db.executemany(
+            "INSERT INTO activities (strava_id, type, start_date, description) VALUES (?, 'Hike', '2020-01-01T08:00:00Z', ?)",
+            ((i, corpus[i % len(corpus)]) for i in range(rows))
+        )
+
+
+def main(rows, worker_counts):
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app({
+            'DATABASE': os.path.join(directory, 'benchmark.sqlite'),
+            'SHARED_CACHE': None,
+        })
+        with app.app_context():
+            init_db()
+            fill(rows)
+            print(f"{'workers':>7} {'rows':>9} {'changed':>9} {'seconds':>8} {'rows/s':>10}")
+            for workers in worker_counts:
+                started = time.perf_counter()
+                for stats in reparse(workers):
+                    pass
+                elapsed = time.perf_counter() - started
+                print(f"{workers:>7} {stats['read']:>9} {stats['changed']:>9} {elapsed:>8.1f} {stats['rows_per_second']:>10,.0f}")
+        close_connections()
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+        [int(workers) for workers in sys.argv[2:]] or sorted({1, os.cpu_count() or 1}),
+    )
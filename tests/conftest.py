@@ -3,7 +3,7 @@ import tempfile
 
 import pytest
 from application import create_app
-from application.db import get_db, init_db
+from application.db import get_db, init_db, close_connections
 
 with open(os.path.join(os.path.dirname(__file__), 'data.sql'), 'rb') as f:
     _data_sql = f.read().decode('utf8')
@@ -12,10 +12,12 @@ with open(os.path.join(os.path.dirname(__file__), 'data.sql'), 'rb') as f:
 @pytest.fixture
 def app():
     db_fd, db_path = tempfile.mkstemp()
+    cache_dir = tempfile.TemporaryDirectory()
 
     app = create_app({
         'TESTING': True,
         'DATABASE': db_path,
+        'SHARED_CACHE': os.path.join(cache_dir.name, 'cache.sqlite'),
     })
 
     with app.app_context():
@@ -24,8 +26,10 @@ def app():
 
     yield app
 
+    close_connections()
     os.close(db_fd)
     os.unlink(db_path)
+    cache_dir.cleanup()
 
 
 @pytest.fixture
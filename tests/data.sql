@@ -19,6 +19,8 @@ VALUES
   (4526779165, 6626.1, 6293, 10888, 126.7, 446.6, 17.2, "Hike", "2020-12-27T19:45:05Z", 1.053, "b12345678987654321", 10, 2, "trail", NULL),
   (4526779166, 18349, 3209, 3421, 310, 246.2, 9.2, "Walk", "2020-10-06T22:13:31Z", 1.246, "b12345678987654321", 5, 0, "snow", "walked with Jack");
 
+UPDATE activities SET start_ts = CAST(strftime('%s', start_date) AS INTEGER);
+
 
 
 INSERT INTO gear (strava_id, name)
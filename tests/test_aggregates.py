@@ -0,0 +1,125 @@
+"""Tests the SQL aggregation against the pandas code it replaced."""
+
+import datetime
+import random
+
+import pytest
+from application.aggregates import aggregate, activity_series
+from application.db import get_db
+from application.internal_api import convert_meters_miles, insert_activities
+from application.rollups import weekly_summary
+
+# pandas frequency matching each period's buckets
+PANDAS_FREQS = {"day": "D", "week": "W", "month": "MS", "year": "YS"}
+
+
+def pandas_summary(db, freq, start=None, end=None):
+    """The weekly summary as trainer.weekly_summary worked it out with pandas, for any {freq}."""
+    pd = pytest.importorskip("pandas")
+    df = pd.read_sql_query("SELECT * from activities", db)
+    df.start_date = pd.to_datetime(df.start_date, format="%Y-%m-%dT%H:%M:%SZ")
+    if start is not None:
+        df = df[df.start_date >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df.start_date < pd.Timestamp(end) + pd.Timedelta(days=1)]
+    df.distance = df.distance.apply(convert_meters_miles)
+    totals = df[["distance", "total_elevation_gain", "start_date"]]
+    totals = totals.groupby(pd.Grouper(key='start_date', freq=freq)).sum()
+
+    ave = df[["start_date", "knee_pain"]]
+    ave = ave.groupby(pd.Grouper(key='start_date', freq=freq)).mean().round(2)
+
+    weekly = totals.join(ave).fillna(0)
+
+    # figure out average weight per mile
+    df['ave_weight'] = (df['weight']*df['distance'])
+    weight = df[['ave_weight', 'start_date']].groupby(pd.Grouper(key='start_date', freq=freq)).sum()
+    weekly['weight'] = (weight['ave_weight']/weekly['distance']).fillna(0)
+
+    return [
+        {
+            "date": date.strftime('%Y-%m-%d'),
+            "distance": pytest.approx(row.distance, abs=1e-9),
+            "total_elevation_gain": pytest.approx(row.total_elevation_gain, abs=1e-9),
+            "knee_pain": pytest.approx(row.knee_pain, abs=1e-9),
+            "weight": pytest.approx(row.weight, abs=1e-9),
+        }
+        for date, row in weekly.iterrows()
+    ]
+
+
+@pytest.fixture
+def history(app):
+    """Two years of random activities, some without weight or knee pain, with gaps."""
+    rand = random.Random(15)
+    activities = []
+    day = datetime.datetime(2019, 3, 2, 6, 30)
+    for strava_id in range(1, 400):
+        day += datetime.timedelta(days=rand.choice([0, 1, 1, 2, 3, 9, 30]), hours=rand.randint(0, 23))
+        activities.append({
+            "id": strava_id,
+            "start_date": day.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "type": rand.choice(["Walk", "Hike"]),
+            "distance": rand.choice([0, rand.uniform(500, 30000)]),
+            "moving_time": 0, "elapsed_time": 0,
+            "total_elevation_gain": rand.uniform(0, 900),
+            "elev_high": 0, "elev_low": 0, "average_speed": 0, "gear_id": None,
+            "weight": rand.choice([None, rand.randint(0, 40)]),
+            "knee_pain": rand.choice([None, rand.randint(0, 10)]),
+            "ground_type": None, "comments": None,
+        })
+    with app.app_context():
+        get_db().execute("DELETE FROM activities")
+        insert_activities(activities)
+    return app
+
+
+@pytest.mark.parametrize("period", ["day", "week", "month", "year"])
+@pytest.mark.parametrize("start, end", [
+    (None, None),
+    ("2019-06-05", "2020-02-10"),
+    ("2020-01-01", None),
+])
+def test_matches_pandas(history, period, start, end):
+    """Every period and date range comes out the same as the pandas grouping."""
+    with history.app_context():
+        expected = pandas_summary(get_db(), PANDAS_FREQS[period], start, end)
+        assert aggregate(period, start, end) == expected
+
+
+def test_weekly_rollups_match_pandas(history):
+    """The trigger maintained weekly rollups agree with pandas too."""
+    with history.app_context():
+        assert weekly_summary() == pandas_summary(get_db(), "W")
+
+
+def test_empty_range(app):
+    with app.app_context():
+        assert aggregate("month", "1999-01-01", "1999-12-31") == []
+
+
+def test_unknown_period(app):
+    with app.app_context():
+        with pytest.raises(ValueError):
+            aggregate("fortnight")
+
+
+def test_activity_series(app):
+    with app.app_context():
+        assert activity_series("distance") == (
+            [1602022411, 1609098305], ["2020-10-06T22:13:31Z", "2020-12-27T19:45:05Z"], [11.4, 4.12]
+        )
+        assert activity_series("weight", start="2020-12-01") == ([1609098305], ["2020-12-27T19:45:05Z"], [10])
+        get_db().execute("UPDATE activities SET knee_pain = NULL WHERE strava_id = 4526779166")
+        get_db().commit()
+        assert activity_series("knee_pain")[2] == [2]
+
+
+def test_graphs_and_summary_ranges(client):
+    """The pages take period and date range arguments and reject unknown periods."""
+    assert client.get('/graphs?period=month&start=2020-10-01').status_code == 200
+    assert client.get('/graphs?period=fortnight').status_code == 400
+    response = client.get('/weekly-summary?start=2020-12-01&end=2020-12-31')
+    assert response.status_code == 200
+    assert b'2020-12-27' in response.data
+    assert b'2020-10-11' not in response.data
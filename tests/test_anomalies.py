@@ -0,0 +1,194 @@
+"""Tests flagging abnormal hikes as they're stored and rebuilding the flags."""
+
+import pytest
+from application.anomalies import fold, get_anomaly_state, rebuild_anomalies
+from application.db import get_db
+from application.internal_api import delete_activity, insert_activities, insert_activity
+
+
+def make_hike(template, strava_id, day, weight=20, distance=8000, elevation=300, speed=1.2):
+    return dict(
+        template, id=strava_id, start_date=f"2021-01-{day:02d}T08:00:00Z", weight=weight,
+        distance=distance, total_elevation_gain=elevation, average_speed=speed,
+    )
+
+
+@pytest.fixture
+def template(app):
+    """A hike to copy, the test activities are removed so each test starts from no history."""
+    with app.app_context():
+        db = get_db()
+        template = dict(db.execute('SELECT * FROM activities').fetchone())
+        with db:
+            db.execute('DELETE FROM activities')
+            rebuild_anomalies(db)
+        return template
+
+
+def rebuilt_flags(db):
+    """The flags a rebuild from scratch gives, to compare the incremental ones with."""
+    with db:
+        db.execute('UPDATE activities SET abnormal = 0, abnormal_reason = NULL')
+        rebuild_anomalies(db)
+    return get_flags()
+
+
+def get_flags():
+    return [
+        tuple(row) for row in get_db().execute(
+            'SELECT strava_id, abnormal, abnormal_reason FROM activities ORDER BY start_ts, id'
+        )
+    ]
+
+
+def test_flags_hikes_as_they_are_stored(app, template):
+    """Each new hike is compared with the ones before it, only increases are flagged."""
+    with app.app_context():
+        for day in range(1, 8):
+            insert_activity(make_hike(template, day, day, weight=20 + day % 2))
+        insert_activity(make_hike(template, 8, 8, weight=40, distance=4000))
+        insert_activity(make_hike(template, 9, 9, weight=20, distance=24000, speed=2.0))
+
+        flags = dict((strava_id, (abnormal, reason)) for strava_id, abnormal, reason in get_flags())
+        assert flags[7] == (0, None)
+        assert flags[8] == (1, "weight 40 lbs (usual 20.8)")
+        assert flags[9][0] == 1
+        assert flags[9][1].startswith("average speed 4.5 mph (usual 2.7); distance 14.9 mi (usual ")
+
+        state, last = get_anomaly_state(get_db())
+        assert state["weight"][0] == 9
+        assert last[1] == get_db().execute('SELECT id FROM activities WHERE strava_id = 9').fetchone()[0]
+
+
+def test_incremental_matches_rebuild(app, template):
+    """Folding hikes in one at a time gives the same flags and statistics as a rebuild."""
+    weights = [20, 22, 19, 25, 21, 35, 20, 22, 50, 23, 21, 24, 0, 45, 22]
+    with app.app_context():
+        for day, weight in enumerate(weights, start=1):
+            insert_activity(make_hike(template, day, day, weight=weight, elevation=300 + day * 30))
+        db = get_db()
+        incremental_flags = get_flags()
+        incremental_state = get_anomaly_state(db)
+        assert sum(flag[1] for flag in incremental_flags) >= 2
+
+        assert rebuilt_flags(db) == incremental_flags
+        state, last = get_anomaly_state(db)
+        assert last == incremental_state[1]
+        for metric, values in state.items():
+            assert values == pytest.approx(incremental_state[0][metric])
+
+
+def test_out_of_order_rebuilds(app, template):
+    """An older hike, an edit or a delete changes the history, so everything is re-flagged."""
+    with app.app_context():
+        for day in range(2, 9):
+            insert_activity(make_hike(template, day, day))
+        insert_activity(make_hike(template, 9, 9, weight=40))
+        assert get_flags()[-1][1] == 1
+
+        db = get_db()
+
+        # heavy packs early on make the last hike less unusual, 3 and 5 are edits
+        insert_activities([make_hike(template, day, day, weight=45) for day in (1, 3, 5)])
+        flags = get_flags()
+        assert flags[-1][1] == 0
+        assert get_anomaly_state(db)[0]["weight"][0] == 9
+        assert rebuilt_flags(db) == flags
+
+        insert_activity(make_hike(template, 5, 5, weight=20))
+        delete_activity(1)
+        delete_activity(3)
+        flags = get_flags()
+        assert flags[-1] == (9, 1, "weight 40 lbs (usual 20)")
+        assert get_anomaly_state(db)[0]["weight"][0] == 7
+        assert rebuilt_flags(db) == flags
+
+
+def test_editing_latest_hike_is_incremental(app, template, monkeypatch):
+    """An update of the newest hike, like a webhook sends, re-flags it from the saved statistics without a rebuild."""
+    with app.app_context():
+        for day in range(1, 8):
+            insert_activity(make_hike(template, day, day, weight=20 + day % 2))
+        insert_activity(make_hike(template, 8, 8, weight=40))
+        db = get_db()
+        state = get_anomaly_state(db)
+
+        monkeypatch.setattr('application.anomalies.rebuild_anomalies', lambda db: pytest.fail("rebuilt"))
+        # nothing the flags depend on changed
+        insert_activity(dict(make_hike(template, 8, 8, weight=40), gear_id="new boots"))
+        assert get_anomaly_state(db) == state
+        assert get_flags()[-1] == (8, 1, "weight 40 lbs (usual 20.8)")
+
+        # the pack weight was a typo
+        insert_activity(make_hike(template, 8, 8, weight=20))
+        assert get_flags()[-1] == (8, 0, None)
+        insert_activity(make_hike(template, 8, 8, weight=45, speed=1.3))
+        assert get_flags()[-1][1] == 1
+        edited = get_flags(), get_anomaly_state(db)
+
+        # deleting it goes back to the statistics of the hikes before it
+        delete_activity(8)
+        assert get_anomaly_state(db)[0]["weight"][0] == 7
+        deleted = get_flags(), get_anomaly_state(db)
+        monkeypatch.undo()
+
+        assert rebuilt_flags(db) == deleted[0]
+        assert_same_state(get_anomaly_state(db), deleted[1])
+        insert_activity(make_hike(template, 8, 8, weight=45, speed=1.3))
+        assert get_flags() == edited[0]
+        assert_same_state(get_anomaly_state(db), edited[1])
+
+
+def assert_same_state(state, expected):
+    assert state[1] == expected[1]
+    for metric, values in state[0].items():
+        assert values == pytest.approx(expected[0][metric])
+
+
+def test_migration_flags_stored_hikes(app, template, monkeypatch):
+    """Upgrading flags the hikes already stored, a new database doesn't rebuild anything."""
+    from application.db import init_db, migrate_db
+    with app.app_context():
+        for day in range(1, 8):
+            insert_activity(make_hike(template, day, day))
+        insert_activity(make_hike(template, 8, 8, weight=40))
+        db = get_db()
+        db.executescript(
+            "DROP INDEX activities_abnormal; DROP TABLE anomaly_state;"
+            " ALTER TABLE activities DROP COLUMN abnormal; ALTER TABLE activities DROP COLUMN abnormal_reason;"
+            " PRAGMA user_version = 10;"
+        )
+        assert migrate_db()[0] == 11
+        assert get_flags()[-1] == (8, 1, "weight 40 lbs (usual 20)")
+        assert get_anomaly_state(db)[0]["weight"][0] == 8
+
+        monkeypatch.setattr('application.db.get_rebuilds', lambda: pytest.fail("nothing to rebuild"))
+        init_db()
+
+
+def test_fold():
+    assert fold(10, 0, 0.0, 0.0, 0.5) == (1, 10, 0.0)
+    assert fold(20, 1, 10, 0.0, 0.5) == (2, 15, 25.0)
+
+
+def test_index_shows_flags(app, client, template):
+    with app.app_context():
+        for day in range(1, 8):
+            insert_activity(make_hike(template, day, day))
+        insert_activity(make_hike(template, 8, 8, elevation=900))
+    page = client.get('/').data.decode('utf8')
+    assert page.count('>Abnormal</span>') == 1
+    assert 'total elevation gain 2952.9 ft (usual 984.3)' in page
+
+    abnormal_only = client.get('/?abnormal=1').data.decode('utf8')
+    assert abnormal_only.count('<th scope="row">') == 1
+
+
+def test_rebuild_anomalies_command(app, runner, template):
+    with app.app_context():
+        for day in range(1, 8):
+            insert_activity(make_hike(template, day, day))
+        insert_activity(make_hike(template, 8, 8, weight=60))
+    app.config['ANOMALY_MIN_HIKES'] = 100
+    result = runner.invoke(args=['rebuild-anomalies'])
+    assert 'Flagged 0 abnormal hikes.' in result.output
@@ -0,0 +1,100 @@
+"""Tests the streaming activity exports."""
+
+import csv
+import gzip
+import io
+import json
+
+
+def test_ndjson_export(client):
+    """Every activity comes out as a JSON line, oldest first."""
+    response = client.get('/api/activities')
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'application/x-ndjson'
+    activities = [json.loads(line) for line in response.data.decode('utf8').splitlines()]
+    assert [a["strava_id"] for a in activities] == [4526779166, 4526779165]
+    assert activities[0]["comments"] == "walked with Jack"
+    assert activities[0]["distance"] == 18349
+
+
+def test_csv_export(client):
+    response = client.get('/api/activities.csv?fields=strava_id,start_date,weight')
+    assert response.mimetype == 'text/csv'
+    rows = list(csv.reader(io.StringIO(response.data.decode('utf8'))))
+    assert rows == [
+        ["strava_id", "start_date", "weight"],
+        ["4526779166", "2020-10-06T22:13:31Z", "5.0"],
+        ["4526779165", "2020-12-27T19:45:05Z", "10.0"],
+    ]
+
+
+def test_fields_and_filters(client):
+    response = client.get('/api/activities.ndjson?fields=strava_id,type&type=Hike')
+    assert [json.loads(line) for line in response.data.splitlines()] == [
+        {"strava_id": 4526779165, "type": "Hike"}
+    ]
+    response = client.get('/api/activities?fields=strava_id&start=2020-01-01&end=2020-10-31')
+    assert [json.loads(line) for line in response.data.splitlines()] == [{"strava_id": 4526779166}]
+
+    assert client.get('/api/activities?fields=strava_id,password').status_code == 400
+    assert client.get('/api/activities.xml').status_code == 404
+
+    empty = client.get('/api/activities.csv?fields=strava_id&type=Run')
+    assert empty.data == b'strava_id\r\n'
+    assert client.get('/api/activities?type=Run').data == b''
+
+
+def test_gzip(client):
+    plain = client.get('/api/activities.csv').data
+    response = client.get('/api/activities.csv', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == plain
+
+
+def test_streams_in_batches(app, client, monkeypatch):
+    """The export is sent a batch at a time and never loads the whole table."""
+    def fail():
+        raise AssertionError("loaded every activity")
+
+    monkeypatch.setattr('application.internal_api.get_all_activities', fail)
+    app.config['EXPORT_BATCH_SIZE'] = 1
+    response = client.get('/api/activities?fields=strava_id', buffered=False)
+    chunks = list(response.response)
+    assert chunks == [b'{"strava_id": 4526779166}\n', b'{"strava_id": 4526779165}\n']
+    response.close()
+
+
+def test_series(client):
+    series = client.get('/api/series').get_json()
+    assert series == {
+        "metric": "distance", "period": None, "total": 2,
+        "x": ["2020-10-06T22:13:31Z", "2020-12-27T19:45:05Z"], "y": [11.4, 4.12],
+    }
+    series = client.get('/api/series?metric=knee_pain&start=2020-12-01').get_json()
+    assert series["x"] == ["2020-12-27T19:45:05Z"] and series["y"] == [2]
+
+    weekly = client.get('/api/series?metric=total_elevation_gain&period=week').get_json()
+    assert weekly["total"] == 12
+    assert weekly["x"][0] == "2020-10-11" and weekly["y"][0] == 310
+
+    assert client.get('/api/series?metric=pace').status_code == 400
+    assert client.get('/api/series?period=fortnight').status_code == 400
+
+
+def test_series_points(app, client):
+    """Long histories are downsampled to the point budget, keeping both ends."""
+    from application.internal_api import insert_activities
+    from application.db import get_db
+    with app.app_context():
+        template = dict(get_db().execute('SELECT * FROM activities').fetchone())
+        insert_activities(
+            dict(template, id=i, start_date=f"2019-{i // 28 + 1:02d}-{i % 28 + 1:02d}T08:00:00Z", weight=i % 40)
+            for i in range(300)
+        )
+    series = client.get('/api/series?metric=weight&points=50').get_json()
+    assert series["total"] == 302
+    assert len(series["x"]) == 50
+    assert series["x"][0] == "2019-01-01T08:00:00Z"
+    assert series["x"][-1] == "2020-12-27T19:45:05Z"
+    assert len(client.get('/api/series?points=1').get_json()["x"]) == 3
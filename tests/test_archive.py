@@ -0,0 +1,56 @@
+"""Tests the raw response archive and re-parsing from it."""
+
+from copy import deepcopy
+
+from application.archive import archive_activity, archive_row, get_archived_activity, reparse_activities
+from application.internal_api import insert_activity, insert_activities, parse_description, get_specific_activity, handle_manual_activity_errors
+from application.db import get_db
+
+
+def test_archive_activity(app, Activity1):
+    """Assert the response is stored compressed and comes back exactly as Strava sent it."""
+    with app.app_context():
+        archive_activity(Activity1)
+        body = get_db().execute('SELECT body FROM activity_archive').fetchone()["body"]
+        assert body[:2] == b"\x1f\x8b"
+        assert get_archived_activity(Activity1["id"]) == Activity1
+        assert get_archived_activity(1) is None
+
+
+def test_archive_with_insert(app, Activity1):
+    """Assert a sync's responses are stored by the insert_activities call that writes the activities."""
+    with app.app_context():
+        activity = deepcopy(Activity1)
+        archived = [archive_row(activity)]
+        parse_description(activity)
+        handle_manual_activity_errors(activity)
+        insert_activities([activity], archived=archived)
+        assert not get_db().in_transaction
+        assert get_archived_activity(Activity1["id"]) == Activity1
+
+
+def test_reparse_activities(app, Activity1, monkeypatch):
+    """Assert the parsed columns are rebuilt from the archive without touching Strava."""
+    monkeypatch.setattr('application.strava_api.get_client', None)
+    with app.app_context():
+        archive_activity(Activity1)
+        activity = deepcopy(Activity1)
+        parse_description(activity)
+        handle_manual_activity_errors(activity)
+        # pretend an older parser got it wrong
+        activity["weight"] = 0
+        activity["comments"] = "garbled"
+        insert_activity(activity)
+
+        assert reparse_activities() == 1
+        reparsed = get_specific_activity(Activity1["id"])
+        assert reparsed["weight"] == 10
+        assert reparsed["knee_pain"] == 3
+        assert reparsed["comments"] == "Walked with Jack"
+
+
+def test_reparse_activities_command(runner, monkeypatch):
+    """Assert the command reparses and reports how many activities it touched."""
+    monkeypatch.setattr('application.archive.reparse_activities', lambda: 4)
+    result = runner.invoke(args=['reparse-activities'])
+    assert 'Re-parsed 4' in result.output
@@ -0,0 +1,143 @@
+"""Tests the data version based HTTP caching of the read only pages."""
+
+import pytest
+from application.cache import BodyCache
+from application.db import get_db
+from application.jobs import enqueue_job
+
+
+def fail(*args, **kwargs):
+    raise AssertionError("the page was rendered again")
+
+
+@pytest.mark.parametrize("path, rendered_by", [
+    ('/', 'application.trainer.activity_index_page'),
+    ('/weekly-summary', 'application.rollups.weekly_summary'),
+    ('/api/series', 'application.api.activity_series'),
+])
+def test_not_modified(client, monkeypatch, path, rendered_by):
+    """A repeat request for an unchanged page gets a 304 or the cached body without rendering it."""
+    response = client.get(path)
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'no-cache'
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+
+    monkeypatch.setattr(rendered_by, fail)
+    revalidated = client.get(path, headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b''
+    assert revalidated.headers['ETag'] == etag
+    assert client.get(path, headers={'If-Modified-Since': last_modified}).status_code == 304
+
+    # another client without the page gets the body from memory
+    repeat = client.get(path)
+    assert repeat.status_code == 200
+    assert repeat.data == response.data
+
+
+def test_writes_change_the_etag(app, client):
+    """Any write to activities changes the pages' ETags, job changes only the index's."""
+    index, summary = client.get('/').headers['ETag'], client.get('/weekly-summary').headers['ETag']
+
+    with app.app_context():
+        enqueue_job('sync')
+    assert client.get('/', headers={'If-None-Match': index}).status_code == 200
+    assert client.get('/weekly-summary', headers={'If-None-Match': summary}).status_code == 304
+    index = client.get('/').headers['ETag']
+
+    with app.app_context():
+        db = get_db()
+        with db:
+            db.execute("UPDATE activities SET knee_pain = 9 WHERE strava_id = 4526779166")
+    response = client.get('/', headers={'If-None-Match': index})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != index
+    assert client.get('/weekly-summary', headers={'If-None-Match': summary}).status_code == 200
+
+
+def test_query_strings_have_their_own_etag(client):
+    assert client.get('/').headers['ETag'] != client.get('/?type=Hike').headers['ETag']
+    assert client.get('/graphs?period=fortnight').status_code == 400
+    assert client.get('/graphs?period=fortnight').status_code == 400
+
+
+def test_body_cache():
+    cache = BodyCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+    off = BodyCache(0)
+    off.set('a', 1)
+    assert off.get('a') is None
+
+
+def test_shared_between_workers(app, client, monkeypatch):
+    """A page one worker rendered is served to another worker from the shared cache."""
+    from application import create_app
+    response = client.get('/weekly-summary')
+    other_worker = create_app({key: app.config[key] for key in ('TESTING', 'DATABASE', 'SHARED_CACHE')})
+    monkeypatch.setattr('application.rollups.weekly_summary', fail)
+    repeat = other_worker.test_client().get('/weekly-summary')
+    assert repeat.status_code == 200
+    assert repeat.data == response.data
+
+
+def test_single_flight(app):
+    """Only one of several concurrent misses computes the entry, the others wait for it."""
+    import threading
+    import time
+    from application.cache import get_or_compute_shared
+    calls = []
+    results = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.3)
+        return b'body', 'text/html'
+
+    def request_page():
+        with app.app_context():
+            results.append(get_or_compute_shared('key', 'page', compute))
+
+    threads = [threading.Thread(target=request_page) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [(b'body', 'text/html')] * 5
+
+
+def test_uncacheable_results_and_stale_locks(app):
+    """Nothing is stored for a None result, and a lock left by a dead worker is taken over."""
+    import time
+    from application.cache import get_or_compute_shared, get_shared, claim_shared, get_shared_cache_db
+    with app.app_context():
+        assert get_or_compute_shared('key', 'page', lambda: None) is None
+        assert get_shared('key') is None
+
+        assert claim_shared('key')
+        db = get_shared_cache_db()
+        with db:
+            db.execute('UPDATE cache_locks SET expires_at = ?', (time.time() - 1,))
+        assert get_or_compute_shared('key', 'page', lambda: (b'body', 'text/html')) == (b'body', 'text/html')
+        assert db.execute('SELECT COUNT(*) FROM cache_locks').fetchone()[0] == 0
+
+
+def test_shared_eviction(app):
+    """Older versions of a page are dropped and the least recently used pages go past the size limit."""
+    from application.cache import set_shared, get_shared
+    app.config['SHARED_CACHE_MAX_BYTES'] = 10
+    with app.app_context():
+        set_shared('v1', '/', b'1234', 'text/html')
+        set_shared('v2', '/', b'1234', 'text/html')
+        assert get_shared('v1') is None
+        set_shared('a', '/a', b'1234', 'text/html')
+        set_shared('b', '/b', b'1234', 'text/html')
+        assert get_shared('v2') is None
+        assert get_shared('a') == (b'1234', 'text/html')
+        assert get_shared('b') == (b'1234', 'text/html')
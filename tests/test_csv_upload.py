@@ -13,4 +13,58 @@ def test_select_last_start_date(app, Activity3):
         parse_description(activity)
         insert_activity(activity)
         db = get_db()
-        assert get_last_activity_date() == "2020-12-27T19:45:05Z"
\ No newline at end of file
+        assert get_last_activity_date() == "2020-12-27T19:45:05Z"
+
+def test_upload_craw_csv(app, tmp_path):
+    """Walks and Hikes from the csv are converted and inserted, other activities are skipped."""
+    from application.importers import upload_craw_csv
+    csv_file = tmp_path / "craw.csv"
+    csv_file.write_text(
+        "Activity Date,Activity Type,Distance in Miles,Comment\n"
+        "01/02/21,Hike,2.5,20 lbs; knee pain: 2; Rocky\n"
+        "01/03/21,Ride,10,\n"
+        "01/04/21,Walk,1,\n",
+        encoding="utf-8-sig"
+    )
+    with app.app_context():
+        stats = upload_craw_csv(str(csv_file), chunk_size=2)
+        assert (stats["read"], stats["inserted"], stats["skipped"]) == (3, 2, 0)
+        rows = get_db().execute(
+            "SELECT * FROM activities WHERE strava_id IS NULL ORDER BY start_date"
+        ).fetchall()
+        assert len(rows) == 2
+        assert rows[0]["start_date"] == "2021-01-02T00:00:00Z"
+        assert rows[0]["distance"] == 4023.35
+        assert rows[0]["weight"] == 20
+        assert rows[0]["knee_pain"] == 2
+        assert rows[0]["ground_type"] == "rocky"
+        assert rows[1]["type"] == "Walk"
+
+
+def test_upload_craw_csv_twice(app, tmp_path):
+    """Importing the same file again doesn't duplicate anything, even across chunks."""
+    from application.importers import upload_craw_csv
+    csv_file = tmp_path / "craw.csv"
+    csv_file.write_text(
+        "Activity Date,Activity Type,Distance in Miles,Comment\n"
+        + "".join(f"01/{day:02}/21,Hike,{day},\n" for day in range(1, 11))
+        + "01/01/21,Hike,1,same hike logged twice\n",
+        encoding="utf-8-sig"
+    )
+    with app.app_context():
+        stats = upload_craw_csv(str(csv_file), chunk_size=3)
+        assert (stats["read"], stats["inserted"], stats["skipped"]) == (11, 10, 1)
+        stats = upload_craw_csv(str(csv_file), chunk_size=4)
+        assert (stats["inserted"], stats["skipped"]) == (0, 11)
+        assert get_db().execute(
+            "SELECT COUNT(*) FROM activities WHERE strava_id IS NULL"
+        ).fetchone()[0] == 10
+
+
+def test_upload_craw_csv_command(runner, monkeypatch):
+    """The command reports progress after every chunk."""
+    def fake_import_craw_csv(filename, chunk_size):
+        yield {"read": 10, "inserted": 9, "skipped": 1, "rows_per_second": 1000}
+    monkeypatch.setattr('application.importers.import_craw_csv', fake_import_craw_csv)
+    result = runner.invoke(args=['upload-craw-csv', 'craw.csv'])
+    assert '9 inserted, 1 already stored' in result.output
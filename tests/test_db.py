@@ -8,17 +8,58 @@ from application.db import get_db
 
 def test_get_close_db(app):
     """Ensure get_db() returns the same connection each time 
-    it's called and that after context the connection is closed."""
+    it's called, that later contexts on the same thread reuse it
+    and that close_connections() closes it."""
+    from application.db import close_connections
     with app.app_context():
         db = get_db()
         assert db is get_db()
 
+    with app.app_context():
+        assert get_db() is db
+
+    close_connections()
     with pytest.raises(sqlite3.ProgrammingError) as e:
         db.execute('SELECT 1')
 
     assert 'closed' in str(e.value)
 
 
+def test_connection_tuning(app):
+    """Connections run in WAL mode with the configured pragmas, and read-only
+    connections refuse writes."""
+    with app.app_context():
+        db = get_db()
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert db.execute('PRAGMA synchronous').fetchone()[0] == 1
+        assert db.execute('PRAGMA temp_store').fetchone()[0] == 2
+
+        readonly = get_db(readonly=True)
+        assert readonly is not db
+        assert readonly.execute('SELECT COUNT(*) FROM activities').fetchone()[0] == 2
+        with pytest.raises(sqlite3.OperationalError):
+            readonly.execute('DELETE FROM activities')
+
+
+def test_reads_during_write(app):
+    """A reader still sees the last committed data while a write transaction is open."""
+    with app.app_context():
+        db = get_db()
+        db.execute('DELETE FROM activities')
+        assert db.in_transaction
+        assert get_db(readonly=True).execute('SELECT COUNT(*) FROM activities').fetchone()[0] == 2
+        db.rollback()
+
+
+def test_uncommitted_work_rolled_back(app):
+    """A request that errors out mid-transaction doesn't leave the reused connection in it."""
+    with app.app_context():
+        get_db().execute('DELETE FROM activities')
+    with app.app_context():
+        assert not get_db().in_transaction
+        assert get_db().execute('SELECT COUNT(*) FROM activities').fetchone()[0] == 2
+
+
 def test_init_db_command(runner, monkeypatch):
     """Ensures the init-db command line arguement calls
      the init_db function and outputs a message."""
@@ -50,3 +91,83 @@ def test_db_values(app):
 
         assert activity["type"] == "Hike"
         assert activity['type'] != "Walk"
+
+
+def test_migrate_db(app):
+    """Migrating a database created by the original schema keeps every row,
+    fills the new columns in and records the version reached."""
+    from application.db import migrate_db, get_migrations, get_db_version
+    with app.app_context():
+        db = get_db()
+        db.executescript(
+            "DROP TABLE activities; DROP TABLE sync_state; DROP TABLE sync_in_flight;"
+            "DROP TABLE jobs; DROP TABLE activity_archive; DROP TABLE rollups; DROP VIEW rollup_periods;"
+            "DROP TABLE data_versions; DROP TABLE activity_fields; DROP TABLE anomaly_state;"
+            "PRAGMA user_version = 0;"
+        )
+        assert migrate_db(target=1) == [1]
+        db.executescript(
+            "INSERT INTO activities (strava_id, start_date, type) VALUES"
+            " (1, '2020-12-27T19:45:05Z', 'Hike'), (1, '2020-12-27T19:45:05Z', 'Hike'),"
+            " (NULL, '2020-10-06T22:13:31Z', 'Walk'), (NULL, '2020-10-06T22:13:31Z', 'Walk');"
+        )
+        latest = get_migrations()[-1][0]
+        assert migrate_db() == list(range(2, latest + 1))
+        assert get_db_version() == latest
+
+        rows = db.execute("SELECT strava_id, start_ts FROM activities ORDER BY id").fetchall()
+        # the duplicate Strava activity is gone, manual uploads are untouched
+        assert [tuple(row) for row in rows] == [(1, 1609098305), (None, 1602022411), (None, 1602022411)]
+        # running it again is harmless
+        assert migrate_db() == []
+
+
+def test_migrate_db_command(runner, monkeypatch):
+    """The migrate-db command applies migrations and reports the version."""
+    monkeypatch.setattr('application.db.migrate_db', lambda: [7, 8])
+    monkeypatch.setattr('application.db.get_db_version', lambda: 8)
+    result = runner.invoke(args=['migrate-db'])
+    assert 'Applied 2 migrations' in result.output
+
+
+def test_init_db_rebuilds_schema(app):
+    """init-db wipes the data and leaves the schema at the latest version."""
+    from application.db import init_db, get_migrations, get_db_version
+    with app.app_context():
+        init_db()
+        assert get_db().execute("SELECT COUNT(*) FROM activities").fetchone()[0] == 0
+        assert get_db_version() == get_migrations()[-1][0]
+
+
+@pytest.mark.parametrize("query, params", [
+    ("SELECT * FROM activities ORDER BY start_ts DESC, id DESC", ()),
+    ("SELECT * FROM activities WHERE strava_id=?", (1,)),
+    ("SELECT start_date FROM activities WHERE strava_id IS NOT NULL ORDER BY start_ts DESC LIMIT 1", ()),
+    ("SELECT * FROM activities WHERE abnormal = 1 ORDER BY start_ts DESC, id DESC LIMIT 51", ()),
+])
+def test_queries_use_indexes(app, query, params):
+    """None of the main queries scan the whole activities table."""
+    with app.app_context():
+        plan = " ".join(
+            row["detail"] for row in get_db().execute("EXPLAIN QUERY PLAN " + query, params)
+        )
+        assert "USING" in plan and "INDEX" in plan
+        assert "TEMP B-TREE" not in plan
+
+
+@pytest.mark.parametrize("where, params", [
+    ("(start_ts, id) < (?, ?)", (1609098305, 2)),
+    ("start_ts IS NULL", ()),
+    ("start_ts IS NULL AND id < ?", (2,)),
+])
+def test_cursor_pages_search_the_index(app, where, params):
+    """A page after a cursor is a range search of the index, not a scan up to where it starts."""
+    with app.app_context():
+        plan = " ".join(
+            row["detail"] for row in get_db().execute(
+                f"EXPLAIN QUERY PLAN SELECT * FROM activities WHERE {where} ORDER BY start_ts DESC, id DESC LIMIT 51",
+                params
+            )
+        )
+        assert plan.startswith("SEARCH activities USING INDEX activities_start_ts")
+        assert "SCAN" not in plan and "TEMP B-TREE" not in plan
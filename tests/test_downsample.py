@@ -0,0 +1,24 @@
+"""Tests the LTTB downsampling."""
+
+import math
+
+from application.downsample import lttb
+
+
+def test_short_series_are_kept():
+    assert lttb([1, 2, 3], [1, 2, 3], 10) == [0, 1, 2]
+    assert lttb([1, 2, 3, 4], [1, 2, 3, 4], 2) == [0, 1, 2, 3]
+    assert lttb([], [], 10) == []
+
+
+def test_keeps_the_shape():
+    """Ends and spikes survive, and every bucket gives one point."""
+    x = list(range(1000))
+    y = [math.sin(i / 50) for i in x]
+    y[500] = 10
+    y[700] = -10
+    kept = lttb(x, y, 100)
+    assert len(kept) == 100
+    assert kept == sorted(set(kept))
+    assert kept[0] == 0 and kept[-1] == 999
+    assert 500 in kept and 700 in kept
@@ -17,3 +17,12 @@ def test_hello(client):
     """Check that hello route gets correct response data."""
     response = client.get('/hello')
     assert response.data == b'Hello, World!'
+
+
+def test_auto_migrate(tmp_path):
+    """With AUTO_MIGRATE on, a fresh database is migrated when the app starts."""
+    from application.db import get_db, get_db_version, get_migrations
+    app = create_app({'TESTING': True, 'DATABASE': str(tmp_path / 'db.sqlite'), 'AUTO_MIGRATE': True})
+    with app.app_context():
+        assert get_db_version() == get_migrations()[-1][0]
+        assert get_db().execute('SELECT COUNT(*) FROM activities').fetchone()[0] == 0
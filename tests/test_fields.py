@@ -0,0 +1,125 @@
+"""Tests the user defined description fields and querying them."""
+
+import json
+
+import pytest
+from application.db import get_db
+from application.fields import aggregate_field, get_activity_fields, get_fields, rebuild_fields
+from application.internal_api import insert_activities
+
+
+def add_activities(app):
+    """Adds three hikes that mention blisters, hip pain and temperature."""
+    with app.app_context():
+        template = dict(get_db().execute('SELECT * FROM activities').fetchone())
+        insert_activities([
+            dict(template, id=1, start_date="2021-03-01T08:00:00Z", description="blisters: 2, temp 40F"),
+            dict(template, id=2, start_date="2021-03-03T08:00:00Z", description="Blisters: 4 hip pain: 3"),
+            dict(template, id=3, start_date="2021-03-10T08:00:00Z", description="temperature: 55.5 F"),
+        ])
+
+
+def get_activity_id(strava_id):
+    return get_db().execute('SELECT id FROM activities WHERE strava_id = ?', (strava_id,)).fetchone()[0]
+
+
+def test_fields_stored_with_the_activity(app):
+    """Fields are written with the activity, replaced when it's updated and go when it's deleted."""
+    from application.internal_api import delete_activity
+    add_activities(app)
+    with app.app_context():
+        assert get_activity_fields(get_activity_id(1)) == {"blisters": 2, "temperature": 40.0}
+        assert get_activity_fields(get_activity_id(2)) == {"blisters": 4, "hip_pain": 3}
+
+        template = dict(get_db().execute('SELECT * FROM activities WHERE strava_id = 1').fetchone())
+        insert_activities([dict(template, id=1, description="hip pain: 1")])
+        assert get_activity_fields(get_activity_id(1)) == {"hip_pain": 1}
+
+        activity_id = get_activity_id(2)
+        delete_activity(2)
+        assert get_activity_fields(activity_id) == {}
+
+
+def test_filter_on_fields(app, client):
+    add_activities(app)
+    response = client.get('/api/activities?fields=strava_id&min_blisters=3')
+    assert [json.loads(line) for line in response.data.splitlines()] == [{"strava_id": 2}]
+    response = client.get('/api/activities?fields=strava_id&max_temperature=50&blisters=2')
+    assert [json.loads(line) for line in response.data.splitlines()] == [{"strava_id": 1}]
+    # unusable values are left out like the other filters
+    response = client.get('/api/activities?fields=strava_id&min_blisters=lots&type=Hike')
+    assert [json.loads(line) for line in response.data.splitlines()] == [
+        {"strava_id": 4526779165}, {"strava_id": 1}, {"strava_id": 2}, {"strava_id": 3}
+    ]
+    assert client.get('/?min_hip_pain=2').status_code == 200
+
+
+def test_aggregate_field(app):
+    add_activities(app)
+    with app.app_context():
+        assert aggregate_field("blisters") == [
+            {"date": None, "activities": 2, "sum": 6, "average": 3.0, "min": 2, "max": 4}
+        ]
+        weeks = aggregate_field("temperature", "week")
+        assert [(week["date"], week["average"]) for week in weeks] == [("2021-03-07", 40.0), ("2021-03-14", 55.5)]
+        import datetime
+        assert aggregate_field("blisters", "month", start=datetime.date(2021, 3, 2)) == [
+            {"date": "2021-03-01", "activities": 1, "sum": 4, "average": 4.0, "min": 4, "max": 4}
+        ]
+        assert aggregate_field("hip_pain", "day", end=datetime.date(2021, 1, 1)) == []
+
+
+def test_field_api(app, client):
+    add_activities(app)
+    assert client.get('/api/fields').get_json() == {"blisters": "int", "hip_pain": "int", "temperature": "float"}
+    summary = client.get('/api/fields/blisters?period=week').get_json()
+    assert summary["field"] == "blisters"
+    assert summary["buckets"] == [
+        {"date": "2021-03-07", "activities": 2, "sum": 6, "average": 3.0, "min": 2, "max": 4}
+    ]
+    assert client.get('/api/fields/mood').status_code == 404
+    assert client.get('/api/fields/blisters?period=fortnight').status_code == 400
+
+
+def test_rebuild_fields(app, runner):
+    """Changing DESCRIPTION_FIELDS and rebuilding parses every stored description again."""
+    add_activities(app)
+    app.config['DESCRIPTION_FIELDS'] = {"rain": (r"[rR]ain(?:ing|ed)?", "str"), "hip_pain": (r"hip pain: (\d+)", "int")}
+    with app.app_context():
+        db = get_db()
+        with db:
+            db.execute("UPDATE activities SET description = 'rained' WHERE strava_id = 3")
+        version = db.execute("SELECT version FROM data_versions WHERE name = 'activities'").fetchone()[0]
+        assert rebuild_fields(chunk_size=2) == (5, 2)
+        assert get_activity_fields(get_activity_id(2)) == {"hip_pain": 3}
+        assert get_activity_fields(get_activity_id(3)) == {"rain": "rained"}
+        assert db.execute("SELECT version FROM data_versions WHERE name = 'activities'").fetchone()[0] > version
+
+    result = runner.invoke(args=['rebuild-fields'])
+    assert 'Parsed 5 activities, stored 2 field values.' in result.output
+
+
+def test_migration_backfills_fields(app, client):
+    """Upgrading a database from before activity_fields parses the fields out of the stored descriptions."""
+    from application.db import migrate_db
+    with app.app_context():
+        db = get_db()
+        with db:
+            db.execute("UPDATE activities SET description = '20 lbs, blisters: 2, hip pain: 3' WHERE strava_id = 4526779165")
+        db.executescript("DROP TRIGGER activities_fields_delete; DROP TABLE activity_fields; PRAGMA user_version = 9;")
+        assert migrate_db()[0] == 10
+        assert get_activity_fields(get_activity_id(4526779165)) == {"blisters": 2, "hip_pain": 3}
+        # running it again is harmless
+        db.execute("PRAGMA user_version = 9")
+        assert migrate_db()[0] == 10
+        assert get_activity_fields(get_activity_id(4526779165)) == {"blisters": 2, "hip_pain": 3}
+    assert client.get('/api/fields/blisters').get_json()["buckets"][0]["sum"] == 2
+
+
+@pytest.mark.parametrize("name", ["weight", "type", "abnormal", "not a name", "class"])
+def test_field_names(app, name):
+    """Names taken by columns or query arguments are refused."""
+    app.config['DESCRIPTION_FIELDS'] = {name: (r"x(\d+)", "int")}
+    with app.app_context():
+        with pytest.raises(ValueError):
+            get_fields()
@@ -153,3 +153,109 @@ def test_handle_manual_activity_errors(Activity4):
     handle_manual_activity_errors(Activity4)
     assert Activity4["elev_high"] == 0
     assert Activity4["elev_low"] == 0
+
+
+def test_insert_activity_upserts(app, Activity1):
+    """Ensure inserting an activity that's already stored updates it instead of duplicating it."""
+    from application.db import get_db
+    activity = Activity1
+    with app.app_context():
+        parse_description(activity)
+        handle_manual_activity_errors(activity)
+        insert_activity(activity)
+        activity["distance"] = 30000
+        insert_activity(activity)
+
+        assert get_db().execute(
+            'SELECT COUNT(*) FROM activities WHERE strava_id = ?', (activity["id"],)
+        ).fetchone()[0] == 1
+        assert get_specific_activity(activity["id"])["distance"] == 30000
+
+
+def test_insert_activities(app, Activity1):
+    """Ensure a batch of activities is written in batch_size chunks with an outcome per row."""
+    from application.internal_api import insert_activities
+    parse_description(Activity1)
+    handle_manual_activity_errors(Activity1)
+    activities = [dict(Activity1, id=i) for i in range(5)]
+    # a manual upload without a strava_id and an update of a stored activity
+    activities.append(dict(Activity1, id=None))
+    activities.append(dict(Activity1, id=4526779165, distance=1))
+    # the same activity twice in one batch
+    activities.append(dict(Activity1, id=0, distance=2))
+    with app.app_context():
+        outcomes = insert_activities(iter(activities), batch_size=2)
+        assert outcomes == ["inserted"] * 6 + ["updated", "updated"]
+        assert len(get_all_activities()) == 8
+        assert get_specific_activity(4526779165)["distance"] == 1
+        assert get_specific_activity(0)["distance"] == 2
+        assert get_specific_activity(0)["start_ts"] == 1518792774
+        assert insert_activities([]) == []
+
+
+def test_get_activities_page(app, Activity1):
+    """Walking the cursors visits every activity once, in index order, a page at a time."""
+    from application.internal_api import insert_activities, get_activities_page
+    from application.db import get_db
+    parse_description(Activity1)
+    handle_manual_activity_errors(Activity1)
+    # several activities share a start time and a few have no start_ts at all
+    activities = [dict(Activity1, id=i, start_date=f"2021-01-0{i % 3 + 1}T08:00:00Z") for i in range(7)]
+    activities += [dict(Activity1, id=i, start_date="not a date") for i in (97, 98, 99)]
+    with app.app_context():
+        insert_activities(activities)
+        expected = [row["id"] for row in get_all_activities()]
+
+        # every page size, so pages start and end on both sides of the last start_ts
+        for page_size in range(1, 6):
+            seen, cursor = [], None
+            while True:
+                page, cursor = get_activities_page(cursor=cursor, page_size=page_size)
+                assert len(page) <= page_size
+                seen.extend(row["id"] for row in page)
+                if cursor is None:
+                    break
+            assert seen == expected
+        assert get_db().execute(
+            "SELECT start_ts FROM activities WHERE id = ?", (seen[-1],)
+        ).fetchone()[0] is None
+
+        page, cursor = get_activities_page(page_size=len(expected))
+        assert len(page) == len(expected) and cursor is None
+
+
+def test_get_activities_page_filters(app):
+    """Each filter is applied in SQL."""
+    from application.internal_api import get_activities_page
+    with app.app_context():
+        def strava_ids(**filters):
+            return [row["strava_id"] for row in get_activities_page(filters)[0]]
+
+        assert strava_ids() == [4526779165, 4526779166]
+        assert strava_ids(type="Walk") == [4526779166]
+        assert strava_ids(ground_type="trail") == [4526779165]
+        assert strava_ids(start="2020-12-27") == [4526779165]
+        assert strava_ids(end="2020-12-26") == [4526779166]
+        assert strava_ids(min_weight=6, max_weight=10) == [4526779165]
+        assert strava_ids(max_weight=5) == [4526779166]
+        assert strava_ids(min_knee_pain=1) == [4526779165]
+        assert strava_ids(type="Walk", min_knee_pain=1) == []
+        assert strava_ids(type=None) == [4526779165, 4526779166]
+
+
+def test_format_activities_for_view(app):
+    """The batch formatter gives exactly what format_activity_for_view gives row by row."""
+    from application.internal_api import format_activities_for_view
+    from benchmarks.format_activities import make_activities
+    activities = make_activities(3000)
+    # values the fast paths hand back to the convert_* helpers
+    activities.append(dict(activities[0], moving_time=90000, elapsed_time=2.5, average_speed=None,
+                           distance=None, elev_low=0, start_date="2020-02-29T01:02:03Z"))
+    activities.append(dict(activities[0], average_speed=-1, start_date="2021-1-5T01:02:03Z"))
+    with app.app_context():
+        activities.extend(get_all_activities())
+        assert format_activities_for_view(activities) == [format_activity_for_view(a) for a in activities]
+        assert format_activities_for_view([]) == []
+
+    with pytest.raises(ValueError):
+        format_activities_for_view([dict(activities[0], start_date="2021-02-29T01:02:03Z")])
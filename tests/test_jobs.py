@@ -0,0 +1,92 @@
+"""Tests the background job queue and worker."""
+
+from application.jobs import (
+    enqueue_job,
+    get_job,
+    run_next_job,
+    requeue_stale_jobs,
+    enqueue_due_sync,
+    work,
+)
+
+
+def test_enqueue_job_dedupes(app):
+    """Assert a second request for the same kind of job joins the one already queued."""
+    with app.app_context():
+        job_id = enqueue_job("sync")
+        assert enqueue_job("sync") == job_id
+        assert get_job(job_id)["status"] == "queued"
+        # jobs for different keys don't collide
+        assert enqueue_job("activity", 1) != enqueue_job("activity", 2)
+        assert enqueue_job("activity", 1) == enqueue_job("activity", "1")
+
+
+def test_run_next_job(app, monkeypatch):
+    """Assert queued jobs are run once and marked done, and a new job can be queued after."""
+    calls = []
+    monkeypatch.setattr("application.jobs.get_job_handlers", lambda: {"sync": lambda key: calls.append(1)})
+    with app.app_context():
+        job_id = enqueue_job("sync")
+        assert run_next_job()["id"] == job_id
+        assert run_next_job() is None
+        assert calls == [1]
+        assert get_job(job_id)["status"] == "done"
+        assert enqueue_job("sync") != job_id
+
+
+def test_run_next_job_failure(app, monkeypatch):
+    """Assert a job that raises is marked failed with the error."""
+    def broken(key):
+        raise ValueError("no tokens")
+    monkeypatch.setattr("application.jobs.get_job_handlers", lambda: {"sync": broken})
+    with app.app_context():
+        job_id = enqueue_job("sync")
+        run_next_job()
+        job = get_job(job_id)
+        assert job["status"] == "failed"
+        assert "no tokens" in job["error"]
+
+
+def test_requeue_stale_jobs(app):
+    """Assert jobs left running by a dead worker go back in the queue."""
+    from application.jobs import claim_next_job
+    with app.app_context():
+        job_id = enqueue_job("sync")
+        claim_next_job()
+        assert get_job(job_id)["status"] == "running"
+        requeue_stale_jobs()
+        assert get_job(job_id)["status"] == "queued"
+
+
+def test_enqueue_due_sync(app, monkeypatch):
+    """Assert a sync is queued only if none was queued within the interval, even once it's finished."""
+    monkeypatch.setattr("application.jobs.get_job_handlers", lambda: {"sync": lambda key: None})
+    with app.app_context():
+        enqueue_due_sync(3600)
+        run_next_job()
+        enqueue_due_sync(3600)
+        assert run_next_job() is None
+        from application.db import get_db
+        assert get_db().execute("SELECT COUNT(*) FROM jobs WHERE kind = 'sync'").fetchone()[0] == 1
+
+
+def test_work_schedules_sync(app, monkeypatch):
+    """Assert the worker queues and runs a sync when none has run recently, but not twice."""
+    calls = []
+    monkeypatch.setattr("application.jobs.get_job_handlers", lambda: {"sync": lambda key: calls.append(1)})
+    with app.app_context():
+        work(0, 3600, once=True)
+        work(0, 3600, once=True)
+        assert calls == [1]
+
+
+def test_sync_route_enqueues(client, app):
+    """Assert the refresh button queues a sync and returns without running it."""
+    response = client.post("/sync", headers={"Accept": "application/json"})
+    assert response.status_code == 202
+    job = response.get_json()
+    assert job["status"] == "queued"
+
+    assert client.post("/sync").status_code == 302
+    assert client.get(f"/jobs/{job['id']}").get_json()["kind"] == "sync"
+    assert client.get("/jobs/1000").status_code == 404
@@ -1,5 +1,5 @@
 # Local imports...
-from application.strava_api import get_detailed_activity, get_page_of_activities, download_new_activities
+from application.strava_api import get_detailed_activity, get_page_of_activities, download_new_activities, StravaClient
 
 # Third-party imports...
 import pytest
@@ -25,7 +25,7 @@ class TestRequestsGet(object):
 
     @classmethod
     def setup_class(cls):
-        cls.mock_get_patcher = patch("application.strava_api.requests.get")
+        cls.mock_get_patcher = patch("application.strava_api.requests.Session.request")
         cls.mock_get = cls.mock_get_patcher.start()
 
     @classmethod
@@ -34,38 +34,99 @@ class TestRequestsGet(object):
 
     def test_get_detailed_activity(self, Activity1, StravaTokens1):
         """Assert returns detailed activity object."""
-        self.mock_get.return_value = Mock(ok=True)
+        self.mock_get.return_value = Mock(ok=True, status_code=200, headers={})
         self.mock_get.return_value.json.return_value = Activity1
         strava_tokens = StravaTokens1
         response = get_detailed_activity(12345678987654321, strava_tokens)
+        args, kwargs = self.mock_get.call_args
+        assert args == ("GET", "https://www.strava.com/api/v3/activities/12345678987654321")
+        assert kwargs["headers"]["Authorization"] == "Bearer " + strava_tokens["access_token"]
         assert response.ok is True
         assert response.json() == Activity1
 
     def test_get_page_of_activities_return_all(self, StravaTokens1, Activity1, Activity2, Activity3):
         """Assert makes correct call if no date is provided."""
-        self.mock_get.return_value = Mock(ok=True)
+        self.mock_get.return_value = Mock(ok=True, status_code=200, headers={})
         self.mock_get.return_value.json.return_value = [Activity1, Activity2, Activity3]
         strava_tokens = StravaTokens1
         response = get_page_of_activities(None, 1, strava_tokens)
-        assert self.mock_get.called_with("https://www.strava.com/api/v3/activities?access_token="
-            + strava_tokens["access_token"]
-            + "&per_page=200&page=1")
+        args, kwargs = self.mock_get.call_args
+        assert args == ("GET", "https://www.strava.com/api/v3/activities")
+        assert kwargs["params"] == {"per_page": 200, "page": 1}
         assert response.ok is True
         assert response.json() == [Activity1, Activity2, Activity3]
 
     def test_get_page_of_activities_return_after_date(self, StravaTokens1, Activity1, Activity2, Activity3):
         """Assert makes correct call if date is provided."""
-        self.mock_get.return_value = Mock(ok=True)
+        self.mock_get.return_value = Mock(ok=True, status_code=200, headers={})
         self.mock_get.return_value.json.return_value = [Activity1, Activity2, Activity3]
         strava_tokens = StravaTokens1
         response = get_page_of_activities("2018-02-16T14:52:54Z", 1, strava_tokens)
-        assert self.mock_get.called_with("https://www.strava.com/api/v3/activities?access_token="
-            + strava_tokens["access_token"]
-            + "&after=2018-02-16T14:52:54Z&per_page=200&page=1")
+        args, kwargs = self.mock_get.call_args
+        assert kwargs["params"] == {"per_page": 200, "page": 1, "after": 1518792774}
         assert response.ok is True
         assert response.json() == [Activity1, Activity2, Activity3]
 
-def test_download_activities(monkeypatch, StravaTokens1, Activity1, Activity2, Activity3):
+class TestStravaClientRetries(object):
+
+    @staticmethod
+    def response(status_code, headers=None):
+        return Mock(status_code=status_code, headers=headers or {})
+
+    def test_retries_server_errors(self, monkeypatch):
+        """Assert 5xx responses are retried until a good response comes back."""
+        client = StravaClient(base_url="http://strava.test", backoff=0)
+        responses = [self.response(503), self.response(502), self.response(200)]
+        monkeypatch.setattr(client.session, "request", Mock(side_effect=responses))
+        assert client.request("GET", "/api/v3/activities").status_code == 200
+        assert client.session.request.call_count == 3
+
+    def test_gives_up_after_max_retries(self, monkeypatch):
+        """Assert the last bad response is returned once retries run out."""
+        client = StravaClient(base_url="http://strava.test", max_retries=2, backoff=0)
+        monkeypatch.setattr(client.session, "request", Mock(return_value=self.response(500)))
+        assert client.request("GET", "/api/v3/activities").status_code == 500
+        assert client.session.request.call_count == 3
+
+    def test_does_not_retry_client_errors(self, monkeypatch):
+        """Assert a 404 is returned straight away."""
+        client = StravaClient(base_url="http://strava.test", backoff=0)
+        monkeypatch.setattr(client.session, "request", Mock(return_value=self.response(404)))
+        assert client.request("GET", "/api/v3/activities/1").status_code == 404
+        assert client.session.request.call_count == 1
+
+    def test_retries_timeouts(self, monkeypatch):
+        """Assert timeouts are retried and raised once retries run out."""
+        import requests
+        client = StravaClient(base_url="http://strava.test", max_retries=1, backoff=0)
+        monkeypatch.setattr(client.session, "request", Mock(side_effect=requests.Timeout))
+        with pytest.raises(requests.Timeout):
+            client.request("GET", "/api/v3/activities")
+        assert client.session.request.call_count == 2
+
+    def test_authorization_code_not_retried(self, monkeypatch):
+        """Assert the single use authorization code is sent once, refreshing tokens is still retried."""
+        import requests
+        from application.strava_api import get_initial_token, refresh_tokens
+        client = StravaClient(base_url="http://strava.test", max_retries=2, backoff=0)
+        monkeypatch.setattr("application.strava_api.get_client", lambda: client)
+        monkeypatch.setattr(client.session, "request", Mock(side_effect=requests.Timeout))
+        with pytest.raises(requests.Timeout):
+            get_initial_token("code")
+        assert client.session.request.call_count == 1
+
+        monkeypatch.setattr(client.session, "request", Mock(return_value=self.response(503)))
+        assert refresh_tokens({"refresh_token": "token"}).status_code == 503
+        assert client.session.request.call_count == 3
+
+    def test_retry_delay(self):
+        """Assert backoff grows exponentially with jitter and honors Retry-After."""
+        client = StravaClient(backoff=1)
+        assert 4 <= client.retry_delay(2) <= 5
+        assert client.retry_delay(0, self.response(429, {"Retry-After": "7"})) == 7
+
+
+def test_download_activities(app, monkeypatch, StravaTokens1, Activity1, Activity2, Activity3):
     """Assert that download activities stops downloading if it recieves an empty list. Also a monkeypatch flex CAUSE I FIGURED IT OUT"""
     class MockResponsePage1:
         status_code = 200
@@ -87,6 +148,8 @@ def test_download_activities(monkeypatch, StravaTokens1, Activity1, Activity2, A
     
     class Recorder:
         called = 0
+        inserted = []
+        archived = []
     
     def fake_get_tokens():
         return StravaTokens1
@@ -104,15 +167,96 @@ def test_download_activities(monkeypatch, StravaTokens1, Activity1, Activity2, A
     def fake_get_last_activity_date():
         return "Hi I'm not a date"
 
-    def fake_insert_activity(activity):
-        pass
+    def fake_insert_activities(activities, archived=()):
+        Recorder.inserted.extend(activities)
+        Recorder.archived.extend(archived)
 
     monkeypatch.setattr('application.strava_api.get_page_of_activities', fake_get_page_of_activities)
     monkeypatch.setattr('application.strava_api.get_tokens', fake_get_tokens)
     monkeypatch.setattr('application.strava_api.get_detailed_activity', fake_get_detailed_activity)
     monkeypatch.setattr('application.strava_api.get_last_activity_date', fake_get_last_activity_date)
-    monkeypatch.setattr('application.strava_api.insert_activity', fake_insert_activity)
+    monkeypatch.setattr('application.strava_api.insert_activities', fake_insert_activities)
 
-    download_new_activities()
+    with app.app_context():
+        download_new_activities()
 
     assert Recorder.called == 2
+    # each activity's response is archived in the same insert_activities call
+    assert Recorder.inserted
+    assert [strava_id for strava_id, body in Recorder.archived] == [activity["id"] for activity in Recorder.inserted]
+
+
+def test_download_activities_inserts_in_date_order(app, monkeypatch, StravaTokens1, Activity1, Activity3):
+    """Assert detailed activities are fetched concurrently but inserted in start_date order,
+    and that the next page is requested before the previous page is inserted."""
+    newer = dict(Activity3, id=3)
+    older = dict(Activity1, id=1)
+    walk = dict(Activity1, id=2, type="Ride")
+    events = []
+
+    class MockResponse:
+        status_code = 200
+        def __init__(self, body):
+            self.body = body
+        def json(self):
+            return self.body
+
+    def fake_get_page_of_activities(last_activity_date, page, strava_tokens):
+        events.append(("page", page))
+        return MockResponse([newer, walk, older] if page == 1 else [])
+
+    def fake_get_detailed_activity(id, strava_tokens):
+        return MockResponse({1: older, 3: newer}[id])
+
+    def fake_insert_activities(activities, archived=()):
+        events.extend(("insert", activity["id"]) for activity in activities)
+
+    monkeypatch.setattr('application.strava_api.get_page_of_activities', fake_get_page_of_activities)
+    monkeypatch.setattr('application.strava_api.get_tokens', lambda: StravaTokens1)
+    monkeypatch.setattr('application.strava_api.get_detailed_activity', fake_get_detailed_activity)
+    monkeypatch.setattr('application.strava_api.get_last_activity_date', lambda: None)
+    monkeypatch.setattr('application.strava_api.insert_activities', fake_insert_activities)
+
+    with app.app_context():
+        download_new_activities(max_workers=2)
+
+    assert events == [("page", 1), ("page", 2), ("insert", 1), ("insert", 3)]
+
+
+def test_download_activities_resumes(app, monkeypatch, caplog, StravaTokens1, Activity1, Activity3):
+    """Assert an interrupted sync resumes from its checkpoint: in flight activities are
+    re-fetched, paging restarts at the saved page with the saved after date, and the
+    checkpoint is cleared once the sync finishes."""
+    from application.strava_api import get_sync_state, get_in_flight_activities, save_sync_state
+    pages = []
+    inserted = []
+
+    class MockResponse:
+        status_code = 200
+        def __init__(self, body):
+            self.body = body
+        def json(self):
+            return self.body
+
+    def fake_get_page_of_activities(last_activity_date, page, strava_tokens):
+        pages.append((last_activity_date, page))
+        return MockResponse([dict(Activity3, id=3)] if page == 3 else [])
+
+    def fake_get_detailed_activity(id, strava_tokens):
+        return MockResponse(dict(Activity1 if id == 1 else Activity3, id=id))
+
+    monkeypatch.setattr('application.strava_api.get_page_of_activities', fake_get_page_of_activities)
+    monkeypatch.setattr('application.strava_api.get_tokens', lambda: StravaTokens1)
+    monkeypatch.setattr('application.strava_api.get_detailed_activity', fake_get_detailed_activity)
+    monkeypatch.setattr('application.strava_api.insert_activities', lambda acts, archived=(): inserted.extend(a["id"] for a in acts))
+
+    with app.app_context():
+        save_sync_state("2019-01-01T00:00:00Z", 3, [(1, "2019-02-01T00:00:00Z")])
+        caplog.set_level("INFO", logger=app.logger.name)
+        download_new_activities()
+        assert "Resuming sync at page 3." in caplog.messages
+
+        assert pages == [("2019-01-01T00:00:00Z", 3), ("2019-01-01T00:00:00Z", 4)]
+        assert inserted == [1, 3]
+        assert get_sync_state() is None
+        assert get_in_flight_activities() == []
@@ -0,0 +1,67 @@
+"""Tests the compiled description parser against the corpus and the parser it replaced."""
+
+import pytest
+from application.parser import compile_fields, parse, parse_descriptions, parse_fields
+from benchmarks.parse_descriptions import legacy_parse, load_corpus
+
+
+@pytest.mark.parametrize("description", load_corpus())
+def test_matches_legacy_parser(description):
+    """Every corpus description parses the same as before, except where the old parser crashed."""
+    expected = legacy_parse(description)
+    if expected is None:
+        # float("") on "0 lbs"
+        expected = {"weight": 0, "knee_pain": 0, "ground_type": "trail", "comments": None}
+    assert parse(description) == expected
+
+
+def test_matched_text_is_not_a_pattern():
+    """The old parser removed "25.5 lbs" as a regex, so "2545 lbs" went from the comments too."""
+    description = "25.5 lbs, 2545 lbs"
+    assert legacy_parse(description)["comments"] is None
+    assert parse(description) == {"weight": 25.5, "knee_pain": 0, "ground_type": "trail", "comments": "2545 lbs"}
+
+
+def test_parse():
+    assert parse("25 lbs pack, knee pain: 2, rocky trail up the ridge") == {
+        "weight": 25, "knee_pain": 2, "ground_type": "rocky", "comments": "rocky trail up the ridge",
+    }
+    assert parse("Off trail with 05 lbs") == {
+        "weight": 5, "knee_pain": 0, "ground_type": "off trail", "comments": "Off trail with ",
+    }
+
+
+def test_parse_descriptions():
+    descriptions = ["10 lbs; knee pain: 3; Walked with Jack", None, "Walked with Jack in Snow"]
+    parsed = list(parse_descriptions(iter(descriptions)))
+    assert parsed == [parse(description) for description in descriptions]
+    assert parsed[1] is not parsed[0]
+    parsed[1]["weight"] = 99
+    assert parse(None)["weight"] == 0
+
+
+def test_parse_fields():
+    """Every field comes out of one scan with its type, the first value found wins."""
+    compiled = compile_fields({
+        "blisters": (r"[bB]listers?:\s?(\d+)", "int"),
+        "temperature": (r"[tT]emp\s?(-?\d+)\s?F", "float"),
+        "rain": (r"[rR]ain(?:ing|ed)?", "str"),
+        "water": (r"water(?: (\d+))?", "int"),
+    })
+    assert parse_fields("temp 40F, blisters: 2, rained. Blisters: 5", compiled) == {
+        "blisters": 2, "temperature": 40.0, "rain": "rained",
+    }
+    # a value that doesn't convert is skipped and a later one is used
+    assert parse_fields("water, water 3", compiled) == {"water": 3}
+    assert parse_fields(None, compiled) == {}
+    assert parse_fields("blisters: 1", compile_fields({})) == {}
+
+
+@pytest.mark.parametrize("fields", [
+    {"blisters": (r"(\d+", "int")},
+    {"blisters": (r"(?P<count>\d+)", "int")},
+    {"blisters": (r"\d+", "date")},
+])
+def test_compile_fields_errors(fields):
+    with pytest.raises(ValueError):
+        compile_fields(fields)
@@ -0,0 +1,145 @@
+"""Tests the Strava rate limiter, including against a fake local Strava server."""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from application.rate_limit import RateLimiter, RateLimitExceeded, SHORT_WINDOW
+from application.strava_api import StravaClient
+
+
+class FakeClock:
+    """Stands in for time.time/time.sleep so the tests never actually wait."""
+
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+# start exactly at the beginning of a 15 minute window
+WINDOW_START = SHORT_WINDOW * 1777778
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(WINDOW_START)
+
+
+@pytest.fixture
+def fake_strava(clock):
+    """Local server that enforces a 5 request / 15 minute budget on the fake clock
+    and reports it with Strava's rate limit headers."""
+    counts = {}
+    seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            window = clock.time() // SHORT_WINDOW
+            counts[window] = counts.get(window, 0) + 1
+            status = 429 if counts[window] > 5 else 200
+            seen.append(status)
+            self.send_response(status)
+            self.send_header("X-RateLimit-Limit", "5,1000")
+            self.send_header("X-RateLimit-Usage", f"{counts[window]},{sum(counts.values())}")
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b"[]")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", seen
+    server.shutdown()
+    server.server_close()
+
+
+def test_burst_then_spaced(clock):
+    """Assert requests burst until the bucket is empty and are then spread over the window."""
+    limiter = RateLimiter(short_limit=10, daily_limit=1000, burst=2, clock=clock.time, sleep=clock.sleep)
+    for _ in range(3):
+        limiter.acquire()
+    # 8 requests left to spread over the whole 900 second window
+    assert clock.sleeps == [pytest.approx(900 / 8)]
+    assert limiter.remaining() == {"short": 7, "daily": 997}
+
+
+def test_update_from_headers(clock):
+    """Assert limits and usage are taken from Strava's headers."""
+    limiter = RateLimiter(clock=clock.time, sleep=clock.sleep)
+    limiter.update({"X-RateLimit-Limit": "200,2000", "X-RateLimit-Usage": "150,1200"})
+    assert limiter.remaining() == {"short": 50, "daily": 800}
+    # missing or garbled headers are ignored
+    limiter.update({})
+    limiter.update({"X-RateLimit-Limit": "abc", "X-RateLimit-Usage": "1,2"})
+    assert limiter.remaining() == {"short": 50, "daily": 800}
+
+
+def test_waits_for_next_window(clock):
+    """Assert a spent 15-minute budget pauses until the next window and then resumes."""
+    limiter = RateLimiter(clock=clock.time, sleep=clock.sleep)
+    clock.now += 100
+    limiter.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "100,400"})
+    limiter.acquire()
+    assert clock.sleeps == [SHORT_WINDOW - 100]
+    assert limiter.remaining() == {"short": 99, "daily": 599}
+
+
+def test_daily_budget_raises(clock):
+    """Assert a spent daily budget stops the caller instead of sleeping for hours."""
+    limiter = RateLimiter(clock=clock.time, sleep=clock.sleep)
+    limiter.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "10,1000"})
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire()
+    assert clock.sleeps == []
+
+
+def test_client_against_fake_server(clock, fake_strava):
+    """Assert the client never gets a 429 from a server enforcing a small budget."""
+    url, seen = fake_strava
+    limiter = RateLimiter(short_limit=100, daily_limit=1000, burst=5, clock=clock.time, sleep=clock.sleep)
+    client = StravaClient(base_url=url, backoff=0, rate_limiter=limiter)
+    for _ in range(8):
+        assert client.request("GET", "/api/v3/activities", "token").status_code == 200
+    assert seen == [200] * 8
+    # the headers taught the limiter about the 5 request budget and it paused for the next window
+    assert clock.now >= WINDOW_START + SHORT_WINDOW
+    assert limiter.remaining() == {"short": 2, "daily": 992}
+
+
+def test_update_while_waiting(clock):
+    """Assert headers coming in while a request waits for budget aren't blocked, and the wait is re-checked after."""
+    sleeping, wake = threading.Event(), threading.Event()
+
+    def sleep(seconds):
+        clock.sleeps.append(seconds)
+        sleeping.set()
+        wake.wait(5)
+
+    limiter = RateLimiter(clock=clock.time, sleep=sleep)
+    limiter.update({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "100,400"})
+    waiting = threading.Thread(target=limiter.acquire)
+    waiting.start()
+    assert sleeping.wait(5)
+
+    # the server says the budget isn't spent after all
+    done = threading.Thread(target=limiter.update, args=({"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "50,400"},))
+    done.start()
+    done.join(1)
+    assert not done.is_alive()
+    assert limiter.remaining() == {"short": 50, "daily": 600}
+
+    wake.set()
+    waiting.join(5)
+    assert not waiting.is_alive()
+    assert clock.sleeps == [SHORT_WINDOW]
+    assert limiter.remaining() == {"short": 49, "daily": 599}
@@ -0,0 +1,110 @@
+"""Tests re-parsing the stored descriptions with flask reparse."""
+
+import pytest
+from application.db import get_db
+from application.reparse import reparse, format_change
+
+
+def add_descriptions(app):
+    """Gives the test activities descriptions the stored columns disagree with."""
+    with app.app_context():
+        db = get_db()
+        with db:
+            db.execute(
+                "UPDATE activities SET description = '25 lbs pack, Knee Pain: 4, rocky. long day'"
+                " WHERE strava_id = 4526779165"
+            )
+            # already parsed correctly, nothing to write
+            db.execute(
+                "UPDATE activities SET description = '5 lbs snow, walked with Jack', comments = 'snow, walked with Jack'"
+                " WHERE strava_id = 4526779166"
+            )
+            db.execute(
+                "INSERT INTO activities (strava_id, type, weight, knee_pain, ground_type, comments)"
+                " VALUES (1, 'Hike', 40, 0, 'trail', 'no description kept')"
+            )
+
+
+def get_parsed(strava_id):
+    return tuple(get_db().execute(
+        'SELECT weight, knee_pain, ground_type, comments FROM activities WHERE strava_id = ?',
+        (strava_id,)
+    ).fetchone())
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_reparse(app, workers):
+    """Only changed rows are written, rows without a description are left alone."""
+    add_descriptions(app)
+    with app.app_context():
+        stats = list(reparse(workers=workers, chunk_size=1))
+        assert [s["read"] for s in stats] == [1, 2]
+        assert stats[-1]["changed"] == 1
+        assert stats[0]["changes"] == [
+            (1, (10.0, 2, "trail", None), (25.0, 4, "rocky", "rocky. long day"))
+        ]
+        assert get_parsed(4526779165) == (25.0, 4, "rocky", "rocky. long day")
+        assert get_parsed(4526779166) == (5.0, 0, "snow", "snow, walked with Jack")
+        assert get_parsed(1) == (40.0, 0, "trail", "no description kept")
+
+
+def test_reparse_command(app, runner):
+    """The dry run prints a diff and writes nothing, the real run reports rows/s."""
+    add_descriptions(app)
+    result = runner.invoke(args=['reparse', '--dry-run', '--workers', '1'])
+    assert "activity 1: weight 10.0 -> 25.0, knee_pain 2 -> 4, ground_type 'trail' -> 'rocky'" in result.output
+    assert 'Re-parsed 2 activities, 1 would change' in result.output
+    with app.app_context():
+        assert get_parsed(4526779165) == (10.0, 2, "trail", None)
+
+    result = runner.invoke(args=['reparse', '--workers', '1'])
+    assert 'rows/s' in result.output
+    assert 'Re-parsed 2 activities, 1 changed' in result.output
+    with app.app_context():
+        assert get_parsed(4526779165)[0] == 25.0
+
+
+def test_format_change():
+    assert format_change(3, (0, 1, "trail", "x"), (10.0, 1, "trail", None)) == (
+        "activity 3: weight 0 -> 10.0, comments 'x' -> None"
+    )
+
+
+def test_description_stored_and_backfilled(app, Activity1):
+    """New activities keep their description, older ones get it back from the archive."""
+    from copy import deepcopy
+    from application.archive import archive_activity
+    from application.db import get_migrations, migrate_db
+    from application.internal_api import insert_activity, parse_description, handle_manual_activity_errors
+    with app.app_context():
+        activity = deepcopy(Activity1)
+        archive_activity(activity)
+        archive_activity(dict(Activity1, id=4526779166, description="archived walk"))
+        parse_description(activity)
+        handle_manual_activity_errors(activity)
+        insert_activity(activity)
+        db = get_db()
+        description = db.execute(
+            'SELECT description FROM activities WHERE strava_id = ?', (Activity1["id"],)
+        ).fetchone()[0]
+        assert description == Activity1["description"]
+
+        db.execute('UPDATE activities SET description = NULL')
+        db.commit()
+        db.execute('PRAGMA user_version = 8')
+        assert migrate_db(target=9) == [9]
+        rows = db.execute('SELECT strava_id, description FROM activities ORDER BY id').fetchall()
+        expected = [
+            (4526779165, None), (4526779166, "archived walk"), (Activity1["id"], Activity1["description"])
+        ]
+        assert [tuple(row) for row in rows] == expected
+
+        # the archive is read a batch at a time
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('migration_0009', dict(get_migrations())[9])
+        migration = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(migration)
+        with db:
+            db.execute('UPDATE activities SET description = NULL')
+        migration.upgrade(db, batch_size=1)
+        assert [tuple(row) for row in db.execute('SELECT strava_id, description FROM activities ORDER BY id')] == expected
@@ -0,0 +1,106 @@
+"""Tests the day/week/month rollups kept by triggers on the activities table."""
+
+from copy import deepcopy
+
+import pytest
+from application.db import get_db
+from application.internal_api import insert_activity, delete_activity, parse_description, handle_manual_activity_errors
+from application.rollups import rebuild_rollups, weekly_summary
+
+
+def all_rollups():
+    return [
+        (row["period"], row["bucket"], row["activities"], pytest.approx(row["distance"]),
+         pytest.approx(row["total_elevation_gain"]), pytest.approx(row["weight_distance"]),
+         row["knee_pain_sum"], row["knee_pain_count"])
+        for row in get_db().execute("SELECT * FROM rollups ORDER BY period, bucket")
+    ]
+
+
+def assert_matches_rebuild():
+    """The incrementally maintained rollups equal the ones rebuilt from scratch."""
+    incremental = all_rollups()
+    rebuild_rollups()
+    assert incremental == all_rollups()
+
+
+def test_rollups_follow_writes(app, Activity1, Activity3):
+    """Inserts, upserts, updates and deletes all keep the rollups in step with the activities."""
+    with app.app_context():
+        assert_matches_rebuild()
+        buckets = [row[:3] for row in all_rollups()]
+        assert ("week", "2020-12-27", 1) in buckets
+        assert ("week", "2020-10-11", 1) in buckets
+        assert ("month", "2020-10-01", 1) in buckets
+
+        for activity in (Activity1, Activity3):
+            parse_description(activity)
+            handle_manual_activity_errors(activity)
+            insert_activity(activity)
+        assert_matches_rebuild()
+
+        # upsert moves the activity to another week and changes its numbers
+        moved = deepcopy(Activity1)
+        moved.update(start_date="2020-12-26T10:00:00Z", distance=5000, weight=30, knee_pain=4)
+        insert_activity(moved)
+        assert_matches_rebuild()
+
+        db = get_db()
+        with db:
+            db.execute("UPDATE activities SET knee_pain = NULL WHERE strava_id = 4526779166")
+        assert_matches_rebuild()
+
+        delete_activity(4526779165)
+        delete_activity(moved["id"])
+        assert_matches_rebuild()
+        assert ("week", "2020-12-27") not in [row[:2] for row in all_rollups()]
+
+
+def test_weekly_summary(app):
+    """Weeks between activities are filled with zeros and averages are worked out per week."""
+    with app.app_context():
+        summary = weekly_summary()
+        assert [week["date"] for week in summary][:2] == ["2020-10-11", "2020-10-18"]
+        assert len(summary) == 12
+        assert summary[0] == {
+            "date": "2020-10-11", "distance": 11.4, "total_elevation_gain": 310,
+            "knee_pain": 0, "weight": 5,
+        }
+        assert summary[1]["distance"] == 0
+        assert summary[-1]["knee_pain"] == 2
+        assert summary[-1]["weight"] == 10
+
+        assert [week["date"] for week in weekly_summary(weeks=2)] == ["2020-12-20", "2020-12-27"]
+        assert weekly_summary(weeks=-3) == summary
+
+
+def test_weekly_summary_empty(app):
+    with app.app_context():
+        get_db().execute("DELETE FROM activities")
+        get_db().commit()
+        assert weekly_summary() == []
+
+
+def test_rebuild_rollups_command(runner, monkeypatch):
+    class Recorder:
+        called = False
+
+    def fake_rebuild_rollups():
+        Recorder.called = True
+
+    monkeypatch.setattr('application.rollups.rebuild_rollups', fake_rebuild_rollups)
+    result = runner.invoke(args=['rebuild-rollups'])
+    assert 'Rebuilt' in result.output
+    assert Recorder.called
+
+
+def test_rollups_skip_unreadable_dates(app, Activity1):
+    """An activity SQLite can't read the start date of is stored but left out of the rollups."""
+    with app.app_context():
+        before = all_rollups()
+        parse_description(Activity1)
+        handle_manual_activity_errors(Activity1)
+        insert_activity(dict(Activity1, start_date="not a date"))
+        assert all_rollups() == before
+        delete_activity(Activity1["id"])
+        assert_matches_rebuild()
@@ -0,0 +1,85 @@
+"""Testing the importer for Strava's account export."""
+
+import os
+import zipfile
+
+import pytest
+from application.importers import import_strava_export
+from application.internal_api import get_specific_activity
+from application.db import get_db
+
+# header and rows in the layout of a real export's activities.csv, including its repeated columns
+EXPORT_CSV = (
+    "Activity ID,Activity Date,Activity Name,Activity Type,Activity Description,Elapsed Time,Distance,"
+    "Commute,Activity Gear,Filename,Elapsed Time,Moving Time,Distance,Max Speed,Average Speed,"
+    "Elevation Gain,Elevation Loss,Elevation Low,Elevation High\n"
+    '4600000001,"Jan 2, 2021, 3:04:05 PM",Morning Hike,Hike,"25 lbs; knee pain: 1; Rocky, with Jack",'
+    "5400,8.05,false,Boots,activities/1.fit,5400.0,5000.0,8046.7,2.1,1.6,300.5,280.0,10.2,250.3\n"
+    '4600000002,"Jan 3, 2021, 7:00:00 AM",Commute,Ride,,1200,5.00,true,,activities/2.fit,1200.0,1100.0,5000.0,8.0,4.5,20.0,20.0,5.0,25.0\n'
+    '4600000003,"Jan 4, 2021, 7:00:00 AM",Stroll,Walk,,1800,2.00,false,,,1800.0,,2000.0,,,,,,\n'
+)
+
+REPO_EXPORT = os.path.join(
+    os.path.dirname(__file__), os.pardir, "application", "strava", "strava_activities.csv"
+)
+
+
+def test_import_export_zip(app, tmp_path):
+    """Activities are streamed straight out of the zip and mapped onto the activities table."""
+    export = tmp_path / "export_134815.zip"
+    with zipfile.ZipFile(export, "w") as z:
+        z.writestr("export_134815/activities.csv", EXPORT_CSV)
+
+    with app.app_context():
+        stats = list(import_strava_export(str(export), chunk_size=2))
+        assert [s["read"] for s in stats] == [2, 3]
+        assert (stats[-1]["inserted"], stats[-1]["updated"]) == (2, 0)
+
+        hike = get_specific_activity(4600000001)
+        assert hike["start_date"] == "2021-01-02T15:04:05Z"
+        assert hike["distance"] == 8046.7
+        assert hike["moving_time"] == 5000
+        assert hike["elapsed_time"] == 5400
+        assert hike["total_elevation_gain"] == 300.5
+        assert hike["weight"] == 25
+        assert hike["knee_pain"] == 1
+        assert hike["ground_type"] == "rocky"
+        assert get_specific_activity(4600000002) is None
+        assert get_specific_activity(4600000003)["moving_time"] == 0
+
+        # importing again updates instead of duplicating
+        stats = list(import_strava_export(str(export)))
+        assert (stats[-1]["inserted"], stats[-1]["updated"]) == (0, 2)
+
+
+def test_import_export_directory(app, tmp_path):
+    """An unzipped export directory works the same way."""
+    (tmp_path / "activities.csv").write_text(EXPORT_CSV)
+    with app.app_context():
+        list(import_strava_export(str(tmp_path)))
+        assert get_specific_activity(4600000003)["type"] == "Walk"
+
+
+def test_import_export_without_activities(app, tmp_path):
+    """An export without activities.csv, or an empty one, is a clear ValueError."""
+    export = tmp_path / "export.zip"
+    with zipfile.ZipFile(export, "w") as z:
+        z.writestr("export/profile.csv", "Athlete ID\n1\n")
+    (tmp_path / "activities.csv").write_text("")
+    with app.app_context():
+        with pytest.raises(ValueError, match="No activities.csv"):
+            list(import_strava_export(str(export)))
+        with pytest.raises(ValueError, match="Empty activities.csv"):
+            list(import_strava_export(str(tmp_path)))
+
+
+def test_import_repo_strava_csv(app):
+    """The API style dump shipped in application/strava loads too."""
+    with app.app_context():
+        stats = list(import_strava_export(REPO_EXPORT))
+        assert stats[-1]["read"] == 59
+        activity = get_specific_activity(4526779165)
+        assert activity["distance"] == 6301.4
+        assert activity["start_date"] == "2020-12-27T14:45:05Z"
+        count = get_db().execute("SELECT COUNT(*) FROM activities").fetchone()[0]
+        assert count == stats[-1]["inserted"] + 2
@@ -2,7 +2,36 @@
 
 import pytest
 
-@pytest.mark.skip
 def test_index(client):
     """Make sure no errors when fetching index."""
     assert client.get('/').status_code == 200
+
+
+def test_weekly_summary(client):
+    """Make sure no errors when fetching the weekly summary."""
+    assert client.get('/weekly-summary').status_code == 200
+    # a negative number of weeks shows all of them, like 0
+    assert client.get('/weekly-summary?weeks=-3').data == client.get('/weekly-summary?weeks=0').data
+
+
+def test_graphs(client):
+    """Make sure no errors when fetching graphs."""
+    assert client.get('/graphs').status_code == 200
+
+
+def test_index_pages_and_filters(client):
+    """The index shows one page at a time and carries the filters over to the next page."""
+    response = client.get('/?page_size=1&type=')
+    assert b'Dec 27 2020' in response.data
+    assert b'Oct 06 2020' not in response.data
+    assert b'cursor=1609098305:1' in response.data
+
+    response = client.get('/?page_size=1&cursor=1609098305:1')
+    assert b'Oct 06 2020' in response.data
+    assert b'Older' not in response.data
+
+    response = client.get('/?type=Walk&min_knee_pain=0&page_size=1')
+    assert b'Oct 06 2020' in response.data
+    assert b'Dec 27 2020' not in response.data
+
+    assert client.get('/?cursor=nonsense').status_code == 400
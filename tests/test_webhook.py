@@ -0,0 +1,113 @@
+"""Tests the Strava webhook endpoint with recorded event payloads."""
+
+import pytest
+from application.jobs import run_next_job, get_job
+from application.internal_api import get_specific_activity
+
+# payloads as Strava sends them
+CREATE_EVENT = {
+    "aspect_type": "create",
+    "event_time": 1610134821,
+    "object_id": 12345678987654321,
+    "object_type": "activity",
+    "owner_id": 134815,
+    "subscription_id": 120475,
+    "updates": {},
+}
+UPDATE_EVENT = dict(CREATE_EVENT, aspect_type="update", updates={"title": "Messy"})
+DELETE_EVENT = dict(CREATE_EVENT, aspect_type="delete", object_id=4526779165)
+DEAUTHORIZE_EVENT = dict(
+    CREATE_EVENT, object_type="athlete", object_id=134815, updates={"authorized": "false"}
+)
+
+
+@pytest.fixture
+def webhook_app(app):
+    app.config.update(STRAVA_VERIFY_TOKEN="STRAVA", STRAVA_SUBSCRIPTION_ID=120475)
+    return app
+
+
+class MockResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+@pytest.fixture
+def fake_strava(monkeypatch, StravaTokens1):
+    """Serves detailed activities from a dict instead of calling Strava."""
+    activities = {}
+
+    def fake_get_detailed_activity(id, strava_tokens):
+        if id in activities:
+            return MockResponse(200, dict(activities[id]))
+        return MockResponse(404)
+
+    monkeypatch.setattr("application.strava_api.get_tokens", lambda: StravaTokens1)
+    monkeypatch.setattr("application.strava_api.get_detailed_activity", fake_get_detailed_activity)
+    return activities
+
+
+def test_validation_handshake(webhook_app):
+    """Assert the challenge is echoed back only when the verify token matches."""
+    client = webhook_app.test_client()
+    response = client.get(
+        "/webhook?hub.mode=subscribe&hub.verify_token=STRAVA&hub.challenge=15f7d1a91c1f40f8a748fd134752feb3"
+    )
+    assert response.status_code == 200
+    assert response.get_json() == {"hub.challenge": "15f7d1a91c1f40f8a748fd134752feb3"}
+    assert client.get("/webhook?hub.mode=subscribe&hub.verify_token=nope&hub.challenge=1").status_code == 403
+
+
+def test_create_and_update_events(webhook_app, fake_strava, Activity1):
+    """Assert a create event fetches and inserts just that activity, and an update upserts it."""
+    client = webhook_app.test_client()
+    fake_strava[Activity1["id"]] = Activity1
+
+    response = client.post("/webhook", json=CREATE_EVENT)
+    assert response.status_code == 200
+    job_id = response.get_json()["queued"]
+
+    with webhook_app.app_context():
+        # nothing is fetched until the worker runs the job
+        assert get_specific_activity(Activity1["id"]) is None
+        run_next_job()
+        assert get_job(job_id)["status"] == "done"
+        assert get_specific_activity(Activity1["id"])["weight"] == 10
+
+    fake_strava[Activity1["id"]] = dict(Activity1, description="25 lbs; Walked with Jack")
+    client.post("/webhook", json=UPDATE_EVENT)
+    with webhook_app.app_context():
+        run_next_job()
+        assert get_specific_activity(Activity1["id"])["weight"] == 25
+
+
+def test_update_to_other_type_deletes(webhook_app, fake_strava, Activity1):
+    """Assert an activity changed from a Hike to a Ride is removed."""
+    client = webhook_app.test_client()
+    fake_strava[4526779166] = dict(Activity1, id=4526779166, type="Ride")
+    client.post("/webhook", json=dict(UPDATE_EVENT, object_id=4526779166))
+    with webhook_app.app_context():
+        run_next_job()
+        assert get_specific_activity(4526779166) is None
+
+
+def test_delete_event(webhook_app, fake_strava):
+    """Assert a delete event removes the activity without calling Strava."""
+    client = webhook_app.test_client()
+    client.post("/webhook", json=DELETE_EVENT)
+    with webhook_app.app_context():
+        assert get_specific_activity(4526779165) is not None
+        run_next_job()
+        assert get_specific_activity(4526779165) is None
+
+
+def test_ignored_and_rejected_events(webhook_app):
+    """Assert athlete events are ignored and events for other subscriptions are rejected."""
+    client = webhook_app.test_client()
+    assert client.post("/webhook", json=DEAUTHORIZE_EVENT).get_json() == {"queued": None}
+    assert client.post("/webhook", json=dict(CREATE_EVENT, subscription_id=1)).status_code == 403
+    assert client.post("/webhook", data="not json").status_code == 400